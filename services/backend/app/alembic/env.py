@@ -4,6 +4,7 @@ from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 import os
 from app.db import models
+from app.groups import models as group_models
 from alembic import context
 
 # How to run:
@@ -1,7 +1,7 @@
 """orig
 
 Revision ID: b34033a76c83
-Revises: 0bd8723f72d4
+Revises: 05b9a36d4482
 Create Date: 2023-10-08 22:08:58.378088
 
 """
@@ -13,7 +13,7 @@ import sqlalchemy as sa
 
 # revision identifiers, used by Alembic.
 revision: str = 'b34033a76c83'
-down_revision: Union[str, None] = '0bd8723f72d4'
+down_revision: Union[str, None] = '05b9a36d4482'
 branch_labels: Union[str, Sequence[str], None] = None
 depends_on: Union[str, Sequence[str], None] = None
 
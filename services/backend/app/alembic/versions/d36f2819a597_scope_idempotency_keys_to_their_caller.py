@@ -0,0 +1,34 @@
+"""scope idempotency keys to their caller
+
+Revision ID: d36f2819a597
+Revises: 83a433512c63
+Create Date: 2026-10-18 20:31:10.768179
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd36f2819a597'
+down_revision: Union[str, None] = '83a433512c63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Keys stored so far have no caller: '' keeps them (they only replay to nobody) until they expire
+    op.add_column('idempotency_keys', sa.Column('caller', sa.String(), server_default='', nullable=False))
+    op.alter_column('idempotency_keys', 'caller', server_default=None)
+    op.drop_constraint('idempotency_keys_pkey', 'idempotency_keys', type_='primary')
+    op.create_primary_key('idempotency_keys_pkey', 'idempotency_keys', ['key', 'endpoint', 'caller'])
+
+
+def downgrade() -> None:
+    # Keys reused by several callers can't share one row any more
+    op.execute("DELETE FROM idempotency_keys")
+    op.drop_constraint('idempotency_keys_pkey', 'idempotency_keys', type_='primary')
+    op.create_primary_key('idempotency_keys_pkey', 'idempotency_keys', ['key', 'endpoint'])
+    op.drop_column('idempotency_keys', 'caller')
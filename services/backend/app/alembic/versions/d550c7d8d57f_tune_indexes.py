@@ -0,0 +1,55 @@
+"""tune indexes
+
+Revision ID: d550c7d8d57f
+Revises: 966e339d5ac6
+Create Date: 2026-10-18 19:37:30.744512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd550c7d8d57f'
+down_revision: Union[str, None] = '966e339d5ac6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Emails become unique regardless of case; stop with a clear message instead of a failed index build
+    duplicates = op.get_bind().execute(sa.text(
+        "SELECT lower(email) FROM users WHERE email IS NOT NULL GROUP BY lower(email) HAVING count(*) > 1"
+    )).scalars().all()
+    if duplicates:
+        raise RuntimeError(f"Emails that differ only in case must be merged first: {', '.join(duplicates)}")
+
+    # CONCURRENTLY so the tables stay writable while the indexes build; it can't run in a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_email_lower', 'users', [sa.text('lower(email)')],
+                        unique=True, postgresql_concurrently=True)
+        op.drop_index('ix_users_email', table_name='users', postgresql_concurrently=True)
+        op.create_index('ix_groups_owner_id', 'groups', ['owner_id'], postgresql_concurrently=True)
+        op.create_index('ix_groups_name_id', 'groups', ['name', 'id'], postgresql_concurrently=True)
+        op.drop_index('ix_groups_name', table_name='groups', postgresql_concurrently=True)
+        # Free-text column nothing filters on: only cost writes
+        op.drop_index('ix_groups_description', table_name='groups', postgresql_concurrently=True)
+        # Duplicates of the primary key indexes
+        op.drop_index('ix_users_id', table_name='users', postgresql_concurrently=True)
+        op.drop_index('ix_groups_id', table_name='groups', postgresql_concurrently=True)
+        op.drop_index('ix_expenses_id', table_name='expenses', postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_expenses_id', 'expenses', ['id'], postgresql_concurrently=True)
+        op.create_index('ix_groups_id', 'groups', ['id'], postgresql_concurrently=True)
+        op.create_index('ix_users_id', 'users', ['id'], postgresql_concurrently=True)
+        op.create_index('ix_groups_description', 'groups', ['description'], postgresql_concurrently=True)
+        op.create_index('ix_groups_name', 'groups', ['name'], postgresql_concurrently=True)
+        op.drop_index('ix_groups_name_id', table_name='groups', postgresql_concurrently=True)
+        op.drop_index('ix_groups_owner_id', table_name='groups', postgresql_concurrently=True)
+        op.create_index('ix_users_email', 'users', ['email'], unique=True, postgresql_concurrently=True)
+        op.drop_index('ix_users_email_lower', table_name='users', postgresql_concurrently=True)
@@ -0,0 +1,321 @@
+""" Response cache for read endpoints: serialized bodies with ETags, invalidated by namespace """
+import hashlib
+import json
+import socket
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+from fastapi import Request, Response
+
+from app import metrics
+from app.config import get_settings
+from app.responses import dump_json
+
+CACHE_REQUESTS = metrics.Counter(
+    "response_cache_requests_total", "Cached route lookups by outcome (hit, not_modified, miss)", ["result"])
+CACHE_ERRORS = metrics.Counter(
+    "response_cache_errors_total", "Cache backend calls that failed and were treated as a miss")
+
+
+class MemoryBackend:
+    """ Per-process LRU of serialized responses with a TTL per entry, plus namespace versions """
+    # Calls never wait on I/O, so async callers make them directly
+    blocking = False
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._versions: dict[str, int] = {}
+        # Namespace -> monotonic time until which its last bump counts as recent
+        self._recent: dict[str, float] = {}
+        # Sync crud functions run in the threadpool and can invalidate concurrently
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def versions(self, namespaces: tuple):
+        """ Version of each namespace, and whether any of them was bumped recently (see bump()) """
+        now = time.monotonic()
+        with self._lock:
+            return ([self._versions.get(namespace, 0) for namespace in namespaces],
+                    any(self._recent.get(namespace, 0) > now for namespace in namespaces))
+
+    def bump(self, namespace: str, recent: float):
+        """ Move namespace to a new version, counted as recent for the next recent seconds """
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+            self._recent[namespace] = time.monotonic() + recent
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._recent.clear()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+
+class RedisBackend:
+    """
+    Shared cache on any server speaking the Redis protocol (Redis, Valkey, KeyDB, ...), so every worker
+    sees the same entries and invalidations. Uses one blocking connection with a short timeout; calls
+    are sub-millisecond on a local server, but a slow or unreachable server would hold the event loop,
+    so async callers run them in a thread. Entry eviction is left to the server's maxmemory policy
+    """
+    blocking = True
+
+    def __init__(self, url: str, timeout: float):
+        parts = urlsplit(url)
+        self.address = (parts.hostname or "localhost", parts.port or 6379)
+        self.database = int(parts.path.lstrip("/") or 0)
+        self.password = parts.password
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile("rb")
+        if self.password:
+            self._send("AUTH", self.password)
+        if self.database:
+            self._send("SELECT", self.database)
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = self._reader = None
+
+    def _send(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self._sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Cache server closed the connection")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload
+        if kind == b"-":
+            raise RuntimeError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            if payload == b"-1":
+                return None
+            value = self._reader.read(int(payload) + 2)
+            return value[:-2]
+        if kind == b"*":
+            if payload == b"-1":
+                return None
+            return [self._read_reply() for _ in range(int(payload))]
+        raise ConnectionError(f"Unexpected reply from cache server: {line!r}")
+
+    def command(self, *args):
+        """ Run one command, reconnecting once if the connection went away """
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._send(*args)
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt:
+                        raise
+
+    def get(self, key: str):
+        return self.command("GET", key)
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.command("SET", key, value, "PX", max(1, int(ttl * 1000)))
+
+    def versions(self, namespaces: tuple):
+        values = self.command("MGET", *(f"version:{namespace}" for namespace in namespaces),
+                              *(f"recent:{namespace}" for namespace in namespaces))
+        versions, recent = values[:len(namespaces)], values[len(namespaces):]
+        return [int(value) if value is not None else 0 for value in versions], any(recent)
+
+    def bump(self, namespace: str, recent: float):
+        self.command("INCR", f"version:{namespace}")
+        if recent:
+            self.command("SET", f"recent:{namespace}", 1, "PX", max(1, int(recent * 1000)))
+
+    def clear(self):
+        self.command("FLUSHDB")
+
+    def after_fork(self):
+        # The socket belongs to the parent; open a new one on the next command
+        self._sock = self._reader = None
+        self._lock = threading.Lock()
+
+
+def _etag(body: bytes):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as If-None-Match requires
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def _pack(etag: str, headers: dict, body: bytes):
+    return etag.encode() + b"\n" + json.dumps(headers, separators=(",", ":")).encode() + b"\n" + body
+
+
+def _unpack(value: bytes):
+    etag, headers, body = value.split(b"\n", 2)
+    return etag.decode(), json.loads(headers), body
+
+
+class ResponseCache:
+    """
+    Caches the serialized JSON body of GET responses, keyed by path, query string and the current
+    version of every namespace the response depends on ("users", "groups"). Writes call invalidate(),
+    which bumps the namespace version so older entries are never read again and age out of the backend.
+    A response computed while a write was in flight is stored under the version read before it, so it
+    can't outlive the write. A miss within primary_seconds of a write is filled from the primary, since a
+    lagging replica would cache the data from before the write under its new version. Every response
+    carries an ETag; a matching If-None-Match gets a 304
+    """
+
+    def __init__(self, backend, ttl: float, primary_seconds: float = 0.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.primary_seconds = primary_seconds
+
+    def _call(self, fn, *args):
+        # A broken cache must not break reads; treat errors as a miss
+        try:
+            return fn(*args)
+        except Exception:
+            CACHE_ERRORS.inc()
+            return None
+
+    async def _call_async(self, fn, *args):
+        """ _call from a coroutine: in a thread if the backend does blocking I/O """
+        if self.backend.blocking:
+            return await metrics.to_thread(self._call, fn, *args)
+        return self._call(fn, *args)
+
+    async def _key(self, request: Request, namespaces: tuple):
+        """ Cache key of the request at the namespaces' current versions, and whether one was just bumped """
+        result = await self._call_async(self.backend.versions, namespaces)
+        if result is None:
+            return None, False
+        versions, recent = result
+        query = "&".join(sorted(request.url.query.split("&"))) if request.url.query else ""
+        tags = ",".join(f"{namespace}:{version}" for namespace, version in zip(namespaces, versions))
+        return f"response:{request.url.path}?{query}|{tags}", recent
+
+    async def get(self, request: Request, namespaces: tuple):
+        """
+        The cached response for this request (or a 304 if the client already has it), or None on a miss.
+        Namespace versions are stashed on the request so set() stores under the key read here
+        """
+        if self.backend is None:
+            return None
+        key, recent = await self._key(request, namespaces)
+        request.state.response_cache_key = key
+        value = await self._call_async(self.backend.get, key) if key is not None else None
+        if value is None:
+            CACHE_REQUESTS.inc(1, "miss")
+            read_db = getattr(request.state, "read_db", None)
+            if recent and read_db is not None:
+                # Set by get_async_read_db: the fill reads from the primary
+                read_db.info["use_replica"] = False
+            return None
+        etag, headers, body = _unpack(value)
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            CACHE_REQUESTS.inc(1, "not_modified")
+            return Response(status_code=304, headers={"ETag": etag, **headers})
+        CACHE_REQUESTS.inc(1, "hit")
+        return Response(content=body, media_type="application/json", headers={"ETag": etag, **headers})
+
+    async def set(self, request: Request, type_, content, response: Response | None = None):
+        """
+        Serialize content once as type_, cache it along with the headers the route set on
+        response (e.g. X-Next-Cursor) and return the response to send
+        """
+        body = dump_json(type_, content)
+        etag = _etag(body)
+        headers = {}
+        if response is not None:
+            headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+        key = getattr(request.state, "response_cache_key", None)
+        if self.backend is not None and key is not None:
+            await self._call_async(self.backend.set, key, _pack(etag, headers, body), self.ttl)
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag, **headers})
+        return Response(content=body, media_type="application/json", headers={"ETag": etag, **headers})
+
+    def invalidate(self, *namespaces: str):
+        """ Make every cached response depending on these namespaces stale; for sync code (threadpool) """
+        if self.backend is None:
+            return
+        for namespace in namespaces:
+            self._call(self.backend.bump, namespace, self.primary_seconds)
+
+    async def invalidate_async(self, *namespaces: str):
+        """ invalidate() for coroutines, keeping the backend's I/O off the event loop """
+        if self.backend is None:
+            return
+        for namespace in namespaces:
+            await self._call_async(self.backend.bump, namespace, self.primary_seconds)
+
+    def clear(self):
+        if self.backend is not None:
+            self._call(self.backend.clear)
+
+    def after_fork(self):
+        """ Drop the backend's connection and locks inherited from a parent process """
+        if self.backend is not None:
+            self.backend.after_fork()
+
+
+def create_backend(settings):
+    if settings.response_cache_backend == "redis":
+        return RedisBackend(settings.response_cache_url, timeout=settings.response_cache_timeout)
+    if settings.response_cache_backend == "memory":
+        return MemoryBackend(max_entries=settings.response_cache_max_entries)
+    return None
+
+
+@lru_cache
+def get_response_cache():
+    """ The process's response cache, created from the settings on first use """
+    settings = get_settings()
+    return ResponseCache(create_backend(settings), ttl=settings.response_cache_ttl,
+                         primary_seconds=settings.response_cache_primary_seconds)
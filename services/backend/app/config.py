@@ -1,4 +1,5 @@
 import os
+from typing import Literal
 
 from pydantic import Field
 from functools import lru_cache
@@ -8,6 +9,107 @@ from pydantic import PostgresDsn
 # Will read in environment variable passed through Docker and validate that it's a postfreszl link
 class Settings(BaseSettings):
     database_url: PostgresDsn
+    # Optional read replicas, as a JSON list in DATABASE_REPLICA_URLS; GET routes read from these
+    database_replica_urls: list[PostgresDsn] = []
+    # Replicas are health checked every replica_health_check_seconds; a failing one is left out of
+    # rotation for replica_eject_seconds (or until it passes a check)
+    replica_health_check_seconds: float = Field(default=5.0, gt=0)
+    replica_eject_seconds: float = Field(default=30.0, gt=0)
+
+    # Connection pool for the async engine (env: DB_POOL_SIZE, DB_MAX_OVERFLOW, ...)
+    db_pool_size: int = Field(default=10, ge=1)
+    db_max_overflow: int = Field(default=20, ge=0)
+    db_pool_timeout: float = Field(default=30.0, gt=0)
+    db_pool_pre_ping: bool = True
+    # /ready reports 503 when a pooled connection can't answer SELECT 1 within this many seconds
+    readiness_timeout: float = Field(default=2.0, gt=0)
+
+    # bcrypt process pool (env: PASSWORD_HASH_WORKERS, ...); calls past workers + queue limit get a 503
+    password_hash_workers: int = Field(default_factory=lambda: os.cpu_count() or 1, ge=1)
+    password_hash_queue_limit: int = Field(default=64, ge=0)
+    password_hash_retry_after: int = Field(default=1, ge=1)
+
+    # Verified JWT cache used by get_current_user
+    token_cache_max_entries: int = Field(default=10_000, ge=1)
+    token_cache_max_ttl: float = Field(default=300.0, gt=0)
+
+    # Cache for GET /users/ and /groups/ responses: "memory" (per worker LRU, only for a single worker:
+    # gunicorn_conf.py defaults to "redis" when it starts several), "redis" (shared, any Redis protocol
+    # server at response_cache_url) or "off". Writes invalidate it; ttl bounds staleness of changes made
+    # outside the app. For response_cache_primary_seconds after a write, misses are filled from the
+    # primary rather than a replica that may not have the write yet
+    response_cache_backend: Literal["memory", "redis", "off"] = "memory"
+    response_cache_url: str = "redis://localhost:6379/0"
+    response_cache_ttl: float = Field(default=30.0, gt=0)
+    response_cache_max_entries: int = Field(default=1000, ge=1)
+    response_cache_timeout: float = Field(default=0.25, gt=0)
+    response_cache_primary_seconds: float = Field(default=10.0, ge=0)
+
+    # Token buckets in front of /token, /login and /reset/, per client IP and per email: a bucket holds
+    # *_burst attempts and refills at *_per_minute. "memory" keeps them per worker (sharded LRU of at most
+    # rate_limit_max_keys buckets), "redis" shares them through rate_limit_url, "off" disables limiting
+    rate_limit_backend: Literal["memory", "redis", "off"] = "memory"
+    rate_limit_url: str = "redis://localhost:6379/1"
+    rate_limit_timeout: float = Field(default=0.25, gt=0)
+    rate_limit_shards: int = Field(default=16, ge=1)
+    rate_limit_max_keys: int = Field(default=100_000, ge=1)
+    rate_limit_ip_burst: int = Field(default=20, ge=1)
+    rate_limit_ip_per_minute: float = Field(default=10.0, gt=0)
+    rate_limit_email_burst: int = Field(default=5, ge=1)
+    rate_limit_email_per_minute: float = Field(default=2.0, gt=0)
+
+    # Idempotency-Key on POST /users/ and /users/{id}/groups/: responses are replayed for idempotency_ttl
+    # seconds (up to idempotency_cache_max_entries of them from memory), expired keys are purged every
+    # idempotency_purge_seconds. A key whose first request is still running is held for
+    # idempotency_lease_seconds at a time, so a retry can take it over if that request's worker died
+    idempotency_ttl: float = Field(default=86400.0, gt=0)
+    idempotency_lease_seconds: float = Field(default=30.0, gt=0)
+    idempotency_cache_max_entries: int = Field(default=10_000, ge=1)
+    idempotency_purge_seconds: float = Field(default=3600.0, gt=0)
+
+    # FX rates are stored against fx_pivot_currency (whose rate is always 1); looked up rates are cached
+    # per (currency, day) for fx_cache_ttl seconds
+    fx_pivot_currency: str = Field(default="USD", pattern=r"^[A-Z]{3}$")
+    fx_cache_ttl: float = Field(default=300.0, gt=0)
+    fx_cache_max_entries: int = Field(default=10_000, ge=1)
+    # Usernames allowed to load FX rates through PUT /fx/rates
+    admin_usernames: list[str] = []
+
+    # Settlements of groups with at most settlement_exact_max_members unsettled balances use the exact
+    # minimum-transfers engine (2 ** n subsets, so keep it small) unless it takes over settlement_time_budget
+    # seconds; bigger groups, and timeouts, use the greedy engine
+    settlement_exact_max_members: int = Field(default=20, ge=0, le=24)
+    settlement_time_budget: float = Field(default=0.5, gt=0)
+
+    # A group's balances are snapshotted every ledger_snapshot_interval ledger events, which bounds how many
+    # events a balances-as-of query replays
+    ledger_snapshot_interval: int = Field(default=100, ge=1)
+
+    # Background jobs, run by python -m app.jobs (job_concurrency at a time) and, if job_in_process_concurrency
+    # is above 0, inside every web worker too. Idle workers poll every job_poll_interval seconds. A running
+    # job's lease is renewed while it runs and lapses job_lease_seconds after its worker died, then the job is
+    # retried; failed attempts are retried up to job_max_attempts, backing off exponentially from
+    # job_backoff_base up to job_backoff_max seconds. Finished jobs are kept job_retention_seconds
+    job_concurrency: int = Field(default=4, ge=1)
+    job_in_process_concurrency: int = Field(default=0, ge=0)
+    job_poll_interval: float = Field(default=1.0, gt=0)
+    job_lease_seconds: float = Field(default=60.0, gt=0)
+    job_max_attempts: int = Field(default=5, ge=1)
+    job_backoff_base: float = Field(default=2.0, gt=0)
+    job_backoff_max: float = Field(default=300.0, gt=0)
+    job_retention_seconds: float = Field(default=7 * 86400.0, gt=0)
+
+    # Live group streams (GET /groups/{id}/stream): a subscriber more than stream_queue_size events behind
+    # is disconnected and resumes with Last-Event-ID, replaying at most stream_replay_limit missed events.
+    # Idle streams get a keep-alive comment every stream_heartbeat_seconds
+    stream_queue_size: int = Field(default=256, ge=1)
+    stream_replay_limit: int = Field(default=1000, ge=1)
+    stream_heartbeat_seconds: float = Field(default=15.0, gt=0)
+
+    # Rows per INSERT ... RETURNING (and per parallel hashing round) in bulk imports
+    import_batch_size: int = Field(default=1000, ge=1)
+    # Rows fetched from the server-side cursor (and sent as one chunk) per round in exports
+    export_batch_size: int = Field(default=1000, ge=1)
 
 @lru_cache
 def get_settings() -> Settings:
@@ -16,4 +118,4 @@ def get_settings() -> Settings:
 
 # Define settings class
 # BaseSettings from pydantic validates the data on creation of instance
-# Auto loads db url from environment variable
\ No newline at end of file
+# Auto loads db url from environment variable
@@ -0,0 +1,71 @@
+""" Fixtures for the tests kept next to the modules they cover
+
+Run with: python -m pytest app
+Tests using the client fixture need TEST_DATABASE_URL, a scratch Postgres database: its tables are
+dropped and created again once per run and emptied before every test. Without it they're skipped
+"""
+import os
+
+import pytest
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+if TEST_DATABASE_URL:
+    # Before anything reads the settings
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+
+PASSWORD = "test-password"
+
+
+@pytest.fixture(scope="session")
+def database_url():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    from sqlalchemy import create_engine
+
+    from app.db import models
+    from app.groups import models as group_models  # noqa: F401 (registers the group tables)
+
+    engine = create_engine(TEST_DATABASE_URL)
+    # The app leaves the schema to Alembic; like the benchmarks, tests create it directly
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    engine.dispose()
+    return TEST_DATABASE_URL
+
+
+@pytest.fixture
+def client(database_url):
+    """ TestClient of the app (lifespan included) over empty tables and caches """
+    from fastapi.testclient import TestClient
+    from sqlalchemy import create_engine, text
+
+    from app.cache import get_response_cache
+    from app.db import models
+    from app.groups.fx import get_rate_cache
+    from app.idempotency import get_idempotency_store
+    from app.main import app
+    from app.ratelimit import get_limiter_backend
+    from app.users.utils import get_token_cache
+
+    engine = create_engine(database_url)
+    tables = ", ".join(table.name for table in models.Base.metadata.sorted_tables)
+    with engine.begin() as connection:
+        connection.execute(text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
+    engine.dispose()
+    caches = (get_response_cache(), get_rate_cache(), get_idempotency_store().front, get_limiter_backend(),
+              get_token_cache())
+    for cache in caches:
+        if cache is not None:
+            cache.clear()
+    with TestClient(app) as client:
+        yield client
+
+
+def create_user(client, name: str):
+    """ Sign a user up; returns (user, Authorization headers) """
+    user = client.post("/users/", headers={"Authorization": "Bearer signup"}, json={
+        "email": f"{name}@example.com", "username": name, "given_name": name.title(), "family_name": "Test",
+        "password": PASSWORD, "confirm_password": PASSWORD,
+    }).json()
+    token = client.post("/token", data={"username": user["email"], "password": PASSWORD}).json()["access_token"]
+    return user, {"Authorization": f"Bearer {token}"}
@@ -0,0 +1,161 @@
+""" Async CRUD operations: same functions as crud.py but awaited on an AsyncSession """
+#  External imports
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, raiseload, selectinload
+
+# Local imports
+from app.cache import get_response_cache
+from app.db import models, schemas
+from app.groups.models import GroupMember
+from app.users.service import get_password_hasher
+from app.users.utils import get_token_cache
+
+# Relationships can't lazy load on an AsyncSession (no implicit IO), so anything
+# serialized through UserModel needs its groups loaded up front. Strategies:
+#   selectin: one extra "WHERE owner_id IN (...)" query for the whole page; best for lists
+#   joined:   a single LEFT OUTER JOIN; best for single user lookups
+#   none:     groups aren't needed (e.g. password checks); touching them raises instead of querying
+USER_GROUP_LOADERS = {
+    "selectin": selectinload(models.User.groups),
+    "joined": joinedload(models.User.groups),
+    "none": raiseload(models.User.groups),
+}
+
+
+def _select_user(load_groups: str = "selectin"):
+    return select(models.User).options(USER_GROUP_LOADERS[load_groups])
+
+
+def _first_user(result):
+    # Joined loading returns one row per group, so consume them all (first() would stop after one)
+    users = result.unique().scalars().all()
+    return users[0] if users else None
+
+
+# Keyset columns for each group sort order; the trailing ID makes the key unique
+GROUP_SORTS = {
+    "id": (models.Group.id,),
+    "name": (models.Group.name, models.Group.id),
+}
+
+# A plain refresh() expires User.groups again; list the attributes so groups is reloaded too
+USER_REFRESH_ATTRIBUTES = [column.key for column in models.User.__table__.columns] + ["groups"]
+
+
+async def get_user(db: AsyncSession, user_id: int, load_groups: str = "joined"):
+    """ Get user by ID from database """
+    result = await db.execute(_select_user(load_groups).filter(models.User.id == user_id))
+    return _first_user(result)
+
+
+async def get_user_by_username(db: AsyncSession, username: str, load_groups: str = "joined"):
+    """ Get user by username (the JWT subject) from database """
+    result = await db.execute(_select_user(load_groups).filter(models.User.username == username))
+    return _first_user(result)
+
+
+async def get_user_by_email(db: AsyncSession, email: str, load_groups: str = "joined"):
+    """ Get user by email address (case-insensitive) from database """
+    result = await db.execute(_select_user(load_groups).filter(func.lower(models.User.email) == email.lower()))
+    return _first_user(result)
+
+
+# Get multiple users
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int | None = None, load_groups: str = "selectin"):
+    """ Get list of all users ordered by ID; pass after_id (keyset) instead of skip for deep pages """
+    query = _select_user(load_groups).order_by(models.User.id)
+    if after_id is not None:
+        query = query.filter(models.User.id > after_id)
+    else:
+        query = query.offset(skip)
+    result = await db.execute(query.limit(limit))
+    return result.scalars().all()
+
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate, commit: bool = True):
+    """
+    After checking if account already exists, add user and password to db; with commit=False the user is
+    only flushed, leaving the commit (and the "users" cache invalidation after it) to the caller
+    """
+    db_user = models.User(email=user.email, username=user.username,
+                          given_name=user.given_name, family_name=user.family_name)
+    db_user.hashed_password = await get_password_hasher().hash(user.password)
+    db.add(db_user)
+    if commit:
+        await db.commit()
+        await get_response_cache().invalidate_async("users")
+    else:
+        await db.flush()
+    await db.refresh(db_user, attribute_names=USER_REFRESH_ATTRIBUTES)
+    return db_user
+
+
+async def get_groups(db: AsyncSession, skip: int = 0, limit: int = 100, sort: str = "id", after: list | None = None):
+    """
+    Get list of all groups ordered by sort ("id" or "name", ties broken by ID);
+    pass the last row's key as after (keyset) instead of skip for deep pages
+    """
+    query = select(models.Group).order_by(*GROUP_SORTS[sort])
+    if after is not None:
+        query = query.filter(tuple_(*GROUP_SORTS[sort]) > tuple_(*after))
+    else:
+        query = query.offset(skip)
+    result = await db.execute(query.limit(limit))
+    return result.scalars().all()
+
+
+async def create_user_group(db: AsyncSession, group: schemas.GroupCreate, user_id: int, commit: bool = True):
+    """ Create a group assigned to the specific user; commit=False leaves it flushed, as for create_user """
+    db_group = models.Group(**group.dict(), owner_id=user_id)
+    db.add(db_group)
+    await db.flush()
+    # The owner is the group's first member
+    db.add(GroupMember(group_id=db_group.id, user_id=user_id, role="owner"))
+    if commit:
+        await db.commit()
+        await get_response_cache().invalidate_async("groups")
+    else:
+        await db.flush()
+    await db.refresh(db_group)
+    return db_group
+
+
+async def authenticate_user_by_email(db: AsyncSession, username: str, password: str):
+    """
+    Takes user email and password, verifies if it matches with database;
+    Returns false or user
+    """
+    user = await get_user_by_email(db, email=username, load_groups="none")
+    if not user:
+        return False
+    if not await get_password_hasher().verify(password, user.hashed_password):
+        return False
+    return user
+
+
+async def reset_user_password(db: AsyncSession, email: str, password: str):
+    """ If user account exists for given email, reset the password """
+    user = await get_user_by_email(db, email=email)
+    if not user:
+        return False
+    user.hashed_password = await get_password_hasher().hash(password)
+    await db.commit()
+    # Tokens issued before the reset must be verified (and the user re-read) again
+    get_token_cache().invalidate_user(user.id)
+    await get_response_cache().invalidate_async("users")
+    await db.refresh(user, attribute_names=USER_REFRESH_ATTRIBUTES)
+    return user
+
+
+async def deactivate_user(db: AsyncSession, user_id: int):
+    """ Mark a user inactive and drop their cached tokens """
+    user = await get_user(db, user_id=user_id)
+    if not user:
+        return False
+    user.is_active = False
+    await db.commit()
+    get_token_cache().invalidate_user(user.id)
+    await get_response_cache().invalidate_async("users")
+    await db.refresh(user, attribute_names=USER_REFRESH_ATTRIBUTES)
+    return user
@@ -0,0 +1,213 @@
+""" Bulk import of users and groups from NDJSON or CSV """
+import csv
+import io
+import json
+
+from pydantic import ValidationError
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.cache import get_response_cache
+from app.db import models, schemas
+from app.groups.models import GroupMember
+from app.users.service import get_password_hasher
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+CSV_TYPES = ("text/csv", "application/csv")
+
+
+def parse_rows(body: bytes, content_type: str):
+    """
+    Split an import body into (line number, row dict) pairs, or (line number, error) for rows
+    that can't be parsed. NDJSON: one object per line, blank lines skipped. CSV: header row of field names.
+    """
+    media_type = content_type.split(";")[0].strip().lower()
+    text = body.decode("utf-8-sig")
+    if media_type in NDJSON_TYPES:
+        for line, raw in enumerate(text.splitlines(), start=1):
+            if not raw.strip():
+                continue
+            try:
+                row = json.loads(raw)
+            except ValueError as exc:
+                yield line, f"Invalid JSON: {exc}"
+                continue
+            if not isinstance(row, dict):
+                yield line, "Expected a JSON object"
+                continue
+            yield line, row
+    elif media_type in CSV_TYPES:
+        for line, row in enumerate(csv.DictReader(io.StringIO(text)), start=1):
+            # Empty cells mean "not given" so optional fields fall back to their defaults
+            yield line, {key: value for key, value in row.items() if key is not None and value != ""}
+    else:
+        raise ValueError(f"Unsupported content type {content_type!r}, use NDJSON or CSV")
+
+
+def _validate(rows, model):
+    """ Validate parsed rows against a schema; returns (valid [(line, model)], errors) """
+    valid, errors = [], []
+    for line, row in rows:
+        if isinstance(row, str):
+            errors.append(schemas.ImportRowError(line=line, error=row))
+            continue
+        try:
+            valid.append((line, model.model_validate(row)))
+        except ValidationError as exc:
+            message = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in exc.errors())
+            errors.append(schemas.ImportRowError(line=line, error=message))
+    return valid, errors
+
+
+def _batches(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def hash_passwords(rows):
+    """
+    Validate rows with UserCreate and replace their passwords by their hash, so the rows can be stored
+    (in a job's payload) without them; returns (line, row) pairs for import_users(hashed=True), rows
+    rejected here carrying their error instead, as from parse_rows
+    """
+    valid, errors = _validate(rows, schemas.UserCreate)
+    hashed_rows = [(error.line, error.error) for error in errors]
+    matching = []
+    for line, user in valid:
+        if user.password != user.confirm_password:
+            hashed_rows.append((line, "Passwords do not match"))
+        else:
+            matching.append((line, user))
+    hashes = await get_password_hasher().hash_many([user.password for _, user in matching])
+    for (line, user), hashed in zip(matching, hashes):
+        fields = user.model_dump(exclude={"password", "confirm_password"})
+        hashed_rows.append((line, schemas.UserImport(**fields, hashed_password=hashed).model_dump()))
+    hashed_rows.sort(key=lambda row: row[0])
+    return hashed_rows
+
+
+async def import_users(db: AsyncSession, rows, batch_size: int, hashed: bool = False):
+    """
+    Validate rows with UserCreate (UserImport if hashed, for rows from hash_passwords) and insert them batch
+    by batch with a multi-row INSERT ... RETURNING. Duplicate emails and usernames (within the upload or
+    already stored) are found with one query each per batch, and each batch's passwords are hashed in
+    parallel across the password process pool.
+    """
+    valid, errors = _validate(rows, schemas.UserImport if hashed else schemas.UserCreate)
+    result = schemas.ImportResult(created=0, errors=errors)
+    seen_emails, seen_usernames = set(), set()
+    for batch in _batches(valid, batch_size):
+        candidates = []
+        for line, user in batch:
+            if not hashed and user.password != user.confirm_password:
+                result.errors.append(schemas.ImportRowError(line=line, error="Passwords do not match"))
+            elif user.email.lower() in seen_emails:
+                result.errors.append(schemas.ImportRowError(line=line, error="Duplicate email in upload"))
+            elif user.username in seen_usernames:
+                result.errors.append(schemas.ImportRowError(line=line, error="Duplicate username in upload"))
+            else:
+                seen_emails.add(user.email.lower())
+                seen_usernames.add(user.username)
+                candidates.append((line, user))
+
+        # Emails are unique regardless of case (unique index on lower(email)), usernames as given
+        emails = [user.email.lower() for _, user in candidates]
+        lower_email = func.lower(models.User.email)
+        existing_emails = set((await db.scalars(select(lower_email).filter(lower_email.in_(emails)))).all())
+        usernames = [user.username for _, user in candidates]
+        existing_usernames = set((await db.scalars(
+            select(models.User.username).filter(models.User.username.in_(usernames)))).all())
+        new_users = []
+        for line, user in candidates:
+            if user.email.lower() in existing_emails:
+                result.errors.append(schemas.ImportRowError(line=line, error="Email already registered"))
+            elif user.username in existing_usernames:
+                result.errors.append(schemas.ImportRowError(line=line, error="Username already taken"))
+            else:
+                new_users.append((line, user))
+        if not new_users:
+            continue
+
+        if hashed:
+            hashes = [user.hashed_password for _, user in new_users]
+        else:
+            hashes = await get_password_hasher().hash_many([user.password for _, user in new_users])
+        values = [
+            {
+                "email": user.email,
+                "username": user.username,
+                "given_name": user.given_name,
+                "family_name": user.family_name,
+                "hashed_password": hashed,
+                "is_active": True,
+            }
+            for (_, user), hashed in zip(new_users, hashes)
+        ]
+        # A concurrent signup can still take an email between the check and the insert; skip those rows.
+        # Only email conflicts are skipped: a username taken meanwhile fails the batch rather than being
+        # reported as the wrong error
+        statement = (
+            insert(models.User)
+            .on_conflict_do_nothing(index_elements=[func.lower(models.User.email)])
+            .returning(models.User.id, models.User.email)
+        )
+        inserted = {email: user_id for user_id, email in (await db.execute(statement, values)).all()}
+        await db.commit()
+        for line, user in new_users:
+            if user.email in inserted:
+                result.ids.append(inserted[user.email])
+            else:
+                result.errors.append(schemas.ImportRowError(line=line, error="Email already registered"))
+
+    if result.ids:
+        await get_response_cache().invalidate_async("users")
+    result.created = len(result.ids)
+    result.errors.sort(key=lambda error: error.line)
+    return result
+
+
+async def import_groups(db: AsyncSession, rows, batch_size: int):
+    """
+    Validate rows with GroupImport and insert them batch by batch with a multi-row INSERT ... RETURNING.
+    Owner emails are resolved to user IDs with one query per batch.
+    """
+    valid, errors = _validate(rows, schemas.GroupImport)
+    result = schemas.ImportResult(created=0, errors=errors)
+    for batch in _batches(valid, batch_size):
+        emails = {group.owner_email.lower() for _, group in batch}
+        lower_email = func.lower(models.User.email)
+        owners = dict((await db.execute(
+            select(lower_email, models.User.id).filter(lower_email.in_(emails))
+        )).all())
+        new_groups = []
+        for line, group in batch:
+            if group.owner_email.lower() not in owners:
+                result.errors.append(schemas.ImportRowError(line=line, error="Owner email not found"))
+            else:
+                new_groups.append((line, group))
+        if not new_groups:
+            continue
+
+        values = [
+            {
+                "name": group.name, "description": group.description, "currency": group.currency,
+                "owner_id": owners[group.owner_email.lower()],
+            }
+            for _, group in new_groups
+        ]
+        statement = insert(models.Group).returning(models.Group.id, sort_by_parameter_order=True)
+        ids = (await db.scalars(statement, values)).all()
+        # Owners join their groups in the same transaction, again one multi-row INSERT
+        await db.execute(insert(GroupMember), [
+            {"group_id": group_id, "user_id": value["owner_id"], "role": "owner"}
+            for group_id, value in zip(ids, values)
+        ])
+        await db.commit()
+        result.ids.extend(ids)
+
+    if result.ids:
+        await get_response_cache().invalidate_async("groups")
+    result.created = len(result.ids)
+    result.errors.sort(key=lambda error: error.line)
+    return result
@@ -0,0 +1,75 @@
+""" Query plan check: EXPLAIN every read query of async_crud, the group service and jobs, fail on sequential scans
+
+Run with: python -m app.db.check_plans [--rows N] [--analyze]
+Point DATABASE_URL at a database with production-like data (or lower --rows). Exits with status 1
+if a query can only be answered by scanning a table of at least --rows rows
+"""
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import select, text
+
+from app import jobs
+from app.db import async_crud, database, models
+from app.db.testing import PlanChecker
+from app.groups import service
+
+# Name -> read query, called with a session and a sample user and group
+QUERIES = {
+    "get_user": lambda db, user, group: async_crud.get_user(db, user_id=user.id),
+    "get_user_by_username": lambda db, user, group: async_crud.get_user_by_username(db, username=user.username),
+    "get_user_by_email": lambda db, user, group: async_crud.get_user_by_email(db, email=user.email.upper()),
+    "get_users (offset)": lambda db, user, group: async_crud.get_users(db, skip=100),
+    "get_users (keyset)": lambda db, user, group: async_crud.get_users(db, after_id=user.id),
+    "get_groups id (offset)": lambda db, user, group: async_crud.get_groups(db, skip=100, sort="id"),
+    "get_groups id (keyset)": lambda db, user, group: async_crud.get_groups(db, sort="id", after=[group.id]),
+    "get_groups name (keyset)": lambda db, user, group: async_crud.get_groups(
+        db, sort="name", after=[group.name or "", group.id]),
+    "get_group": lambda db, user, group: service.get_group(db, group.id),
+    "get_role": lambda db, user, group: service.get_role(db, group.id, user.id),
+    "get_members": lambda db, user, group: service.get_members(db, group.id),
+    "get_user_groups": lambda db, user, group: service.get_user_groups(db, user.id),
+    "get_expenses": lambda db, user, group: service.get_expenses(db, group_id=group.id),
+    "get_ledger": lambda db, user, group: service.get_ledger(db, group_id=group.id),
+    "get_balances": lambda db, user, group: service.get_balances(db, group_id=group.id),
+    "get_events": lambda db, user, group: service.get_events(db, group_id=group.id),
+    "get_balances_as_of": lambda db, user, group: service.get_balances_as_of(
+        db, group_id=group.id, as_of=datetime.now(timezone.utc)),
+    "get_jobs": lambda db, user, group: jobs.get_jobs(db, user.id),
+}
+
+
+async def main(row_threshold: int, analyze: bool):
+    engine = database.async_engine
+    if analyze:
+        async with engine.begin() as connection:
+            await connection.execute(text("ANALYZE"))
+
+    failed = 0
+    async with database.AsyncSessionLocal() as db:
+        user = (await db.scalars(select(models.User).limit(1))).first()
+        group = (await db.scalars(select(models.Group).limit(1))).first()
+        if user is None or group is None:
+            print("Need at least one user and one group to build sample queries")
+            return 1
+        for name, query in QUERIES.items():
+            db.expunge_all()
+            with PlanChecker(engine, row_threshold) as checker:
+                await query(db, user, group)
+            scans = sorted({(relation, rows) for relation, rows, _ in checker.violations})
+            status = "FAIL" if scans else "ok"
+            print(f"{status:4}  {name}" + "".join(f"  seq scan on {relation} (~{rows} rows)" for relation, rows in scans))
+            failed += bool(scans)
+        await db.rollback()
+    print(f"{failed} of {len(QUERIES)} queries need a sequential scan")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000, help="only fail on tables with at least this many rows")
+    parser.add_argument("--analyze", action="store_true", help="run ANALYZE first so row estimates are current")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.rows, args.analyze)))
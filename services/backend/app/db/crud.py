@@ -1,43 +1,71 @@
 """ CRUD operations for interactions with database models """
 #  External imports
-from sqlalchemy.orm import Session
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import Session, joinedload, selectinload
 
 # Local imports
+from app.cache import get_response_cache
 from app.db import models, schemas
+from app.db.async_crud import GROUP_SORTS
+from app.groups.models import GroupMember
+from app.users.utils import get_token_cache
 from app.utils import get_password_hash, verify_password
 
 # Functionss here are dedicated only to database interaction, not part of path operation.
 # Can be reused this way and you can add unit tests to these too
 # Read user by ID and email
 def get_user(db: Session, user_id: int):
-    """ Get user by ID from database """
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    """ Get user by ID from database; groups come back in the same query """
+    return (db.query(models.User).options(joinedload(models.User.groups))
+            .filter(models.User.id == user_id).first())
+
+
+def get_user_by_username(db: Session, username: str):
+    """ Get user by username (the JWT subject) from database """
+    return db.query(models.User).filter(models.User.username == username).first()
 
 
 def get_user_by_email(db: Session, email: str):
-    """ Get user by email address from database """
-    return db.query(models.User).filter(models.User.email == email).first()
+    """ Get user by email address (case-insensitive) from database """
+    # Matches the unique index on lower(email)
+    return db.query(models.User).filter(func.lower(models.User.email) == email.lower()).first()
 
 
 # Get multiple users
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    """ Get list of all users """
-    return db.query(models.User).offset(skip).limit(limit).all()
+def get_users(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None):
+    """ Get list of all users ordered by ID; pass after_id (keyset) instead of skip for deep pages """
+    # One IN query loads the groups of the whole page instead of one query per user
+    query = db.query(models.User).options(selectinload(models.User.groups)).order_by(models.User.id)
+    if after_id is not None:
+        query = query.filter(models.User.id > after_id)
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
 
 
 def create_user(db: Session, user: schemas.UserCreate):
     """ After checking if account already exists, add user and password to db """
-    db_user = models.User(email=user.email)
+    db_user = models.User(email=user.email, username=user.username,
+                          given_name=user.given_name, family_name=user.family_name)
     db_user.hashed_password = get_password_hash(password=user.password)
     db.add(db_user)
     db.commit()
+    get_response_cache().invalidate("users")
     db.refresh(db_user)
     return db_user
 
 
-def get_groups(db: Session, skip: int = 0, limit: int = 100):
-    """ Get list of all groups """
-    return db.query(models.Group).offset(skip).limit(limit).all()
+def get_groups(db: Session, skip: int = 0, limit: int = 100, sort: str = "id", after: list | None = None):
+    """
+    Get list of all groups ordered by sort ("id" or "name", ties broken by ID);
+    pass the last row's key as after (keyset) instead of skip for deep pages
+    """
+    query = db.query(models.Group).order_by(*GROUP_SORTS[sort])
+    if after is not None:
+        query = query.filter(tuple_(*GROUP_SORTS[sort]) > tuple_(*after))
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
 
 
 def create_user_group(db: Session, group: schemas.GroupCreate, user_id: int):
@@ -45,7 +73,12 @@ def create_user_group(db: Session, group: schemas.GroupCreate, user_id: int):
     # **group.dict() extracts keys from group, puts them directly in the code here
     db_group = models.Group(**group.dict(), owner_id=user_id)
     db.add(db_group)
+    db.flush()
+    # The owner is the group's first member
+    db.add(GroupMember(group_id=db_group.id, user_id=user_id, role="owner"))
     db.commit()
+    # Groups are embedded in user responses too, which depend on the "groups" namespace as well
+    get_response_cache().invalidate("groups")
     db.refresh(db_group)
     return db_group
 
@@ -70,6 +103,21 @@ def reset_user_password(db: Session, email: str, password: str):
         return False
     user.hashed_password = get_password_hash(password=password)
     db.commit()
+    # Tokens issued before the reset must be verified (and the user re-read) again
+    get_token_cache().invalidate_user(user.id)
+    get_response_cache().invalidate("users")
+    db.refresh(user)
+    return user
+
+
+def deactivate_user(db: Session, user_id: int):
+    """ Mark a user inactive and drop their cached tokens """
+    user = get_user(db, user_id=user_id)
+    if not user:
+        return False
+    user.is_active = False
+    db.commit()
+    get_token_cache().invalidate_user(user.id)
+    get_response_cache().invalidate("users")
     db.refresh(user)
     return user
-    
@@ -1,11 +1,189 @@
-""" Database initialization """
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+"""
+Database initialization. The engines and session factories below are module attributes created on first
+access (module __getattr__), so importing the app neither loads the DB drivers nor reads the settings
+"""
+import asyncio
+import itertools
+import time
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from app import metrics
 from app.config import get_settings
 
-# Create the engine
-# If using SQLite, add arg: connect_args = {"check_same_thread": False}
-engine = create_engine(str(get_settings().database_url))
 
-# Create a SessionLocal class that can be used to instantiate a database session later on
-SessionLocal = sessionmaker(autocommit = False, autoflush = False, bind = engine)
+def get_async_url(database_url: str):
+    """ Swap the driver of a postgresql:// URL for asyncpg so it can be used by the async engine """
+    url = make_url(database_url)
+    if url.drivername in ("postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+asyncpg")
+    return url
+
+
+def create_pooled_async_engine(database_url: str):
+    """ Async engine with its own connection pool, sized from the settings """
+    settings = get_settings()
+    return create_async_engine(
+        get_async_url(database_url),
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_pre_ping=settings.db_pool_pre_ping,
+    )
+
+
+class ReplicaSet:
+    """
+    Round-robin over the read replicas. A replica is ejected for eject_seconds when a health check
+    or a connection to it fails, and is re-admitted by the next passing health check; when none are
+    healthy reads fall back to the primary
+    """
+
+    def __init__(self, engines: list, eject_seconds: float):
+        self.engines = engines
+        self.eject_seconds = eject_seconds
+        self._ejected_until = {}
+        self._cycle = itertools.cycle(range(len(engines)))
+        for replica in engines:
+            event.listen(replica.sync_engine, "handle_error", self._handle_error)
+
+    def choose(self):
+        """ Next healthy replica's sync engine, or None """
+        now = time.monotonic()
+        for _ in range(len(self.engines)):
+            replica = self.engines[next(self._cycle)]
+            if self._ejected_until.get(replica.sync_engine, 0) <= now:
+                return replica.sync_engine
+        return None
+
+    def eject(self, sync_engine):
+        self._ejected_until[sync_engine] = time.monotonic() + self.eject_seconds
+
+    def healthy(self):
+        now = time.monotonic()
+        return [replica for replica in self.engines if self._ejected_until.get(replica.sync_engine, 0) <= now]
+
+    def _handle_error(self, context):
+        # Connection dropped mid-query (not e.g. a bad query): take the replica out of rotation
+        if context.is_disconnect:
+            self.eject(context.engine)
+
+    async def check(self, timeout: float):
+        """ Run SELECT 1 on every replica; eject the ones that fail, re-admit the ones that pass """
+        for replica in self.engines:
+            try:
+                async with asyncio.timeout(timeout):
+                    async with replica.connect() as connection:
+                        await connection.execute(text("SELECT 1"))
+            except Exception:
+                self.eject(replica.sync_engine)
+            else:
+                self._ejected_until.pop(replica.sync_engine, None)
+
+    async def run_health_checks(self, interval: float):
+        """ Background task: check the replicas every interval seconds until cancelled """
+        while True:
+            await self.check(timeout=interval)
+            await asyncio.sleep(interval)
+
+
+class RoutingSession(Session):
+    """
+    Session that sends plain SELECTs to a replica when info["use_replica"] is set. Writes, locking reads
+    and everything after the session's first write go to the primary, so a request reads its own writes.
+    A session sticks to the replica it picked first so its reads see one consistent copy
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.info.get("use_replica") and not self.info.get("wrote"):
+            is_plain_select = getattr(clause, "is_select", False) and clause._for_update_arg is None
+            if self._flushing or not is_plain_select:
+                self.info["wrote"] = True
+            else:
+                if "replica" not in self.info:
+                    self.info["replica"] = _get("replicas").choose()
+                if self.info["replica"] is not None:
+                    return self.info["replica"]
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+
+def _create_engine():
+    # If using SQLite, add arg: connect_args = {"check_same_thread": False}
+    created = create_engine(str(get_settings().database_url))
+    metrics.instrument_engine(created, "sync")
+    return created
+
+
+def _create_session_factory():
+    # SessionLocal instantiates a sync database session
+    return sessionmaker(autocommit = False, autoflush = False, bind = _get("engine"))
+
+
+def _create_async_engine():
+    # Async engine with its own connection pool; used by the coroutine routes
+    created = create_pooled_async_engine(str(get_settings().database_url))
+    metrics.instrument_engine(created, "async")
+    return created
+
+
+def _create_replicas():
+    settings = get_settings()
+    engines = [create_pooled_async_engine(str(url)) for url in settings.database_replica_urls]
+    for index, replica in enumerate(engines):
+        metrics.instrument_engine(replica, f"replica-{index}")
+    return ReplicaSet(engines, eject_seconds=settings.replica_eject_seconds)
+
+
+def _create_async_session_factory():
+    # expire_on_commit=False so returned objects can still be serialized after the commit
+    # without triggering a lazy load (which isn't allowed outside of an await)
+    return async_sessionmaker(
+        bind=_get("async_engine"), sync_session_class=RoutingSession, autoflush=False, expire_on_commit=False)
+
+
+_LAZY_ATTRIBUTES = {
+    "engine": _create_engine,
+    "SessionLocal": _create_session_factory,
+    "async_engine": _create_async_engine,
+    "replicas": _create_replicas,
+    "AsyncSessionLocal": _create_async_session_factory,
+}
+
+
+def __getattr__(name: str):
+    """ Create engine, SessionLocal, async_engine, replicas or AsyncSessionLocal on first access """
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = globals()[name] = _LAZY_ATTRIBUTES[name]()
+    return value
+
+
+def _get(name: str):
+    # Attributes assigned from outside (e.g. the benchmarks swapping in SQLite) take precedence
+    return globals()[name] if name in globals() else __getattr__(name)
+
+
+def _created_engines():
+    engines = [globals()[name] for name in ("engine", "async_engine") if name in globals()]
+    if "replicas" in globals():
+        engines += globals()["replicas"].engines
+    return engines
+
+
+def dispose_engines():
+    """
+    Forget the pooled connections inherited from a parent process; call in a child right after a fork
+    (e.g. gunicorn workers of a preloaded app) so every process opens its own. close=False leaves the
+    sockets alone for the parent, which still owns them. Engines not created yet are skipped
+    """
+    for created in _created_engines():
+        getattr(created, "sync_engine", created).dispose(close=False)
+
+
+async def dispose_async_engines():
+    """ Close the async pools' connections; called on application shutdown """
+    for created in _created_engines():
+        if isinstance(created, AsyncEngine):
+            await created.dispose()
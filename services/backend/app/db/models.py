@@ -1,18 +1,25 @@
 """ SQLAlchemy models for the database """
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import JSON, BigInteger, Boolean, Column, DateTime, ForeignKey, Index, Integer, LargeBinary, String, Text, func
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
 # Create a Base class that can be used to create models later on
 Base = declarative_base()
 
+# JSON columns: JSONB on Postgres, plain JSON elsewhere so the SQLite benchmarks can still create the tables
+JSONDocument = JSON().with_variant(JSONB(), "postgresql")
+
 class User(Base):
     """ User table: per-user information """
     __tablename__ = "users"
 
-    id = Column(Integer, primary_key = True, index = True)
-    email = Column(String, unique=True, index=True)
-    username = Column(String)
+    # Primary keys are indexed already; no separate index on id
+    id = Column(Integer, primary_key = True)
+    # Unique regardless of case, see ix_users_email_lower
+    email = Column(String)
+    # JWT subject, looked up by get_current_user
+    username = Column(String, unique=True, index=True)
     given_name = Column(String)
     family_name = Column(String)
     hashed_password = Column(String)
@@ -21,14 +28,87 @@ class User(Base):
     # Create the relationships
     groups = relationship("Group", back_populates="owner")
 
+    __table_args__ = (
+        # Serves get_user_by_email's lower(email) = ... lookups
+        Index("ix_users_email_lower", func.lower(email), unique=True),
+    )
+
 
 class Group(Base):
     """ Group table: groups linked to user accounts """
     __tablename__ = "groups"
 
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, index=True)
-    description = Column(String, index=True)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    description = Column(String)
+    # ISO 4217 code balances and settlements are kept in; expenses may be in other currencies
+    currency = Column(String(3), nullable=False, default="USD", server_default="USD")
+    # Loading a user's groups filters on owner_id
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
 
     owner = relationship("User", back_populates="groups")
+
+    __table_args__ = (
+        # Keyset pagination of /groups/?sort=name orders and seeks on (name, id)
+        Index("ix_groups_name_id", name, id),
+    )
+
+
+class IdempotencyKey(Base):
+    """
+    Idempotency key table: the response stored for the first request a caller sent with an Idempotency-Key,
+    replayed to retries of it until expires_at. status_code is null while the first request runs, and
+    expires_at is then the end of its lease
+    """
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String, primary_key=True)
+    # Method and path the key was used on, e.g. "POST /users/"
+    endpoint = Column(String, primary_key=True)
+    # Who sent it, e.g. "user:42"; a key only replays to its own caller
+    caller = Column(String, primary_key=True)
+    # Hash of the request body; a retry with a different body is an error, not a replay
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer)
+    response_body = Column(LargeBinary)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Expired keys are purged in the background and can be reused
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+
+class Job(Base):
+    """
+    Background job table: the durable queue of app.jobs. Workers claim queued jobs whose run_at has come
+    with SELECT ... FOR UPDATE SKIP LOCKED and hold them under a lease (locked_by until locked_until)
+    """
+    __tablename__ = "jobs"
+
+    id = Column(BigInteger, primary_key=True)
+    # Name of the registered handler, e.g. "import_users"
+    kind = Column(String, nullable=False)
+    payload = Column(JSONDocument, nullable=False)
+    # queued, running, succeeded or failed
+    status = Column(String, nullable=False, default="queued", server_default="queued")
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    max_attempts = Column(Integer, nullable=False)
+    # Earliest time the job may (re)run: now when enqueued, later after a failed attempt
+    run_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    locked_by = Column(String)
+    locked_until = Column(DateTime(timezone=True))
+    result = Column(JSONDocument)
+    last_error = Column(Text)
+    created_by = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"))
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        # The claim query: oldest due queued job
+        Index("ix_jobs_queued_run_at", run_at, id, postgresql_where=(status == "queued")),
+        # Running jobs whose lease lapsed (their worker died) are requeued by the next worker to look
+        Index("ix_jobs_running_locked_until", locked_until, postgresql_where=(status == "running")),
+        # GET /jobs lists a user's jobs newest first
+        Index("ix_jobs_created_by_id", created_by, id),
+        # Finished jobs are purged after job_retention_seconds
+        Index("ix_jobs_finished_at", finished_at, postgresql_where=finished_at.isnot(None)),
+    )
@@ -0,0 +1,35 @@
+""" Opaque cursors for keyset pagination """
+import base64
+import json
+
+from fastapi import HTTPException, Response
+
+# Header carrying the cursor of the next page; the list response body is unchanged
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(sort: str, key: list):
+    """ Pack the sort column and the last row's key values into an opaque, url safe string """
+    raw = json.dumps({"s": sort, "k": key}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, types: tuple):
+    """ Unpack a cursor made by encode_cursor; 400 if it is malformed, for a different sort or of the wrong types """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        key = data["k"]
+        if data["s"] != sort or len(key) != len(types):
+            raise ValueError(cursor)
+        if not all(isinstance(value, type_) for value, type_ in zip(key, types)):
+            raise ValueError(cursor)
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+
+def set_next_cursor(response: Response, rows: list, limit: int, sort: str, key):
+    """ If the page was full, add the cursor for the row after the last one to the response headers """
+    if rows and len(rows) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(sort, key(rows[-1]))
@@ -1,10 +1,15 @@
 """ Schemas to receive data from database """
-from pydantic import BaseModel
+from datetime import datetime
+from typing import Any, Literal
+
+from pydantic import BaseModel, Field
 
 class GroupBase(BaseModel):
     """ Base group model """
     name: str
     description: str | None = None
+    # ISO 4217 code balances are kept in
+    currency: str = Field(default="USD", pattern=r"^[A-Z]{3}$")
 
 
 class GroupCreate(GroupBase):
@@ -38,6 +43,13 @@ class UserCreate(UserBase):
     confirm_password: str
 
 
+class UserImport(UserBase):
+    """ One row of a bulk user import whose password was hashed before it was queued """
+    given_name: str
+    family_name: str
+    hashed_password: str
+
+
 class UserLogin(BaseModel):
     """ Receive login info to authenticate user"""
     email: str
@@ -63,3 +75,39 @@ class UserModel(UserBase):
         """ Configure to read as properties from database """
         from_attributes = True
 
+
+
+class GroupImport(GroupCreate):
+    """ One row of a bulk group import; the owner is referenced by email """
+    owner_email: str
+
+
+class ImportRowError(BaseModel):
+    """ Why a row of a bulk import was rejected (line is 1-based, CSV header excluded) """
+    line: int
+    error: str
+
+
+class ImportResult(BaseModel):
+    """ Outcome of a bulk import: IDs of the created rows plus per-row errors """
+    created: int
+    ids: list[int] = []
+    errors: list[ImportRowError] = []
+
+
+class JobModel(BaseModel):
+    """ A background job: result is the handler's return value once it succeeded """
+    id: int
+    kind: str
+    status: Literal["queued", "running", "succeeded", "failed"]
+    attempts: int
+    max_attempts: int
+    run_at: datetime
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    result: Any = None
+    last_error: str | None = None
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,57 @@
+""" Query count and plan helpers, against the app's own routes and queries
+
+Run with: TEST_DATABASE_URL=postgresql://... python -m pytest app/db
+"""
+import pytest
+from sqlalchemy import select
+
+from app.conftest import create_user
+from app.db import async_crud, database, models
+from app.db.testing import PlanChecker, assert_no_seq_scans, assert_query_count
+
+
+def test_user_route_loads_its_groups_in_one_statement(client):
+    alice, _ = create_user(client, "alice")
+    for name in ("Flat", "Trip", "Office"):
+        client.post(f"/users/{alice['id']}/groups/", json={"name": name})
+    with assert_query_count(database.async_engine, 1):
+        response = client.get(f"/users/{alice['id']}")
+    assert len(response.json()["groups"]) == 3
+    # Answered from the response cache
+    with assert_query_count(database.async_engine, 0):
+        client.get(f"/users/{alice['id']}")
+
+
+def test_query_count_mismatch_lists_the_statements(client):
+    with pytest.raises(AssertionError, match=r"Expected 0 statements, got 1:\nSELECT groups\.id"):
+        with assert_query_count(database.async_engine, 0):
+            client.get("/groups/")
+
+
+def test_user_lookups_use_indexes(client):
+    alice, _ = create_user(client, "alice")
+    # Empty tables: any sequential scan is reported
+    with assert_no_seq_scans(database.async_engine, row_threshold=0) as checker:
+        client.get(f"/users/{alice['id']}")
+
+        async def by_email():
+            async with database.AsyncSessionLocal() as db:
+                return await async_crud.get_user_by_email(db, email="ALICE@example.com")
+
+        assert client.portal.call(by_email).id == alice["id"]
+    assert len(checker.plans) == 2
+
+
+def test_plan_checker_reports_unindexed_filters(client):
+    create_user(client, "alice")
+
+    async def by_given_name():
+        async with database.AsyncSessionLocal() as db:
+            return (await db.scalars(select(models.User).filter(models.User.given_name == "Alice"))).all()
+
+    with PlanChecker(database.async_engine, row_threshold=0) as checker:
+        client.portal.call(by_given_name)
+    assert [(relation, rows) for relation, rows, _ in checker.violations] == [("users", 0)]
+    with pytest.raises(AssertionError, match=r"Sequential scans:\nusers \(~0 rows\)"):
+        with assert_no_seq_scans(database.async_engine, row_threshold=0):
+            client.portal.call(by_given_name)
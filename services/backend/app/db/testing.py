@@ -0,0 +1,120 @@
+""" Helpers for tests that pin the number of SQL statements a query or route issues, and their plans """
+import json
+from contextlib import contextmanager, suppress
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """ Records every statement executed on an engine (sync or async) while the context is open """
+
+    def __init__(self, engine):
+        # Cursor events are only emitted by the sync engine wrapped inside an AsyncEngine
+        self.engine = getattr(engine, "sync_engine", engine)
+        self.statements: list[str] = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+
+
+@contextmanager
+def assert_query_count(engine, expected: int):
+    """
+    Fail if the block runs a different number of statements than expected, e.g.
+        with assert_query_count(async_engine, 2):
+            client.get("/users/")
+    """
+    with QueryCounter(engine) as counter:
+        yield counter
+    if counter.count != expected:
+        statements = "\n".join(counter.statements)
+        raise AssertionError(f"Expected {expected} statements, got {counter.count}:\n{statements}")
+
+
+class PlanChecker:
+    """
+    EXPLAINs every SELECT run on a Postgres engine (sync or async) while the context is open, just before
+    it executes, with sequential scans disabled: a Seq Scan left in such a plan means no index can serve
+    the query (full index walks that filter every row count too). Those on tables estimated at
+    row_threshold rows or more (pg_class.reltuples, so ANALYZE first) are collected in violations
+    as (relation, estimated rows, statement)
+    """
+
+    def __init__(self, engine, row_threshold: int = 1000):
+        self.engine = getattr(engine, "sync_engine", engine)
+        self.row_threshold = row_threshold
+        self.plans: list[tuple[str, dict]] = []
+        self.violations: list[tuple[str, int, str]] = []
+        self._table_rows: dict[str, int] = {}
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if executemany or not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            return
+        # A cursor of its own so the one about to run the statement is left untouched
+        explain = conn.connection.cursor()
+        try:
+            explain.execute("SET enable_seqscan = off")
+            explain.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            plan = explain.fetchone()[0]
+            # psycopg2 decodes json columns, asyncpg returns the text
+            plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+            self.plans.append((statement, plan))
+            for relation in _seq_scanned_relations(plan):
+                if relation not in self._table_rows:
+                    # Inlined: the drivers disagree on the parameter style (%s vs $1)
+                    quoted = relation.replace("'", "''")
+                    explain.execute(f"SELECT reltuples FROM pg_class WHERE relname = '{quoted}'")
+                    row = explain.fetchone()
+                    self._table_rows[relation] = max(int(row[0]), 0) if row else 0
+                if self._table_rows[relation] >= self.row_threshold:
+                    self.violations.append((relation, self._table_rows[relation], statement))
+        finally:
+            # Also after a failed EXPLAIN, so the statement itself and the rest of the session plan normally;
+            # if the failure aborted the transaction, the rollback undoes the SET and this can't run anyway
+            with suppress(Exception):
+                explain.execute("RESET enable_seqscan")
+            explain.close()
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+
+
+def _seq_scanned_relations(plan: dict):
+    if plan["Node Type"] == "Seq Scan":
+        yield plan["Relation Name"]
+    # With seq scans disabled the planner walks a whole index instead; filtering every row of it
+    # (no Index Cond) is the same scan in disguise. Plain ordered walks, e.g. ORDER BY id LIMIT, are fine
+    elif plan["Node Type"] in ("Index Scan", "Index Only Scan") and "Index Cond" not in plan and "Filter" in plan:
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", ()):
+        yield from _seq_scanned_relations(child)
+
+
+@contextmanager
+def assert_no_seq_scans(engine, row_threshold: int = 1000):
+    """
+    Fail if a SELECT run in the block can only be answered by sequentially scanning a table of
+    row_threshold rows or more, e.g.
+        with assert_no_seq_scans(async_engine, row_threshold=0):
+            client.get("/users/1")
+    """
+    with PlanChecker(engine, row_threshold) as checker:
+        yield checker
+    if checker.violations:
+        scans = "\n".join(f"{relation} (~{rows} rows): {statement}" for relation, rows, statement in checker.violations)
+        raise AssertionError(f"Sequential scans:\n{scans}")
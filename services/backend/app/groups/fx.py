@@ -0,0 +1,185 @@
+""" Currency conversion for group balances: FX rate table, per-day rate cache and vectorised conversion
+
+Load rates from a CSV file (currency,as_of,rate) with: python -m app.groups.fx rates.csv
+"""
+import argparse
+import asyncio
+import csv
+import sys
+import time
+from collections import OrderedDict
+from datetime import date
+from decimal import ROUND_HALF_EVEN, Decimal
+from functools import lru_cache
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import get_settings
+from app.db import database
+from app.groups.models import FxRate
+from app.groups.schemas import FxRateModel
+
+# Conversion factors are integers scaled by FX_SCALE, so amounts convert with exact integer arithmetic
+FX_SCALE = 10 ** 12
+INT64_MAX = np.iinfo(np.int64).max
+
+# ISO 4217 minor units that aren't 2 (cents)
+MINOR_UNITS = {
+    "BHD": 3, "BIF": 0, "CLP": 0, "DJF": 0, "GNF": 0, "IQD": 3, "ISK": 0, "JOD": 3, "JPY": 0, "KMF": 0,
+    "KRW": 0, "KWD": 3, "LYD": 3, "OMR": 3, "PYG": 0, "RWF": 0, "TND": 3, "UGX": 0, "UYI": 0, "VND": 0,
+    "VUV": 0, "XAF": 0, "XOF": 0, "XPF": 0,
+}
+
+
+class MissingRateError(ValueError):
+    """ No FX rate is known for a currency on a day """
+
+
+def minor_unit(currency: str):
+    return MINOR_UNITS.get(currency, 2)
+
+
+def conversion_factor(rate_from: Decimal, rate_to: Decimal, currency_from: str, currency_to: str):
+    """ Multiplier (scaled by FX_SCALE) from minor units of currency_from to minor units of currency_to """
+    factor = rate_from / rate_to * Decimal(10) ** (minor_unit(currency_to) - minor_unit(currency_from))
+    return int((factor * FX_SCALE).to_integral_value(ROUND_HALF_EVEN))
+
+
+def convert_lines(labels: np.ndarray, amounts: np.ndarray, factors: np.ndarray):
+    """
+    Convert amounts (minor units) with a scaled factor per line, in one vectorised pass. Lines sharing a
+    label (the payers, or the shares, of one expense) are converted together: their total is rounded once,
+    then split with the largest remainder method, so a converted expense still balances to zero
+    """
+    unique_labels, index = np.unique(labels, return_inverse=True)
+    # int64 unless a label's total x factor could overflow; then Python ints, still vectorised but slower
+    dtype = np.int64
+    if len(amounts):
+        label_amounts = np.zeros(len(unique_labels), dtype=np.int64)
+        np.add.at(label_amounts, index, np.abs(amounts))
+        if int(label_amounts.max()) * int(np.abs(factors).max()) > INT64_MAX // 2:
+            dtype = object
+    exact = amounts.astype(dtype) * factors.astype(dtype)
+    floors = exact // FX_SCALE
+    remainders = exact - floors * FX_SCALE
+
+    totals = np.zeros(len(unique_labels), dtype=dtype)
+    floor_sums = np.zeros(len(unique_labels), dtype=dtype)
+    np.add.at(totals, index, exact)
+    np.add.at(floor_sums, index, floors)
+    leftover = (totals + FX_SCALE // 2) // FX_SCALE - floor_sums
+
+    # Within each label, lines with the largest remainders get the leftover units; ties go to earlier lines
+    order = np.lexsort((np.arange(len(amounts)), -remainders, index))
+    sorted_index = index[order]
+    ranks = np.arange(len(amounts)) - np.searchsorted(sorted_index, sorted_index)
+    bump = np.zeros(len(amounts), dtype=np.int64)
+    bump[order] = ranks < leftover[sorted_index].astype(np.int64)
+    return (floors + bump).astype(np.int64)
+
+
+class RateCache:
+    """
+    Rates by (currency, day), the day being the time bucket a rate applies to. Lookups for all the
+    currencies of a day are batched into one query; entries (misses included) live ttl seconds, so rates
+    loaded by another worker or the CLI show up within ttl, and at once in the worker that loaded them
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[str, date], tuple[float, Decimal | None]] = OrderedDict()
+
+    async def get_rates(self, db: AsyncSession, keys: set[tuple[str, date]]):
+        """ Rate of every (currency, day) in keys, None where no rate is known """
+        now = time.monotonic()
+        rates, missing = {}, {}
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                rates[key] = entry[1]
+                self._entries.move_to_end(key)
+            else:
+                missing.setdefault(key[1], set()).add(key[0])
+        for day, currencies in missing.items():
+            found = dict((await db.execute(
+                select(FxRate.currency, FxRate.rate)
+                .filter(FxRate.currency.in_(currencies), FxRate.as_of <= day)
+                .order_by(FxRate.currency, FxRate.as_of.desc())
+                .distinct(FxRate.currency)
+            )).all())
+            for currency in currencies:
+                rates[(currency, day)] = found.get(currency)
+                self._entries[(currency, day)] = (now + self.ttl, found.get(currency))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return rates
+
+    def clear(self):
+        self._entries.clear()
+
+
+async def conversion_factors(db: AsyncSession, currency_to: str, keys: set[tuple[str, date]]):
+    """
+    Scaled conversion factor into currency_to for every (currency, day) in keys, from one batched rate
+    lookup. Raises MissingRateError if a rate is missing
+    """
+    pivot = get_settings().fx_pivot_currency
+    needed = set(keys) | {(currency_to, day) for _, day in keys}
+    rates = await get_rate_cache().get_rates(db, {key for key in needed if key[0] != pivot})
+    rates.update({key: Decimal(1) for key in needed if key[0] == pivot})
+    factors = {}
+    for currency, day in keys:
+        for missing in (currency, currency_to):
+            if rates[(missing, day)] is None:
+                raise MissingRateError(f"No exchange rate for {missing} on {day.isoformat()}")
+        factors[(currency, day)] = conversion_factor(
+            rates[(currency, day)], rates[(currency_to, day)], currency, currency_to)
+    return factors
+
+
+async def save_rates(db: AsyncSession, rates: list[dict]):
+    """ Insert or replace rates (dicts with currency, as_of and rate) in one multi-row upsert """
+    if rates:
+        statement = insert(FxRate).values(rates)
+        statement = statement.on_conflict_do_update(
+            index_elements=[FxRate.currency, FxRate.as_of], set_={"rate": statement.excluded.rate})
+        await db.execute(statement)
+        await db.commit()
+    get_rate_cache().clear()
+    return len(rates)
+
+
+async def get_latest_rates(db: AsyncSession, day: date):
+    """ Latest rate of every currency on or before day """
+    result = await db.scalars(
+        select(FxRate).filter(FxRate.as_of <= day)
+        .order_by(FxRate.currency, FxRate.as_of.desc())
+        .distinct(FxRate.currency)
+    )
+    return result.all()
+
+
+@lru_cache
+def get_rate_cache():
+    """ The process's rate cache, created from the settings on first use """
+    settings = get_settings()
+    return RateCache(ttl=settings.fx_cache_ttl, max_entries=settings.fx_cache_max_entries)
+
+
+async def main(path: str):
+    with open(path, newline="") as file:
+        rates = [FxRateModel.model_validate(row).model_dump() for row in csv.DictReader(file)]
+    async with database.AsyncSessionLocal() as db:
+        print(f"{await save_rates(db, rates)} rate(s) loaded")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="CSV file with a currency,as_of,rate header")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.path)))
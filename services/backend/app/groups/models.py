@@ -0,0 +1,134 @@
+""" SQLAlchemy models for group members, expenses, the ledger event log and FX rates """
+from sqlalchemy import BigInteger, Column, Date, DateTime, ForeignKey, Index, Integer, Numeric, String, func
+from sqlalchemy.orm import relationship
+
+from app.db.models import Base, JSONDocument
+
+
+class Expense(Base):
+    """ Expense table: an amount spent for a group, paid by one or more users and split between participants """
+    __tablename__ = "expenses"
+
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, ForeignKey("groups.id", ondelete="CASCADE"), nullable=False, index=True)
+    description = Column(String)
+    # All money is stored in integer minor units (cents) of the expense's currency
+    amount_cents = Column(BigInteger, nullable=False)
+    # ISO 4217 code; null means the group's currency. Balances convert at the rate of the day it was created
+    currency = Column(String(3))
+    # equal, exact, percentage or weighted
+    split_type = Column(String, nullable=False)
+    created_by_id = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    group = relationship("Group")
+    payers = relationship("ExpensePayer", back_populates="expense", cascade="all, delete-orphan")
+    shares = relationship("ExpenseShare", back_populates="expense", cascade="all, delete-orphan")
+
+
+class ExpensePayer(Base):
+    """ Expense payer table: how much each user paid towards an expense """
+    __tablename__ = "expense_payers"
+
+    expense_id = Column(Integer, ForeignKey("expenses.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    amount_cents = Column(BigInteger, nullable=False)
+
+    expense = relationship("Expense", back_populates="payers")
+
+
+class ExpenseShare(Base):
+    """ Expense share table: each participant's part of an expense """
+    __tablename__ = "expense_shares"
+
+    expense_id = Column(Integer, ForeignKey("expenses.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    # What the split was given as: cents (exact), percent (percentage) or weight (weighted); null for equal
+    value = Column(Numeric(20, 6))
+    # Resolved amount this participant owes, in cents
+    amount_cents = Column(BigInteger, nullable=False)
+
+    expense = relationship("Expense", back_populates="shares")
+
+
+class GroupBalance(Base):
+    """
+    Group balance table: running net balance of each user in a group (paid minus owed, in cents).
+    Kept up to date with deltas in the same transaction as every expense write
+    """
+    __tablename__ = "group_balances"
+
+    group_id = Column(Integer, ForeignKey("groups.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    balance_cents = Column(BigInteger, nullable=False, default=0)
+
+
+class GroupMember(Base):
+    """ Group member table: which users belong to a group, and their role in it (owner, admin or member) """
+    __tablename__ = "group_members"
+
+    # The primary key serves the (group_id, user_id) membership checks of every expense write
+    group_id = Column(Integer, ForeignKey("groups.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    role = Column(String, nullable=False, default="member")
+    joined_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # "My groups" seeks on user_id; role is included so the join reads no member rows
+        Index("ix_group_members_user_id_group_id", user_id, group_id, postgresql_include=["role"]),
+    )
+
+
+class FxRate(Base):
+    """
+    FX rate table: value of one unit of a currency in the pivot currency (FX_PIVOT_CURRENCY) from a day on.
+    An expense converts at the latest rate on or before the day it was created
+    """
+    __tablename__ = "fx_rates"
+
+    currency = Column(String(3), primary_key=True)
+    as_of = Column(Date, primary_key=True)
+    rate = Column(Numeric(20, 10), nullable=False)
+
+
+class LedgerEvent(Base):
+    """
+    Ledger event table: append-only history of every change to a group's balances (expense created,
+    updated or deleted, settlement recorded, balances corrected), with the balance delta of each user.
+    A trigger rejects updates and deletes. Events of a group are written under a lock on the group row,
+    so their ids and created_at follow commit order
+    """
+    __tablename__ = "ledger_events"
+
+    id = Column(BigInteger, primary_key=True)
+    group_id = Column(Integer, ForeignKey("groups.id"), nullable=False)
+    kind = Column(String, nullable=False)
+    # No foreign key: the history of a deleted expense stays
+    expense_id = Column(Integer)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    # {user_id: cents} moved in the group's currency
+    deltas = Column(JSONDocument, nullable=False)
+    # What changed, for audits (amount, currency, payers and shares of an expense, ...)
+    data = Column(JSONDocument)
+    # Time of the insert rather than of the transaction start, so it increases with id
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.clock_timestamp())
+
+    __table_args__ = (
+        # Replays and exports read a group's events in id order from a starting id
+        Index("ix_ledger_events_group_id_id", group_id, id),
+    )
+
+
+class BalanceSnapshot(Base):
+    """
+    Balance snapshot table: every user's balance in a group right after an event, taken every
+    LEDGER_SNAPSHOT_INTERVAL events. Balances at any time are the latest snapshot before it plus the tail
+    """
+    __tablename__ = "balance_snapshots"
+
+    group_id = Column(Integer, ForeignKey("groups.id"), primary_key=True)
+    event_id = Column(BigInteger, ForeignKey("ledger_events.id"), primary_key=True)
+    # {user_id: cents}
+    balances = Column(JSONDocument, nullable=False)
+    # created_at of the event
+    created_at = Column(DateTime(timezone=True), nullable=False)
@@ -0,0 +1,175 @@
+""" Schemas for group members, expenses, FX rates, balances and settlements """
+from datetime import date, datetime
+from decimal import Decimal
+from enum import Enum
+from typing import Literal
+
+from pydantic import BaseModel, Field
+
+from app.db.schemas import GroupModel
+
+
+class SplitType(str, Enum):
+    """ How an expense is divided between its participants """
+    equal = "equal"
+    exact = "exact"
+    percentage = "percentage"
+    weighted = "weighted"
+
+
+class MemberRole(str, Enum):
+    """ What a group member may do: owners and admins manage members, everyone adds expenses """
+    owner = "owner"
+    admin = "admin"
+    member = "member"
+
+
+class MembersAdd(BaseModel):
+    """ Users to add to a group, all with the same role """
+    user_ids: list[int] = Field(min_length=1, max_length=1000)
+    role: MemberRole = MemberRole.member
+
+
+class MembersChanged(BaseModel):
+    """ Users actually added to or removed from a group (unknown users and no-ops are left out) """
+    user_ids: list[int]
+
+
+class MemberModel(BaseModel):
+    """ Read a group member from database """
+    user_id: int
+    role: MemberRole
+    joined_at: datetime | None = None
+
+    class Config:
+        """ Configure to read as properties from database """
+        from_attributes = True
+
+
+class MyGroupModel(GroupModel):
+    """ A group the current user belongs to, with their role in it """
+    role: MemberRole
+
+
+class PayerBase(BaseModel):
+    """ A user who paid (part of) an expense """
+    user_id: int
+    amount_cents: int = Field(gt=0)
+
+
+class ShareBase(BaseModel):
+    """
+    A participant of an expense. value is the cents owed (exact), a percent (percentage)
+    or a weight (weighted); leave it out for equal splits
+    """
+    user_id: int
+    value: Decimal | None = Field(default=None, allow_inf_nan=False)
+
+
+class ExpenseCreate(BaseModel):
+    """ Write an expense to the database; amounts are in minor units of currency (default: the group's) """
+    description: str | None = None
+    amount_cents: int = Field(gt=0)
+    currency: str | None = Field(default=None, pattern=r"^[A-Z]{3}$")
+    split_type: SplitType = SplitType.equal
+    payers: list[PayerBase] = Field(min_length=1)
+    shares: list[ShareBase] = Field(min_length=1)
+
+
+class PayerModel(PayerBase):
+    """ Read an expense payer from database """
+
+    class Config:
+        """ Configure to read as properties from database """
+        from_attributes = True
+
+
+class ShareModel(ShareBase):
+    """ Read an expense share from database, with the amount it resolved to """
+    amount_cents: int
+
+    class Config:
+        """ Configure to read as properties from database """
+        from_attributes = True
+
+
+class ExpenseModel(BaseModel):
+    """ Read an expense from database """
+    id: int
+    group_id: int
+    description: str | None = None
+    amount_cents: int
+    currency: str | None = None
+    split_type: SplitType
+    created_by_id: int | None = None
+    created_at: datetime | None = None
+    payers: list[PayerModel] = []
+    shares: list[ShareModel] = []
+
+    class Config:
+        """ Configure to read as properties from database """
+        from_attributes = True
+
+
+class BalanceModel(BaseModel):
+    """ Net balance of a user in a group: positive is owed to them, negative is what they owe """
+    user_id: int
+    balance_cents: int
+
+
+class TransferModel(BaseModel):
+    """ One payment needed to settle a group """
+    from_user_id: int
+    to_user_id: int
+    amount_cents: int
+
+
+class SettlementModel(BaseModel):
+    """ Balances of a group and the transfers that settle them, in minor units of the group's currency """
+    currency: str
+    balances: list[BalanceModel]
+    transfers: list[TransferModel]
+    # Planner engine that produced the transfers: exact (fewest possible) or greedy
+    engine: Literal["exact", "greedy"] = "greedy"
+
+
+class SettlementRecord(BaseModel):
+    """ A payment made outside the app from one member to another, in minor units of the group's currency """
+    from_user_id: int
+    to_user_id: int
+    amount_cents: int = Field(gt=0)
+
+
+class LedgerEventModel(BaseModel):
+    """ Read a ledger event from database; deltas maps user IDs to the cents their balance moved """
+    id: int
+    group_id: int
+    kind: str
+    expense_id: int | None = None
+    user_id: int | None = None
+    deltas: dict[int, int]
+    data: dict | None = None
+    created_at: datetime
+
+    class Config:
+        """ Configure to read as properties from database """
+        from_attributes = True
+
+
+class FxRateModel(BaseModel):
+    """ Value of one unit of currency in the pivot currency, from as_of on """
+    currency: str = Field(pattern=r"^[A-Z]{3}$")
+    as_of: date
+    rate: Decimal = Field(gt=0, max_digits=20, decimal_places=10)
+
+    class Config:
+        """ Configure to read as properties from database """
+        from_attributes = True
+
+
+class BalanceDriftModel(BaseModel):
+    """ A stored group balance that doesn't match the balance rebuilt from the ledger """
+    group_id: int
+    user_id: int
+    stored_cents: int
+    expected_cents: int
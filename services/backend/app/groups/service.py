@@ -0,0 +1,704 @@
+""" Group membership, expense splitting and settlement for groups """
+import heapq
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from functools import lru_cache
+
+import numpy as np
+from sqlalchemy import delete, exists, func, literal, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from app import metrics
+from app.config import get_settings
+from app.db import models
+from app.groups import fx, schemas, stream
+from app.groups.models import (
+    BalanceSnapshot, Expense, ExpensePayer, ExpenseShare, GroupBalance, GroupMember, LedgerEvent,
+)
+
+
+class SplitError(ValueError):
+    """ The payers or shares of an expense don't add up """
+
+
+def allocate(amount_cents: int, weights: list[Decimal]):
+    """
+    Divide amount_cents proportionally to weights in whole cents (largest remainder method):
+    everyone gets the floor of their exact share, leftover cents go to the largest fractions first
+    """
+    total = sum(weights)
+    if total <= 0 or any(weight < 0 for weight in weights):
+        raise SplitError("Weights must be non-negative and not all zero")
+    exact = [Decimal(amount_cents) * weight / total for weight in weights]
+    amounts = [int(share) for share in exact]
+    leftover = amount_cents - sum(amounts)
+    # Ties go to the earlier participant so the result is deterministic
+    order = sorted(range(len(exact)), key=lambda i: (amounts[i] - exact[i], i))
+    for i in order[:leftover]:
+        amounts[i] += 1
+    return amounts
+
+
+def resolve_shares(expense: schemas.ExpenseCreate):
+    """ Work out how many cents each participant owes; checks payers and shares add up to the amount """
+    if len({payer.user_id for payer in expense.payers}) != len(expense.payers):
+        raise SplitError("A user can only be listed once as a payer")
+    if len({share.user_id for share in expense.shares}) != len(expense.shares):
+        raise SplitError("A user can only be listed once as a participant")
+    if sum(payer.amount_cents for payer in expense.payers) != expense.amount_cents:
+        raise SplitError("Payer amounts must add up to the expense amount")
+
+    values = [share.value for share in expense.shares]
+    if expense.split_type == schemas.SplitType.equal:
+        return allocate(expense.amount_cents, [Decimal(1)] * len(values))
+    if any(value is None for value in values):
+        raise SplitError(f"Every participant needs a value for a {expense.split_type.value} split")
+    if expense.split_type == schemas.SplitType.exact:
+        if any(value != int(value) or value < 0 for value in values):
+            raise SplitError("Exact shares must be whole, non-negative cents")
+        if sum(values) != expense.amount_cents:
+            raise SplitError("Exact shares must add up to the expense amount")
+        return [int(value) for value in values]
+    if expense.split_type == schemas.SplitType.percentage and sum(values) != 100:
+        raise SplitError("Percentages must add up to 100")
+    return allocate(expense.amount_cents, values)
+
+
+def compute_balances(payer_ids: np.ndarray, paid_cents: np.ndarray, share_ids: np.ndarray, owed_cents: np.ndarray):
+    """
+    Net balance per user over a whole ledger in one vectorised pass: paid minus owed, in cents.
+    Returns (user_ids, balances) as int64 arrays sorted by user ID; the balances always sum to zero.
+    """
+    user_ids, index = np.unique(np.concatenate([payer_ids, share_ids]), return_inverse=True)
+    balances = np.zeros(len(user_ids), dtype=np.int64)
+    np.add.at(balances, index[:len(payer_ids)], paid_cents)
+    np.subtract.at(balances, index[len(payer_ids):], owed_cents)
+    return user_ids, balances
+
+
+def settle(user_ids: np.ndarray, balances: np.ndarray):
+    """
+    Reduce net balances to a short list of transfers: repeatedly match the largest debtor with
+    the largest creditor (max-heaps), paying off whichever is smaller. At most n - 1 transfers
+    """
+    # heapq is a min-heap, so store negated amounts
+    creditors = [(-int(amount), int(user)) for user, amount in zip(user_ids, balances) if amount > 0]
+    debtors = [(int(amount), int(user)) for user, amount in zip(user_ids, balances) if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append(schemas.TransferModel(from_user_id=debtor, to_user_id=creditor, amount_cents=amount))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return transfers
+
+
+def _popcounts(n: int):
+    """ Number of set bits of every mask below 2 ** n """
+    counts = np.zeros(1 << n, dtype=np.int8)
+    for i in range(n):
+        counts[1 << i:2 << i] = counts[:1 << i] + 1
+    return counts
+
+
+@lru_cache(maxsize=1024)
+def zero_sum_partition(balances: tuple[int, ...], budget: float):
+    """
+    Split non-zero balances (summing to zero) into as many zero-sum groups as possible, as tuples of indices.
+    Settling each group separately takes len(group) - 1 transfers, so this gives the minimum number of
+    transfers: len(balances) - number of groups. Bitmask DP over all 2 ** n subsets, vectorised one
+    subset size at a time: best[mask] = max over members i of best[mask - i], plus 1 if mask sums to zero.
+    Raises TimeoutError past budget seconds; results are memoized, so unchanged groups cost nothing
+    """
+    deadline = time.monotonic() + budget
+    n = len(balances)
+    values = np.array(balances, dtype=np.int64)
+    sums = np.zeros(1 << n, dtype=np.int64)
+    for i in range(n):
+        sums[1 << i:2 << i] = sums[:1 << i] + values[i]
+    zero = (sums == 0).astype(np.int8)
+    del sums
+    counts = _popcounts(n)
+    by_size = np.argsort(counts, kind="stable").astype(np.int64)
+    bounds = np.searchsorted(counts[by_size], np.arange(n + 2))
+
+    best = np.zeros(1 << n, dtype=np.int8)
+    for size in range(1, n + 1):
+        layer = by_size[bounds[size]:bounds[size + 1]]
+        layer_best = np.zeros(len(layer), dtype=np.int8)
+        for i in range(n):
+            # For masks without bit i, mask ^ bit is a bigger subset, still 0 here: harmless in the max
+            np.maximum(layer_best, best[layer ^ (1 << i)], out=layer_best)
+        best[layer] = layer_best + zero[layer]
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Exact settlement of {n} balances exceeded {budget}s")
+
+    # Walk back from the full set removing one member at a time along an optimal path; consecutive
+    # zero-sum subsets on the path differ by a zero-sum group
+    groups, mask, group_end = [], (1 << n) - 1, (1 << n) - 1
+    while mask:
+        for i in range(n):
+            bit = 1 << i
+            if mask & bit and best[mask ^ bit] == best[mask] - zero[mask]:
+                break
+        mask ^= bit
+        if zero[mask] or not mask:
+            groups.append(tuple(j for j in range(n) if (group_end ^ mask) >> j & 1))
+            group_end = mask
+    return tuple(groups)
+
+
+def _cancel_opposites(user_ids: np.ndarray, balances: np.ndarray):
+    """
+    Settle pairs of equal and opposite balances directly (always part of some optimal plan);
+    returns those transfers and a mask of the balances left over
+    """
+    transfers, left = [], balances != 0
+    creditors = {}
+    for index in np.flatnonzero(balances > 0):
+        creditors.setdefault(int(balances[index]), []).append(index)
+    for index in np.flatnonzero(balances < 0):
+        matches = creditors.get(-int(balances[index]))
+        if matches:
+            creditor = matches.pop()
+            transfers.append(schemas.TransferModel(
+                from_user_id=int(user_ids[index]), to_user_id=int(user_ids[creditor]),
+                amount_cents=int(balances[creditor]),
+            ))
+            left[index] = left[creditor] = False
+    return transfers, left
+
+
+def settle_exact(user_ids: np.ndarray, balances: np.ndarray, budget: float):
+    """ Minimum number of transfers: settle each group of zero_sum_partition on its own """
+    transfers = []
+    for group in zero_sum_partition(tuple(int(amount) for amount in balances), budget):
+        indices = np.array(group, dtype=np.int64)
+        transfers.extend(settle(user_ids[indices], balances[indices]))
+    return transfers
+
+
+class SettlementPlanner:
+    """
+    Picks the settlement engine for a group. Equal and opposite balances are paired off first; if at most
+    exact_max_members balances remain, the exact engine finds the fewest transfers (each one is a payment
+    provider call and fee for someone), else, or if it runs past time_budget seconds, the greedy engine
+    settles in O(n log n) with at most n - 1 transfers
+    """
+
+    def __init__(self, exact_max_members: int, time_budget: float):
+        self.exact_max_members = exact_max_members
+        self.time_budget = time_budget
+
+    async def plan(self, user_ids: np.ndarray, balances: np.ndarray, engine: str = "auto"):
+        """ (engine used, transfers) for a group's balances; engine is auto, exact or greedy """
+        if engine == "greedy":
+            return "greedy", settle(user_ids, balances)
+        transfers, left = _cancel_opposites(user_ids, balances)
+        user_ids, balances = user_ids[left], balances[left]
+        if len(balances) <= self.exact_max_members:
+            try:
+                # Up to a few hundred ms of numpy for the largest groups: keep it off the event loop
+                exact = await metrics.to_thread(settle_exact, user_ids, balances, self.time_budget)
+                return "exact", transfers + exact
+            except TimeoutError:
+                pass
+        return "greedy", transfers + settle(user_ids, balances)
+
+
+async def get_group(db: AsyncSession, group_id: int):
+    """ Get group by ID from database """
+    return await db.get(models.Group, group_id)
+
+
+def expense_deltas(expense: Expense, sign: int = 1):
+    """ How an expense moves each user's balance (paid minus owed); sign=-1 reverses it """
+    deltas = {}
+    for payer in expense.payers:
+        deltas[payer.user_id] = deltas.get(payer.user_id, 0) + sign * payer.amount_cents
+    for share in expense.shares:
+        deltas[share.user_id] = deltas.get(share.user_id, 0) - sign * share.amount_cents
+    return deltas
+
+
+def _utc_day(moment: datetime):
+    return moment.astimezone(timezone.utc).date()
+
+
+async def balance_deltas(db: AsyncSession, expense: Expense, sign: int = 1):
+    """
+    expense_deltas in the group's currency. An expense in another currency converts at the rate of the
+    day it was created, exactly as get_ledger converts it, so stored balances match the rebuilt ones
+    """
+    group = await get_group(db, expense.group_id)
+    if expense.currency is None or expense.currency == group.currency:
+        return expense_deltas(expense, sign)
+    key = (expense.currency, _utc_day(expense.created_at))
+    factor = (await fx.conversion_factors(db, group.currency, {key}))[key]
+    lines = [(payer.user_id, sign) for payer in expense.payers] + [(share.user_id, -sign) for share in expense.shares]
+    converted = fx.convert_lines(
+        np.array([0] * len(expense.payers) + [1] * len(expense.shares)),
+        np.array([line.amount_cents for line in expense.payers + expense.shares], dtype=np.int64),
+        np.full(len(lines), factor, dtype=np.int64),
+    )
+    deltas = {}
+    for (user_id, direction), amount in zip(lines, converted.tolist()):
+        deltas[user_id] = deltas.get(user_id, 0) + direction * amount
+    return deltas
+
+
+async def apply_balance_deltas(db: AsyncSession, group_id: int, deltas: dict[int, int]):
+    """
+    Add deltas to the stored group balances with one multi-row upsert. Runs in the caller's
+    transaction so balances commit (or roll back) together with the expense change
+    """
+    # Sorted so concurrent writers lock balance rows in the same order and can't deadlock
+    values = [
+        {"group_id": group_id, "user_id": user_id, "balance_cents": delta}
+        for user_id, delta in sorted(deltas.items()) if delta
+    ]
+    if not values:
+        return
+    statement = insert(GroupBalance).values(values)
+    statement = statement.on_conflict_do_update(
+        index_elements=[GroupBalance.group_id, GroupBalance.user_id],
+        set_={"balance_cents": GroupBalance.balance_cents + statement.excluded.balance_cents},
+    )
+    await db.execute(statement)
+
+
+async def lock_group(db: AsyncSession, group_id: int):
+    """
+    Hold the group row until the transaction ends (FOR NO KEY UPDATE: inserts referencing the group
+    aren't blocked), so balance changes of a group are logged one transaction at a time. Take it before
+    touching balance rows so writers always lock in the same order
+    """
+    await db.execute(select(models.Group.id).filter(models.Group.id == group_id).with_for_update(key_share=True))
+
+
+async def record_deltas(db: AsyncSession, group_id: int, kind: str, deltas: dict[int, int],
+                        expense_id: int | None = None, user_id: int | None = None, data: dict | None = None):
+    """
+    Apply deltas to the stored balances and append the matching ledger event, in the caller's transaction,
+    which also notifies the group's live streams on commit. Every LEDGER_SNAPSHOT_INTERVAL events of a
+    group, the balances right after the event are snapshotted
+    """
+    await lock_group(db, group_id)
+    await apply_balance_deltas(db, group_id, deltas)
+    deltas = {user: delta for user, delta in sorted(deltas.items()) if delta}
+    event_id, created_at = (await db.execute(
+        insert(LedgerEvent)
+        .values(group_id=group_id, kind=kind, expense_id=expense_id, user_id=user_id, data=data,
+                deltas={str(user): delta for user, delta in deltas.items()})
+        .returning(LedgerEvent.id, LedgerEvent.created_at)
+    )).one()
+    await stream.notify(db, schemas.LedgerEventModel(
+        id=event_id, group_id=group_id, kind=kind, expense_id=expense_id, user_id=user_id, deltas=deltas,
+        data=data, created_at=created_at,
+    ))
+    last_snapshot = (
+        select(func.coalesce(func.max(BalanceSnapshot.event_id), 0))
+        .filter(BalanceSnapshot.group_id == group_id)
+        .scalar_subquery()
+    )
+    since_snapshot = await db.scalar(
+        select(func.count()).select_from(LedgerEvent)
+        .filter(LedgerEvent.group_id == group_id, LedgerEvent.id > last_snapshot)
+    )
+    if since_snapshot >= get_settings().ledger_snapshot_interval:
+        user_ids, balances = await get_balances(db, group_id)
+        db.add(BalanceSnapshot(
+            group_id=group_id, event_id=event_id, created_at=created_at,
+            balances={str(user): balance for user, balance in zip(user_ids.tolist(), balances.tolist())},
+        ))
+    return event_id
+
+
+def _expense_data(expense: Expense):
+    """ What an expense event records for audits """
+    return {
+        "description": expense.description,
+        "amount_cents": expense.amount_cents,
+        "currency": expense.currency,
+        "split_type": expense.split_type,
+        "payers": {str(payer.user_id): payer.amount_cents for payer in expense.payers},
+        "shares": {str(share.user_id): share.amount_cents for share in expense.shares},
+    }
+
+
+async def record_settlement(db: AsyncSession, group_id: int, settlement: schemas.SettlementRecord, user_id: int):
+    """ Record a payment between two members: the payer's balance goes up, the receiver's down """
+    if settlement.from_user_id == settlement.to_user_id:
+        # deltas would keep only one of the two entries and the ledger would no longer sum to zero
+        raise SplitError("A settlement must be between two different members")
+    members = set((await db.scalars(select(GroupMember.user_id).filter(
+        GroupMember.group_id == group_id,
+        GroupMember.user_id.in_([settlement.from_user_id, settlement.to_user_id]),
+    ))).all())
+    if members != {settlement.from_user_id, settlement.to_user_id}:
+        raise SplitError("Both users must be members of the group")
+    deltas = {settlement.from_user_id: settlement.amount_cents, settlement.to_user_id: -settlement.amount_cents}
+    event_id = await record_deltas(db, group_id, "settlement_recorded", deltas, user_id=user_id,
+                                   data=settlement.model_dump())
+    await db.commit()
+    return await db.get(LedgerEvent, event_id)
+
+
+async def get_events(db: AsyncSession, group_id: int, after_id: int = 0, limit: int = 100):
+    """ A group's ledger events after an event id, oldest first (keyset pagination on the id) """
+    result = await db.scalars(
+        select(LedgerEvent)
+        .filter(LedgerEvent.group_id == group_id, LedgerEvent.id > after_id)
+        .order_by(LedgerEvent.id)
+        .limit(limit)
+    )
+    return result.all()
+
+
+async def get_balances_as_of(db: AsyncSession, group_id: int, as_of: datetime):
+    """
+    Balances of a group at a point in time as (user_ids, balances) int64 arrays: the latest snapshot
+    taken by then plus the events after it, so at most about LEDGER_SNAPSHOT_INTERVAL events are read
+    """
+    snapshot = (await db.execute(
+        select(BalanceSnapshot.event_id, BalanceSnapshot.balances)
+        .filter(BalanceSnapshot.group_id == group_id, BalanceSnapshot.created_at <= as_of)
+        .order_by(BalanceSnapshot.event_id.desc())
+        .limit(1)
+    )).first()
+    after_id, totals = (snapshot.event_id, {int(user): cents for user, cents in snapshot.balances.items()}) \
+        if snapshot is not None else (0, {})
+    tail = await db.scalars(
+        select(LedgerEvent.deltas)
+        .filter(LedgerEvent.group_id == group_id, LedgerEvent.id > after_id, LedgerEvent.created_at <= as_of)
+        .order_by(LedgerEvent.id)
+    )
+    for deltas in tail:
+        for user, delta in deltas.items():
+            totals[int(user)] = totals.get(int(user), 0) + delta
+    user_ids = np.array(sorted(totals), dtype=np.int64)
+    return user_ids, np.array([totals[user] for user in user_ids.tolist()], dtype=np.int64)
+
+
+async def get_recorded_settlements(db: AsyncSession, group_id: int):
+    """ Net balance change of each user from the settlements recorded in a group """
+    totals = {}
+    for deltas in await db.scalars(select(LedgerEvent.deltas).filter(
+            LedgerEvent.group_id == group_id, LedgerEvent.kind == "settlement_recorded")):
+        for user, delta in deltas.items():
+            totals[int(user)] = totals.get(int(user), 0) + delta
+    return totals
+
+
+async def get_role(db: AsyncSession, group_id: int, user_id: int):
+    """ Role of a user in a group, or None if they aren't a member; a primary key lookup """
+    return await db.scalar(
+        select(GroupMember.role).filter(GroupMember.group_id == group_id, GroupMember.user_id == user_id)
+    )
+
+
+async def get_members(db: AsyncSession, group_id: int):
+    """ Members of a group, ordered by user ID """
+    result = await db.scalars(
+        select(GroupMember).filter(GroupMember.group_id == group_id).order_by(GroupMember.user_id)
+    )
+    return result.all()
+
+
+async def get_user_groups(db: AsyncSession, user_id: int):
+    """
+    Groups a user belongs to, with their role in each: one join that seeks
+    ix_group_members_user_id_group_id and fetches the groups by primary key
+    """
+    result = await db.execute(
+        select(models.Group.id, models.Group.name, models.Group.description, models.Group.currency,
+               models.Group.owner_id, GroupMember.role)
+        .join(GroupMember, GroupMember.group_id == models.Group.id)
+        .filter(GroupMember.user_id == user_id)
+        .order_by(models.Group.id)
+    )
+    return result.all()
+
+
+async def add_members(db: AsyncSession, group_id: int, user_ids: list[int], role: schemas.MemberRole):
+    """
+    Add users to a group in one INSERT ... SELECT: IDs that aren't users are dropped by the select,
+    existing members are skipped by ON CONFLICT. Returns the IDs that were added
+    """
+    statement = (
+        insert(GroupMember)
+        .from_select(
+            ["group_id", "user_id", "role"],
+            select(literal(group_id), models.User.id, literal(role.value)).filter(models.User.id.in_(user_ids)),
+        )
+        .on_conflict_do_nothing(index_elements=[GroupMember.group_id, GroupMember.user_id])
+        .returning(GroupMember.user_id)
+    )
+    added = (await db.scalars(statement)).all()
+    await db.commit()
+    return sorted(added)
+
+
+async def remove_members(db: AsyncSession, group_id: int, user_ids: list[int]):
+    """
+    Remove users from a group in one DELETE. The owner and members with an unsettled balance
+    are kept, so no balance is left without a member. Returns the IDs that were removed
+    """
+    unsettled = exists().where(
+        GroupBalance.group_id == GroupMember.group_id,
+        GroupBalance.user_id == GroupMember.user_id,
+        GroupBalance.balance_cents != 0,
+    )
+    statement = (
+        delete(GroupMember)
+        .where(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id.in_(user_ids),
+            GroupMember.role != schemas.MemberRole.owner.value,
+            ~unsettled,
+        )
+        .returning(GroupMember.user_id)
+    )
+    removed = (await db.scalars(statement)).all()
+    await db.commit()
+    return sorted(removed)
+
+
+async def _check_members(db: AsyncSession, group_id: int, expense: schemas.ExpenseCreate):
+    """ Every payer and participant must be a member of the group; one lookup on the primary key """
+    user_ids = {payer.user_id for payer in expense.payers} | {share.user_id for share in expense.shares}
+    found = set((await db.scalars(
+        select(GroupMember.user_id).filter(GroupMember.group_id == group_id, GroupMember.user_id.in_(user_ids))
+    )).all())
+    if found != user_ids:
+        raise SplitError(f"Not members of the group: {sorted(user_ids - found)}")
+
+
+def _build_lines(expense: schemas.ExpenseCreate):
+    """ Payer and share rows for an expense, with shares resolved to cents """
+    amounts = resolve_shares(expense)
+    payers = [ExpensePayer(user_id=payer.user_id, amount_cents=payer.amount_cents) for payer in expense.payers]
+    shares = [
+        ExpenseShare(user_id=share.user_id, value=share.value, amount_cents=amount)
+        for share, amount in zip(expense.shares, amounts)
+    ]
+    return payers, shares
+
+
+async def create_expense(db: AsyncSession, group_id: int, expense: schemas.ExpenseCreate, created_by_id: int):
+    """ Resolve the split of an expense and store it with its payers and shares """
+    payers, shares = _build_lines(expense)
+    await _check_members(db, group_id, expense)
+    db_expense = Expense(
+        group_id=group_id,
+        description=expense.description,
+        amount_cents=expense.amount_cents,
+        currency=expense.currency,
+        split_type=expense.split_type.value,
+        created_by_id=created_by_id,
+        # Set here rather than by the database: its day picks the FX rate the balances move by
+        created_at=datetime.now(timezone.utc),
+        payers=payers,
+        shares=shares,
+    )
+    db.add(db_expense)
+    await db.flush()
+    await record_deltas(db, group_id, "expense_created", await balance_deltas(db, db_expense),
+                        expense_id=db_expense.id, user_id=created_by_id, data=_expense_data(db_expense))
+    await db.commit()
+    await db.refresh(db_expense, attribute_names=["id", "created_at", "payers", "shares"])
+    return db_expense
+
+
+async def get_expense(db: AsyncSession, group_id: int, expense_id: int, for_update: bool = False):
+    """
+    Get an expense of a group, with its payers and shares. for_update=True (before changing or deleting
+    it) takes the group lock first, so the lines read are the ones current when the change is applied,
+    not ones a concurrent edit is about to replace
+    """
+    if for_update:
+        await lock_group(db, group_id)
+    result = await db.execute(
+        select(Expense)
+        .options(selectinload(Expense.payers), selectinload(Expense.shares))
+        .filter(Expense.id == expense_id, Expense.group_id == group_id)
+        .execution_options(populate_existing=for_update)
+    )
+    return result.scalars().first()
+
+
+async def update_expense(db: AsyncSession, db_expense: Expense, expense: schemas.ExpenseCreate,
+                         user_id: int | None = None):
+    """ Replace an expense's amount and split; balances move by the difference between old and new """
+    payers, shares = _build_lines(expense)
+    await _check_members(db, db_expense.group_id, expense)
+    deltas = await balance_deltas(db, db_expense, sign=-1)
+    db_expense.description = expense.description
+    db_expense.amount_cents = expense.amount_cents
+    db_expense.currency = expense.currency
+    db_expense.split_type = expense.split_type.value
+    # Flush the removal first so the new rows don't collide with the old (expense_id, user_id) keys
+    db_expense.payers.clear()
+    db_expense.shares.clear()
+    await db.flush()
+    db_expense.payers.extend(payers)
+    db_expense.shares.extend(shares)
+    for member_id, delta in (await balance_deltas(db, db_expense)).items():
+        deltas[member_id] = deltas.get(member_id, 0) + delta
+    await record_deltas(db, db_expense.group_id, "expense_updated", deltas,
+                        expense_id=db_expense.id, user_id=user_id, data=_expense_data(db_expense))
+    await db.commit()
+    await db.refresh(db_expense, attribute_names=["payers", "shares"])
+    return db_expense
+
+
+async def delete_expense(db: AsyncSession, db_expense: Expense, user_id: int | None = None):
+    """ Delete an expense and reverse its effect on the group balances """
+    await record_deltas(db, db_expense.group_id, "expense_deleted", await balance_deltas(db, db_expense, sign=-1),
+                        expense_id=db_expense.id, user_id=user_id, data=_expense_data(db_expense))
+    await db.delete(db_expense)
+    await db.commit()
+
+
+async def get_expenses(db: AsyncSession, group_id: int, skip: int = 0, limit: int = 100):
+    """ Get a group's expenses, newest first """
+    result = await db.execute(
+        select(Expense)
+        .options(selectinload(Expense.payers), selectinload(Expense.shares))
+        .filter(Expense.group_id == group_id)
+        .order_by(Expense.id.desc())
+        .offset(skip)
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+
+async def get_ledger(db: AsyncSession, group_id: int):
+    """
+    Load a group's ledger as flat int64 arrays (payer ids, paid cents, participant ids, owed cents),
+    reading only the columns needed instead of building ORM objects. Amounts are in the group's currency:
+    expenses in other currencies are converted in one vectorised pass, with one rate lookup per
+    currency and day rather than per expense
+    """
+    paid = (await db.execute(
+        select(ExpensePayer.expense_id, ExpensePayer.user_id, ExpensePayer.amount_cents)
+        .join(Expense, Expense.id == ExpensePayer.expense_id)
+        .filter(Expense.group_id == group_id)
+    )).all()
+    owed = (await db.execute(
+        select(ExpenseShare.expense_id, ExpenseShare.user_id, ExpenseShare.amount_cents)
+        .join(Expense, Expense.id == ExpenseShare.expense_id)
+        .filter(Expense.group_id == group_id)
+    )).all()
+    paid = np.array(paid, dtype=np.int64).reshape(-1, 3)
+    owed = np.array(owed, dtype=np.int64).reshape(-1, 3)
+    paid_cents, owed_cents = paid[:, 2], owed[:, 2]
+
+    group = await get_group(db, group_id)
+    foreign = [] if group is None else (await db.execute(
+        select(Expense.id, Expense.currency, func.date(func.timezone("UTC", Expense.created_at)))
+        .filter(Expense.group_id == group_id, Expense.currency.is_not(None), Expense.currency != group.currency)
+        .order_by(Expense.id)
+    )).all()
+    if foreign:
+        factors = await fx.conversion_factors(db, group.currency, {(currency, day) for _, currency, day in foreign})
+        foreign_ids = np.array([expense_id for expense_id, _, _ in foreign], dtype=np.int64)
+        foreign_factors = np.array([factors[(currency, day)] for _, currency, day in foreign], dtype=np.int64)
+        # Payers are labelled 2 * expense_id, shares 2 * expense_id + 1: each side is converted as a whole
+        expense_ids = np.concatenate([paid[:, 0], owed[:, 0]])
+        amounts = np.concatenate([paid_cents, owed_cents])
+        sides = np.concatenate([np.zeros(len(paid), dtype=np.int64), np.ones(len(owed), dtype=np.int64)])
+        mask = np.isin(expense_ids, foreign_ids)
+        amounts[mask] = fx.convert_lines(
+            expense_ids[mask] * 2 + sides[mask],
+            amounts[mask],
+            foreign_factors[np.searchsorted(foreign_ids, expense_ids[mask])],
+        )
+        paid_cents, owed_cents = amounts[:len(paid)], amounts[len(paid):]
+    return paid[:, 1], paid_cents, owed[:, 1], owed_cents
+
+
+async def get_balances(db: AsyncSession, group_id: int, lock: bool = False):
+    """
+    Stored balances of a group as (user_ids, balances) int64 arrays; a single primary key lookup.
+    lock=True holds the rows (FOR UPDATE) so expense writes wait until the transaction ends
+    """
+    query = (
+        select(GroupBalance.user_id, GroupBalance.balance_cents)
+        .filter(GroupBalance.group_id == group_id)
+        .order_by(GroupBalance.user_id)
+    )
+    if lock:
+        query = query.with_for_update()
+    rows = (await db.execute(query)).all()
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    return rows[:, 0], rows[:, 1]
+
+
+async def get_settlement(db: AsyncSession, group_id: int, engine: str = "auto"):
+    """ Net balances of every user in a group and the transfers that settle them """
+    user_ids, balances = await get_balances(db, group_id)
+    group = await get_group(db, group_id)
+    engine, transfers = await get_settlement_planner().plan(user_ids, balances, engine)
+    return schemas.SettlementModel(
+        currency=group.currency,
+        balances=[
+            schemas.BalanceModel(user_id=int(user), balance_cents=int(amount))
+            for user, amount in zip(user_ids, balances)
+        ],
+        transfers=transfers,
+        engine=engine,
+    )
+
+
+async def verify_balances(db: AsyncSession, group_id: int | None = None, repair: bool = False):
+    """
+    Rebuild balances from the expense ledger and recorded settlements and compare them with group_balances,
+    for one group or every group. Returns the drifted rows; with repair=True the stored balances are
+    corrected, and the correction is logged as a balances_corrected event
+    """
+    if group_id is not None:
+        group_ids = [group_id]
+    else:
+        group_ids = sorted(set((await db.scalars(select(Expense.group_id).distinct())).all())
+                           | set((await db.scalars(select(GroupBalance.group_id).distinct())).all()))
+
+    drift = []
+    for gid in group_ids:
+        # When repairing, lock the group before reading the ledger so no expense write lands in between
+        if repair:
+            await lock_group(db, gid)
+        stored = dict(zip(*(array.tolist() for array in await get_balances(db, gid))))
+        expected = dict(zip(*(array.tolist() for array in compute_balances(*await get_ledger(db, gid)))))
+        for user_id, delta in (await get_recorded_settlements(db, gid)).items():
+            expected[user_id] = expected.get(user_id, 0) + delta
+        corrections = {}
+        for user_id in sorted(expected.keys() | stored.keys()):
+            expected_cents, stored_cents = expected.get(user_id, 0), stored.get(user_id, 0)
+            if expected_cents != stored_cents:
+                drift.append(schemas.BalanceDriftModel(
+                    group_id=gid, user_id=user_id, stored_cents=stored_cents, expected_cents=expected_cents,
+                ))
+                corrections[user_id] = expected_cents - stored_cents
+        if repair and corrections:
+            await record_deltas(db, gid, "balances_corrected", corrections, data={"reason": "verify_balances"})
+    if repair:
+        await db.commit()
+    return drift
+
+
+@lru_cache
+def get_settlement_planner():
+    """ The process's settlement planner, created from the settings on first use """
+    settings = get_settings()
+    return SettlementPlanner(settings.settlement_exact_max_members, settings.settlement_time_budget)
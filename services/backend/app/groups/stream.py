@@ -0,0 +1,192 @@
+""" Live group ledger streams: Postgres LISTEN/NOTIFY fanned out to server-sent event subscribers """
+import asyncio
+import json
+import random
+from functools import lru_cache
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import metrics
+from app.config import get_settings
+from app.db import database
+from app.groups.models import LedgerEvent
+from app.groups.schemas import LedgerEventModel
+
+CHANNEL = "group_events"
+# NOTIFY payloads must stay under 8000 bytes; bigger events are sent as a reference and loaded once
+NOTIFY_MAX_BYTES = 7900
+RECONNECT_SECONDS = 1.0
+
+STREAM_DROPS = metrics.Counter(
+    "group_stream_drops_total", "Live group streams ended for falling behind or losing the listener", ["reason"])
+
+
+def frame(event_id: int, kind: str, data: str):
+    """ One server-sent event; data must be a single line (compact JSON is) """
+    return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n".encode()
+
+
+async def notify(db: AsyncSession, event: LedgerEventModel):
+    """ Publish a ledger event to the live streams; like the event itself, it's only sent if db commits """
+    payload = event.model_dump_json()
+    if len(payload.encode()) > NOTIFY_MAX_BYTES:
+        payload = json.dumps({"id": event.id, "group_id": event.group_id, "kind": event.kind, "truncated": True})
+    await db.execute(select(func.pg_notify(CHANNEL, payload)))
+
+
+class Subscriber:
+    """ One open stream: a bounded queue of (event id, encoded frame), None once dropped """
+
+    def __init__(self, group_id: int, queue_size: int):
+        self.group_id = group_id
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+
+class GroupHub:
+    """
+    Per-worker fan-out of ledger events to the open streams of each group. One LISTEN connection per worker
+    receives the notifications of every group; each is encoded as an SSE frame once and put on the queue of
+    every subscriber of its group, without touching the database. A subscriber whose queue is full is
+    dropped instead of holding the others up or buffering without bound: its stream ends and the client
+    reconnects with Last-Event-ID. Losing the listener drops everyone the same way, as events may be missed
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._groups: dict[int, set[Subscriber]] = {}
+        self._listener = None
+        self._connected = None
+
+    def subscriber_count(self):
+        return sum(len(subscribers) for subscribers in self._groups.values())
+
+    async def subscribe(self, group_id: int, timeout: float):
+        """ Register a subscriber; raises TimeoutError if the listener isn't connected within timeout """
+        if self._listener is None or self._listener.done():
+            self._connected = asyncio.Event()
+            self._listener = asyncio.create_task(self._listen())
+        await asyncio.wait_for(self._connected.wait(), timeout)
+        subscriber = Subscriber(group_id, self.queue_size)
+        self._groups.setdefault(group_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscribers = self._groups.get(subscriber.group_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._groups[subscriber.group_id]
+
+    def publish(self, group_id: int, event_id: int, data: bytes):
+        for subscriber in list(self._groups.get(group_id, ())):
+            try:
+                subscriber.queue.put_nowait((event_id, data))
+            except asyncio.QueueFull:
+                STREAM_DROPS.inc(1, "slow")
+                self._drop(subscriber)
+
+    def _drop(self, subscriber: Subscriber):
+        self.unsubscribe(subscriber)
+        # Whatever is still queued is replayed from the ledger on reconnect; make room for the end marker
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(None)
+
+    def drop_all(self, reason: str):
+        for subscribers in list(self._groups.values()):
+            for subscriber in list(subscribers):
+                STREAM_DROPS.inc(1, reason)
+                self._drop(subscriber)
+
+    async def _dispatch(self, payload: str):
+        message = json.loads(payload)
+        if message.get("truncated"):
+            async with database.AsyncSessionLocal() as db:
+                event = await db.get(LedgerEvent, message["id"])
+            if event is None:
+                return
+            payload = LedgerEventModel.model_validate(event).model_dump_json()
+        self.publish(message["group_id"], message["id"], frame(message["id"], message["kind"], payload))
+
+    async def _listen(self):
+        # Imported here like the engines' drivers, so importing the app doesn't load it
+        import asyncpg
+
+        # On the primary: replicas don't relay notifications
+        url = make_url(str(get_settings().database_url)).set(drivername="postgresql")
+        heartbeat = get_settings().stream_heartbeat_seconds
+        while True:
+            connection = None
+            notifications = asyncio.Queue()
+            try:
+                connection = await asyncpg.connect(url.render_as_string(hide_password=False))
+                await connection.add_listener(
+                    CHANNEL, lambda connection, pid, channel, payload: notifications.put_nowait(payload))
+                self._connected.set()
+                while True:
+                    # Handled one at a time so subscribers get a group's events in commit order
+                    try:
+                        payload = await asyncio.wait_for(notifications.get(), heartbeat)
+                    except TimeoutError:
+                        # Idle: make sure the connection is still alive, so a dead one isn't waited on forever
+                        await connection.fetchval("SELECT 1")
+                        continue
+                    await self._dispatch(payload)
+            except Exception:
+                pass
+            finally:
+                self._connected.clear()
+                self.drop_all("listener")
+                if connection is not None:
+                    connection.terminate()
+            await asyncio.sleep(RECONNECT_SECONDS)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+
+
+async def events(subscriber: Subscriber, missed: list, reset: bool):
+    """
+    Body of a stream: the missed events first, then live ones (skipping any already replayed), with a
+    comment every stream_heartbeat_seconds so proxies keep idle streams open and closed ones are noticed
+    """
+    heartbeat = get_settings().stream_heartbeat_seconds
+    try:
+        # Spread the reconnects of streams that are dropped together
+        yield f"retry: {random.randint(1000, 5000)}\n\n".encode()
+        last_id = 0
+        for event in missed:
+            last_id = event.id
+            yield frame(event.id, event.kind, LedgerEventModel.model_validate(event).model_dump_json())
+        if reset:
+            # More was missed than is replayed: the client should reload balances and expenses
+            yield b"event: reset\ndata: {}\n\n"
+        while True:
+            try:
+                item = await asyncio.wait_for(subscriber.queue.get(), heartbeat)
+            except TimeoutError:
+                yield b": ping\n\n"
+                continue
+            if item is None:
+                return
+            event_id, data = item
+            if event_id > last_id:
+                yield data
+    finally:
+        get_group_hub().unsubscribe(subscriber)
+
+
+@lru_cache
+def get_group_hub():
+    """ The process's group hub, created from the settings on first use """
+    return GroupHub(queue_size=get_settings().stream_queue_size)
+
+
+STREAM_SUBSCRIBERS = metrics.Gauge(
+    "group_stream_subscribers", "Open live group streams in this worker",
+    collect=lambda: {(): get_group_hub().subscriber_count()})
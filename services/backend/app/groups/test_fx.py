@@ -0,0 +1,45 @@
+""" Converting amounts between currencies in minor units, rounding each expense once
+
+Run with: python -m pytest app/groups
+"""
+from decimal import Decimal
+
+import numpy as np
+
+from app.groups.fx import FX_SCALE, conversion_factor, convert_lines
+
+
+def convert(labels: list, amounts: list, factor: Decimal):
+    factors = np.full(len(amounts), int(factor * FX_SCALE), dtype=np.int64)
+    return convert_lines(np.array(labels), np.array(amounts, dtype=np.int64), factors).tolist()
+
+
+def test_factor_moves_between_minor_units():
+    # 1 USD = 100 JPY = 0.5 KWD; cents to yen, and cents to fils
+    assert conversion_factor(Decimal(1), Decimal("0.01"), "USD", "JPY") == FX_SCALE
+    assert conversion_factor(Decimal(1), Decimal(2), "USD", "KWD") == 5 * FX_SCALE
+    assert convert([0], [1234], Decimal(1)) == [1234]
+    assert convert([0], [1234], Decimal(5)) == [6170]
+
+
+def test_expense_is_rounded_once_then_split():
+    # Three third-cent lines would each round to 0; the expense rounds to 1, given to the first line
+    assert convert([0, 0, 0], [1, 1, 1], Decimal("0.4")) == [1, 0, 0]
+    # Each expense rounds on its own, half up
+    assert convert([0, 1], [1, 1], Decimal("0.5")) == [1, 1]
+
+
+def test_leftover_goes_to_the_largest_remainders():
+    assert convert([0, 0, 0], [1, 3, 2], Decimal("0.3")) == [0, 1, 1]
+
+
+def test_converted_expense_still_balances():
+    # Paid 1000, shared 333/333/334: both sides of the expense round to the same total
+    lines = convert([0, 1, 1, 1], [1000, -333, -333, -334], Decimal("0.917"))
+    assert lines[0] == 917
+    assert sum(lines) == 0
+
+
+def test_large_amounts_convert_exactly():
+    amount, factor = 9 * 10 ** 15, Decimal("1.23456789")
+    assert convert([0], [amount], factor) == [int((amount * factor).to_integral_value())]
@@ -0,0 +1,37 @@
+""" Ledger events logged by expense writes, through the API
+
+Run with: TEST_DATABASE_URL=postgresql://... python -m pytest app/groups
+"""
+from app.conftest import create_user
+
+
+def expense(payer: dict, members: list[dict], amount_cents: int):
+    return {
+        "description": "Dinner", "amount_cents": amount_cents, "split_type": "equal",
+        "payers": [{"user_id": payer["id"], "amount_cents": amount_cents}],
+        "shares": [{"user_id": member["id"]} for member in members],
+    }
+
+
+def test_expense_edit_logs_the_editor_as_actor(client):
+    alice, alice_headers = create_user(client, "alice")
+    bob, bob_headers = create_user(client, "bob")
+    carol, _ = create_user(client, "carol")
+    group = client.post(f"/users/{alice['id']}/groups/", json={"name": "Trip"}).json()
+    response = client.post(f"/groups/{group['id']}/members", json={"user_ids": [bob["id"], carol["id"]]},
+                           headers=alice_headers)
+    assert response.status_code == 200
+
+    created = client.post(f"/groups/{group['id']}/expenses", json=expense(alice, [alice, bob], 1000),
+                          headers=alice_headers).json()
+    # Bob edits it so that carol, the highest member id, is among the balances moved
+    response = client.put(f"/groups/{group['id']}/expenses/{created['id']}",
+                          json=expense(alice, [alice, bob, carol], 1200), headers=bob_headers)
+    assert response.status_code == 200
+    client.delete(f"/groups/{group['id']}/expenses/{created['id']}", headers=alice_headers)
+
+    events = client.get(f"/groups/{group['id']}/events", headers=alice_headers).json()
+    assert [(event["kind"], event["user_id"]) for event in events] == [
+        ("expense_created", alice["id"]), ("expense_updated", bob["id"]), ("expense_deleted", alice["id"]),
+    ]
+    assert events[1]["deltas"] == {str(bob["id"]): 100, str(carol["id"]): -400, str(alice["id"]): 300}
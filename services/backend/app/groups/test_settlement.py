@@ -0,0 +1,72 @@
+""" Exact settlement engine against a brute force search, on small random groups
+
+Run with: python -m pytest app/groups
+"""
+import random
+from functools import lru_cache
+
+import numpy as np
+import pytest
+
+from app.groups.service import settle_exact, zero_sum_partition
+
+BUDGET = 10.0
+
+
+def brute_force_groups(balances: tuple[int, ...]):
+    """ Most zero-sum groups the balances split into, trying every set partition """
+    @lru_cache(maxsize=None)
+    def best(mask: int):
+        if not mask:
+            return 0
+        # The lowest remaining index goes into some group: try every zero-sum subset containing it
+        first = mask & -mask
+        rest = mask ^ first
+        result, subset = None, rest
+        while True:
+            group = subset | first
+            if sum(balances[i] for i in range(len(balances)) if group >> i & 1) == 0:
+                found = best(mask ^ group)
+                if found is not None and (result is None or found + 1 > result):
+                    result = found + 1
+            if not subset:
+                return result
+            subset = (subset - 1) & rest
+
+    return best((1 << len(balances)) - 1)
+
+
+def random_balances(rng: random.Random, n: int):
+    """ n non-zero balances summing to zero; small amounts so zero-sum subgroups are common """
+    while True:
+        balances = [rng.choice([-1, 1]) * rng.randint(1, 6) for _ in range(n - 1)]
+        balances.append(-sum(balances))
+        if balances[-1] != 0:
+            return tuple(balances)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_zero_sum_partition_matches_brute_force(seed):
+    rng = random.Random(seed)
+    balances = random_balances(rng, rng.randint(2, 9))
+    groups = zero_sum_partition(balances, BUDGET)
+
+    assert sorted(index for group in groups for index in group) == list(range(len(balances)))
+    assert all(group and sum(balances[index] for index in group) == 0 for group in groups)
+    assert len(groups) == brute_force_groups(balances)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_settle_exact_uses_fewest_transfers(seed):
+    rng = random.Random(seed)
+    balances = np.array(random_balances(rng, rng.randint(2, 9)), dtype=np.int64)
+    user_ids = np.arange(100, 100 + len(balances), dtype=np.int64)
+    transfers = settle_exact(user_ids, balances, BUDGET)
+
+    assert len(transfers) == len(balances) - brute_force_groups(tuple(int(amount) for amount in balances))
+    settled = dict(zip(user_ids.tolist(), balances.tolist()))
+    for transfer in transfers:
+        assert transfer.amount_cents > 0 and transfer.from_user_id != transfer.to_user_id
+        settled[transfer.from_user_id] += transfer.amount_cents
+        settled[transfer.to_user_id] -= transfer.amount_cents
+    assert set(settled.values()) == {0}
@@ -0,0 +1,82 @@
+""" Splitting an expense into whole cents, and the errors of shares that don't add up
+
+Run with: python -m pytest app/groups
+"""
+from decimal import Decimal
+
+import pytest
+from pydantic import ValidationError
+
+from app.conftest import create_user
+from app.groups import schemas
+from app.groups.service import SplitError, allocate, resolve_shares
+
+
+def expense(split_type: str, values: list, amount_cents: int = 1000, payers: list | None = None):
+    return schemas.ExpenseCreate(
+        amount_cents=amount_cents, split_type=split_type,
+        payers=payers or [{"user_id": 1, "amount_cents": amount_cents}],
+        shares=[{"user_id": user_id, "value": value} for user_id, value in enumerate(values, start=1)],
+    )
+
+
+@pytest.mark.parametrize("amount_cents, weights, expected", [
+    (1000, [1, 1, 1], [334, 333, 333]),
+    # 1.5, 2.5 and 3: the two halves tie for the leftover cent, which goes to the earlier participant
+    (7, [3, 5, 6], [2, 2, 3]),
+    (100, [1, 0, 1], [50, 0, 50]),
+    (1, [1, 1], [1, 0]),
+])
+def test_allocate_hands_out_the_remainder(amount_cents, weights, expected):
+    amounts = allocate(amount_cents, [Decimal(weight) for weight in weights])
+    assert amounts == expected
+    assert sum(amounts) == amount_cents
+
+
+@pytest.mark.parametrize("weights", [[0, 0], [1, -1], [2, -1]])
+def test_allocate_rejects_bad_weights(weights):
+    with pytest.raises(SplitError):
+        allocate(100, [Decimal(weight) for weight in weights])
+
+
+def test_split_types():
+    assert resolve_shares(expense("equal", [None, None, None])) == [334, 333, 333]
+    assert resolve_shares(expense("exact", [600, 400])) == [600, 400]
+    assert resolve_shares(expense("percentage", ["33.5", "33.5", 33])) == [335, 335, 330]
+    assert resolve_shares(expense("weighted", [1, 3])) == [250, 750]
+
+
+@pytest.mark.parametrize("split_type, values, error", [
+    ("percentage", [50, "49.99"], "Percentages must add up to 100"),
+    ("percentage", [50, 50, None], "Every participant needs a value for a percentage split"),
+    ("exact", [600, 300], "Exact shares must add up to the expense amount"),
+    ("exact", ["600.5", "399.5"], "Exact shares must be whole, non-negative cents"),
+    ("weighted", [0, 0], "Weights must be non-negative and not all zero"),
+])
+def test_resolve_shares_errors(split_type, values, error):
+    with pytest.raises(SplitError, match=error):
+        resolve_shares(expense(split_type, values))
+
+
+def test_resolve_shares_checks_payers():
+    with pytest.raises(SplitError, match="Payer amounts must add up"):
+        resolve_shares(expense("equal", [None], payers=[{"user_id": 1, "amount_cents": 999}]))
+    with pytest.raises(SplitError, match="only be listed once as a payer"):
+        resolve_shares(expense("equal", [None], payers=[{"user_id": 1, "amount_cents": 500}] * 2))
+
+
+@pytest.mark.parametrize("value", ["NaN", "Infinity", "-Infinity", float("nan")])
+def test_share_values_must_be_finite(value):
+    with pytest.raises(ValidationError, match="finite number"):
+        expense("weighted", [1, value])
+
+
+def test_non_finite_share_is_a_422(client):
+    alice, headers = create_user(client, "alice")
+    group = client.post(f"/users/{alice['id']}/groups/", json={"name": "Flat"}).json()
+    body = ('{"amount_cents": 1000, "split_type": "weighted", "payers": [{"user_id": %d, "amount_cents": 1000}],'
+            ' "shares": [{"user_id": %d, "value": NaN}]}' % (alice["id"], alice["id"]))
+    response = client.post(f"/groups/{group['id']}/expenses", content=body,
+                           headers={**headers, "Content-Type": "application/json"})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", "shares", 0, "value"]
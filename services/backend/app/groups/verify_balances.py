@@ -0,0 +1,29 @@
+""" Verification job: rebuild group balances from the expense ledger and report drift
+
+Run with: python -m app.groups.verify_balances [--group GROUP_ID] [--repair]
+Exits with status 1 if any drift was found
+"""
+import argparse
+import asyncio
+import sys
+
+from app.db.database import AsyncSessionLocal
+from app.groups import service
+
+
+async def main(group_id: int | None, repair: bool):
+    async with AsyncSessionLocal() as db:
+        drift = await service.verify_balances(db, group_id=group_id, repair=repair)
+    for row in drift:
+        print(f"group {row.group_id} user {row.user_id}: stored {row.stored_cents}, ledger {row.expected_cents}")
+    action = "repaired" if repair else "found"
+    print(f"{len(drift)} drifted balance(s) {action}")
+    return 1 if drift else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--group", type=int, default=None, help="only check this group")
+    parser.add_argument("--repair", action="store_true", help="overwrite drifted balances with the ledger values")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.group, args.repair)))
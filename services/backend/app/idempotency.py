@@ -0,0 +1,217 @@
+""" Idempotency-Key support for write routes: the first response is stored and replayed to retries """
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from fastapi import HTTPException, Request, Response
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import metrics
+from app.cache import MemoryBackend, get_response_cache
+from app.config import get_settings
+from app.db import database, models
+from app.responses import dump_json, model_response
+
+IDEMPOTENCY_REQUESTS = metrics.Counter(
+    "idempotency_requests_total", "Requests with an Idempotency-Key by outcome (new, replayed, conflict)", ["result"])
+
+
+def _fingerprint(body: bytes):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def token_caller(token: str):
+    """ Caller of a request identified only by its bearer token: a hash of it, so the token isn't stored """
+    return "token:" + _fingerprint(token.encode())
+
+
+def _pack(fingerprint: str, status_code: int, body: bytes):
+    return f"{fingerprint}\n{status_code}\n".encode() + body
+
+
+def _unpack(value: bytes):
+    fingerprint, status_code, body = value.split(b"\n", 2)
+    return fingerprint.decode(), int(status_code), body
+
+
+def _replay(status_code: int, body: bytes):
+    IDEMPOTENCY_REQUESTS.inc(1, "replayed")
+    return Response(content=body, status_code=status_code, media_type="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+
+class IdempotencyStore:
+    """
+    Keys live in the idempotency_keys table so every worker sees them; completed responses are also kept
+    in a per-process LRU so a retry burst is answered without touching the database. A key belongs to the
+    endpoint and caller it was sent by, so another caller using the same key never gets its response.
+    It is claimed with one INSERT ... ON CONFLICT before the write runs, so concurrent retries can't both
+    execute it: the loser gets a 409 until the first one finishes, then the stored response. Until then
+    the claim only holds for a short lease, renewed while the write runs, so a key whose request died with
+    its worker can be taken over by a retry once the lease lapses instead of answering 409 for the whole ttl.
+    The write and its stored response commit in one transaction: a request dying at any point leaves
+    either both or neither
+    """
+
+    def __init__(self, ttl: float, lease: float, max_entries: int):
+        self.ttl = ttl
+        self.lease = lease
+        self.front = MemoryBackend(max_entries=max_entries)
+
+    @staticmethod
+    def _matches(scope: tuple[str, str, str]):
+        """ Filter matching the row of scope, a (key, endpoint, caller) tuple """
+        key, endpoint, caller = scope
+        return (models.IdempotencyKey.key == key, models.IdempotencyKey.endpoint == endpoint,
+                models.IdempotencyKey.caller == caller)
+
+    async def _claim(self, db: AsyncSession, scope: tuple[str, str, str], fingerprint: str):
+        """
+        Insert the key, or take over an expired one (or one whose lease lapsed); returns the claim's
+        created_at, which tells this claim from a later takeover, or None if another request holds the key
+        """
+        key, endpoint, caller = scope
+        values = {
+            "key": key, "endpoint": endpoint, "caller": caller, "fingerprint": fingerprint,
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.lease),
+        }
+        statement = insert(models.IdempotencyKey).values(values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[models.IdempotencyKey.key, models.IdempotencyKey.endpoint, models.IdempotencyKey.caller],
+            set_={
+                "fingerprint": statement.excluded.fingerprint, "expires_at": statement.excluded.expires_at,
+                "status_code": None, "response_body": None, "created_at": func.now(),
+            },
+            where=models.IdempotencyKey.expires_at < func.now(),
+        ).returning(models.IdempotencyKey.created_at)
+        claimed = (await db.execute(statement)).scalar()
+        await db.commit()
+        return claimed
+
+    def _owned(self, scope: tuple[str, str, str], claimed: datetime):
+        """ Filter matching the key while it's still held by the claim made at claimed """
+        return (*self._matches(scope), models.IdempotencyKey.created_at == claimed,
+                models.IdempotencyKey.status_code.is_(None))
+
+    async def _renew(self, scope: tuple[str, str, str], claimed: datetime):
+        """ Extend the lease every third of it, in a session of its own, while work() runs """
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                async with database.AsyncSessionLocal() as db:
+                    await db.execute(
+                        update(models.IdempotencyKey).filter(*self._owned(scope, claimed))
+                        .values(expires_at=func.now() + timedelta(seconds=self.lease))
+                    )
+                    await db.commit()
+            except Exception:
+                # Next renewal retries; the lease outlasts a missed one
+                pass
+
+    async def _stored(self, db: AsyncSession, scope: tuple[str, str, str], fingerprint: str):
+        """ Response of the request that owns the key (caching it in front), or an HTTPException """
+        row = (await db.execute(
+            select(models.IdempotencyKey.fingerprint, models.IdempotencyKey.status_code,
+                   models.IdempotencyKey.response_body, models.IdempotencyKey.expires_at)
+            .filter(*self._matches(scope))
+        )).first()
+        if row is None:
+            # Released by a failed first request in between: let the client retry
+            raise HTTPException(status_code=409, detail="Request with this Idempotency-Key failed, retry it",
+                                headers={"Retry-After": "1"})
+        if row.fingerprint != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different body")
+        if row.status_code is None:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is in progress",
+                                headers={"Retry-After": "1"})
+        remaining = (row.expires_at - datetime.now(timezone.utc)).total_seconds()
+        if remaining > 0:
+            self.front.set("|".join(scope), _pack(fingerprint, row.status_code, row.response_body), remaining)
+        return _replay(row.status_code, row.response_body)
+
+    async def run(self, db: AsyncSession, request: Request, key: str | None, caller: str, type_, work,
+                  status_code: int = 200, invalidates: tuple[str, ...] = ()):
+        """
+        Run work() (a coroutine function writing through db, which it leaves to this method to commit) once
+        per Idempotency-Key of caller and return its result serialized as type_. Retries with the same key
+        and body get the stored response instead; without a key work() simply runs. If work() raises, the
+        key is released so the request can be retried. invalidates: response cache namespaces to make
+        stale once the write has committed
+        """
+        if key is None:
+            response = model_response(type_, await work(), status_code=status_code)
+            await db.commit()
+            await get_response_cache().invalidate_async(*invalidates)
+            return response
+
+        scope = (key, f"{request.method} {request.url.path}", caller)
+        fingerprint = _fingerprint(await request.body())
+        cached = self.front.get("|".join(scope))
+        if cached is not None:
+            cached_fingerprint, cached_status, body = _unpack(cached)
+            if cached_fingerprint == fingerprint:
+                return _replay(cached_status, body)
+        claimed = await self._claim(db, scope, fingerprint)
+        if claimed is None:
+            try:
+                return await self._stored(db, scope, fingerprint)
+            except HTTPException:
+                IDEMPOTENCY_REQUESTS.inc(1, "conflict")
+                raise
+
+        IDEMPOTENCY_REQUESTS.inc(1, "new")
+        renewals = asyncio.create_task(self._renew(scope, claimed))
+        try:
+            body = dump_json(type_, await work())
+            stored = await db.execute(
+                update(models.IdempotencyKey).filter(*self._owned(scope, claimed))
+                .values(status_code=status_code, response_body=body,
+                        expires_at=func.now() + timedelta(seconds=self.ttl))
+            )
+            if stored.rowcount == 0:
+                # Stalled past the lease and a retry took the key over: the write is the retry's to make
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is in progress",
+                                    headers={"Retry-After": "1"})
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            await db.execute(delete(models.IdempotencyKey).filter(*self._owned(scope, claimed)))
+            await db.commit()
+            raise
+        finally:
+            renewals.cancel()
+        await get_response_cache().invalidate_async(*invalidates)
+        self.front.set("|".join(scope), _pack(fingerprint, status_code, body), self.ttl)
+        return Response(content=body, status_code=status_code, media_type="application/json")
+
+    async def purge_expired(self):
+        """ Delete expired keys; returns how many were removed """
+        async with database.AsyncSessionLocal() as db:
+            result = await db.execute(
+                delete(models.IdempotencyKey).filter(models.IdempotencyKey.expires_at < func.now()))
+            await db.commit()
+            return result.rowcount
+
+    async def run_purges(self, interval: float):
+        """ Purge expired keys every interval seconds, for the lifetime of the worker """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.purge_expired()
+            except Exception:
+                # The database being briefly unavailable must not kill the loop; the next round retries
+                pass
+
+    def after_fork(self):
+        self.front.after_fork()
+
+
+@lru_cache
+def get_idempotency_store():
+    """ The process's idempotency store, created from the settings on first use """
+    settings = get_settings()
+    return IdempotencyStore(ttl=settings.idempotency_ttl, lease=settings.idempotency_lease_seconds,
+                            max_entries=settings.idempotency_cache_max_entries)
@@ -0,0 +1,297 @@
+""" Background jobs: a durable queue in the jobs table, worked off the request path
+
+Run a worker with: python -m app.jobs [--concurrency N]
+Routes enqueue a job and answer 202 with it; GET /jobs/{id} reports its status and result. Jobs run at
+least once: a job whose worker died mid-run is retried once its lease lapses. A payload (which may hold
+user data such as the emails of an import) is erased as soon as no attempt can need it again: when
+the last attempt is claimed, and when the job finishes
+"""
+import argparse
+import asyncio
+import os
+import random
+import signal
+import socket
+import sys
+import time
+import traceback
+from datetime import timedelta
+
+from sqlalchemy import case, delete, func, literal, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import metrics
+from app.config import get_settings
+from app.db import bulk, database, models
+from app.groups import service
+from app.users.service import get_password_hasher
+
+JOB_RUNS = metrics.Counter(
+    "jobs_total", "Background job attempts by kind and outcome (succeeded, retried, failed)", ["kind", "result"])
+JOB_DURATION = metrics.Histogram("job_duration_seconds", "Background job attempt duration by kind", ["kind"])
+
+# Job kind -> coroutine function (db, payload) returning a JSON-serializable result
+HANDLERS = {}
+# What a payload is replaced with once no attempt can need it
+ERASED = literal({}, models.Job.payload.type)
+
+
+def handler(kind: str):
+    """ Register the decorated coroutine function as the handler of kind """
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+async def enqueue(db: AsyncSession, kind: str, payload: dict, user_id: int | None = None,
+                  max_attempts: int | None = None):
+    """ Queue a job and commit, so a worker can claim it at once; returns the job """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind {kind!r}")
+    job = models.Job(kind=kind, payload=payload, created_by=user_id,
+                     max_attempts=max_attempts or get_settings().job_max_attempts)
+    db.add(job)
+    await db.commit()
+    await db.refresh(job)
+    return job
+
+
+async def get_job(db: AsyncSession, job_id: int):
+    return await db.get(models.Job, job_id)
+
+
+async def get_jobs(db: AsyncSession, user_id: int, before_id: int | None = None, limit: int = 100):
+    """ Jobs a user enqueued, newest first; pass the last id seen as before_id for the next page """
+    query = select(models.Job).filter(models.Job.created_by == user_id)
+    if before_id is not None:
+        query = query.filter(models.Job.id < before_id)
+    return (await db.scalars(query.order_by(models.Job.id.desc()).limit(limit))).all()
+
+
+def backoff(attempts: int, base: float, maximum: float):
+    """ Seconds before retrying after the attempts-th failure: exponential, capped, with jitter """
+    return min(maximum, base * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+class Worker:
+    """
+    Runs up to concurrency jobs at a time. Each slot loops: claim the oldest due job (the row lock is
+    skipped by other workers, so claims never wait on each other), run its handler in a session of its
+    own, record the outcome. The slot renews the job's lease while the handler runs; outcomes only land
+    while the lease is still the slot's, so a job taken over after a stall isn't finished twice
+    """
+
+    def __init__(self, concurrency: int, poll_interval: float, lease_seconds: float):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = timedelta(seconds=lease_seconds)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = None
+
+    async def claim(self, db: AsyncSession, slot: str):
+        """ Take the oldest queued job whose run_at has come; returns its row, or None if there is none """
+        due = (
+            select(models.Job.id, models.Job.payload)
+            .filter(models.Job.status == "queued", models.Job.run_at <= func.now())
+            .order_by(models.Job.run_at, models.Job.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .subquery()
+        )
+        last_attempt = models.Job.attempts + 1 >= models.Job.max_attempts
+        statement = (
+            update(models.Job)
+            .filter(models.Job.id == due.c.id)
+            .values(status="running", attempts=models.Job.attempts + 1, locked_by=slot,
+                    locked_until=func.now() + self.lease, started_at=func.now(),
+                    payload=case((last_attempt, ERASED), else_=models.Job.payload))
+            # The payload as claimed, from before it was erased
+            .returning(models.Job.id, models.Job.kind, due.c.payload, models.Job.attempts,
+                       models.Job.max_attempts)
+        )
+        job = (await db.execute(statement)).first()
+        await db.commit()
+        return job
+
+    async def _finish(self, job, slot: str, **values):
+        """ Record an outcome, unless the job's lease was lost to another worker meanwhile """
+        if values["status"] != "queued":
+            values["payload"] = ERASED
+        async with database.AsyncSessionLocal() as db:
+            await db.execute(
+                update(models.Job)
+                .filter(models.Job.id == job.id, models.Job.locked_by == slot, models.Job.status == "running")
+                .values(locked_by=None, locked_until=None, **values)
+            )
+            await db.commit()
+
+    async def _renew(self, job, slot: str):
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            try:
+                async with database.AsyncSessionLocal() as db:
+                    await db.execute(
+                        update(models.Job)
+                        .filter(models.Job.id == job.id, models.Job.locked_by == slot)
+                        .values(locked_until=func.now() + self.lease)
+                    )
+                    await db.commit()
+            except Exception:
+                # Next renewal retries; the lease outlasts a couple of missed ones
+                pass
+
+    async def _run(self, job, slot: str):
+        settings = get_settings()
+        function = HANDLERS.get(job.kind)
+        if function is None:
+            JOB_RUNS.inc(1, job.kind, "failed")
+            await self._finish(job, slot, status="failed", last_error=f"No handler for job kind {job.kind!r}",
+                               finished_at=func.now())
+            return
+        renewals = asyncio.create_task(self._renew(job, slot))
+        started = time.perf_counter()
+        try:
+            async with database.AsyncSessionLocal() as db:
+                result = await function(db, job.payload)
+        except asyncio.CancelledError:
+            # Shutting down mid-job: hand it back now, without using up an attempt, rather than once the
+            # lease lapses. Not on its last attempt though: it may have done part of its work (so isn't
+            # safe to run again, e.g. an import with max_attempts=1) and its payload is already erased
+            if job.attempts < job.max_attempts:
+                finish = self._finish(job, slot, status="queued", attempts=models.Job.attempts - 1,
+                                      run_at=func.now())
+            else:
+                JOB_RUNS.inc(1, job.kind, "failed")
+                finish = self._finish(job, slot, status="failed", last_error="Interrupted by worker shutdown",
+                                      finished_at=func.now())
+            await asyncio.shield(finish)
+            raise
+        except Exception as exc:
+            error = "".join(traceback.format_exception_only(exc)).strip()
+            if job.attempts < job.max_attempts:
+                JOB_RUNS.inc(1, job.kind, "retried")
+                delay = backoff(job.attempts, settings.job_backoff_base, settings.job_backoff_max)
+                await self._finish(job, slot, status="queued", last_error=error,
+                                   run_at=func.now() + timedelta(seconds=delay))
+            else:
+                JOB_RUNS.inc(1, job.kind, "failed")
+                await self._finish(job, slot, status="failed", last_error=error, finished_at=func.now())
+        else:
+            JOB_RUNS.inc(1, job.kind, "succeeded")
+            await self._finish(job, slot, status="succeeded", result=result, last_error=None,
+                               finished_at=func.now())
+        finally:
+            renewals.cancel()
+            JOB_DURATION.observe(time.perf_counter() - started, job.kind)
+
+    async def _idle(self):
+        """ Wait about poll_interval (jittered so idle workers don't poll in lockstep), or until stopped """
+        try:
+            await asyncio.wait_for(self.stopping.wait(), self.poll_interval * random.uniform(0.5, 1.5))
+        except TimeoutError:
+            pass
+
+    async def _slot(self, index: int):
+        slot = f"{self.name}:{index}"
+        while not self.stopping.is_set():
+            try:
+                async with database.AsyncSessionLocal() as db:
+                    job = await self.claim(db, slot)
+                if job is None:
+                    await self._idle()
+                else:
+                    await self._run(job, slot)
+            except Exception:
+                # Database unavailable: back off like an idle slot and try again
+                await self._idle()
+
+    async def reap(self):
+        """
+        Requeue running jobs whose lease lapsed (failing those out of attempts) and delete finished jobs past
+        job_retention_seconds; returns (requeued or failed, deleted)
+        """
+        retention = timedelta(seconds=get_settings().job_retention_seconds)
+        exhausted = models.Job.attempts >= models.Job.max_attempts
+        async with database.AsyncSessionLocal() as db:
+            lapsed = await db.execute(
+                update(models.Job)
+                .filter(models.Job.status == "running", models.Job.locked_until < func.now())
+                .values(status=case((exhausted, "failed"), else_="queued"),
+                        finished_at=case((exhausted, func.now()), else_=None),
+                        payload=case((exhausted, ERASED), else_=models.Job.payload),
+                        last_error="Worker lost the job's lease (crashed or stalled)",
+                        locked_by=None, locked_until=None, run_at=func.now())
+            )
+            purged = await db.execute(delete(models.Job).filter(models.Job.finished_at < func.now() - retention))
+            await db.commit()
+        return lapsed.rowcount, purged.rowcount
+
+    async def _reaps(self):
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 2)
+            try:
+                await self.reap()
+            except Exception:
+                pass
+
+    async def run(self):
+        """ Work jobs until stop() is called; jobs in progress are finished first """
+        self.stopping = asyncio.Event()
+        reaps = asyncio.create_task(self._reaps())
+        try:
+            await asyncio.gather(*(self._slot(index) for index in range(self.concurrency)))
+        finally:
+            reaps.cancel()
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+
+
+@handler("import_users")
+async def import_users(db: AsyncSession, payload: dict):
+    rows = [tuple(row) for row in payload["rows"]]
+    result = await bulk.import_users(db, rows, batch_size=get_settings().import_batch_size, hashed=True)
+    return result.model_dump(mode="json")
+
+
+@handler("import_groups")
+async def import_groups(db: AsyncSession, payload: dict):
+    rows = [tuple(row) for row in payload["rows"]]
+    result = await bulk.import_groups(db, rows, batch_size=get_settings().import_batch_size)
+    return result.model_dump(mode="json")
+
+
+@handler("verify_balances")
+async def verify_balances(db: AsyncSession, payload: dict):
+    drift = await service.verify_balances(db, group_id=payload["group_id"], repair=payload["repair"])
+    return [row.model_dump(mode="json") for row in drift]
+
+
+def create_worker(concurrency: int):
+    settings = get_settings()
+    return Worker(concurrency, poll_interval=settings.job_poll_interval, lease_seconds=settings.job_lease_seconds)
+
+
+async def main(concurrency: int):
+    worker = create_worker(concurrency)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, worker.stop)
+    print(f"Worker {worker.name}: {concurrency} slot(s) for {', '.join(sorted(HANDLERS))}")
+    try:
+        await worker.run()
+    finally:
+        get_password_hasher().shutdown()
+        await database.dispose_async_engines()
+    print(f"Worker {worker.name} stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=get_settings().job_concurrency,
+                        help="jobs run at a time (default: JOB_CONCURRENCY)")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.concurrency)))
@@ -1,26 +1,73 @@
 """ Main module of FastaAPI backend """
-from typing import Annotated
+from typing import Annotated, Literal
 
+import asyncio
 import time
+from contextlib import asynccontextmanager
 
-from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
-from sqlalchemy.orm import Session
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.cache import get_response_cache
+from app.config import get_settings
+from app.db import async_crud, database, schemas
+from app.db.pagination import decode_cursor, set_next_cursor
+from app.groups.stream import get_group_hub
+from app.idempotency import get_idempotency_store, token_caller
+from app.ratelimit import login_rate_limit
+from app.responses import FastJSONResponse, model_response
+from app.utils import oauth2_scheme, get_async_db, get_async_read_db, get_current_user
+from app.users.service import get_password_hasher
+from app import jobs, metrics, routers
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Per worker startup and shutdown. The schema is managed by Alembic (alembic upgrade head),
+    so nothing here touches the database except the replica health checks, idempotency key purges,
+    the live stream listener (started by the first subscriber) and, if job_in_process_concurrency is set,
+    a background job worker
+    """
+    settings = get_settings()
+    replicas = database.replicas
+    health_checks = None
+    if replicas.engines:
+        interval = settings.replica_health_check_seconds
+        # First check before serving so replicas that are down at boot never get traffic
+        await replicas.check(timeout=interval)
+        health_checks = asyncio.create_task(replicas.run_health_checks(interval))
+    purges = asyncio.create_task(get_idempotency_store().run_purges(settings.idempotency_purge_seconds))
+    worker = worker_task = None
+    if settings.job_in_process_concurrency:
+        worker = jobs.create_worker(settings.job_in_process_concurrency)
+        worker_task = asyncio.create_task(worker.run())
+    yield
+    if worker is not None:
+        # Jobs still running are handed back to the queue for another worker
+        worker.stop()
+        worker_task.cancel()
+        await asyncio.gather(worker_task, return_exceptions=True)
+    purges.cancel()
+    # Ends the live group streams too
+    await get_group_hub().close()
+    if health_checks is not None:
+        health_checks.cancel()
+    get_password_hasher().shutdown()
+    await database.dispose_async_engines()
 
-from app.db import crud, models, schemas
-from app.db.database import engine
-from app.utils import oauth2_scheme, verify_password, get_db, get_current_user
-from app import routers
-
-# Bind models to engine and create it
-models.Base.metadata.create_all(bind=engine)
 
 # instantiate the FastAPI app
 # access docs with /docs or /redoc
 # Possible next + fastapi: https://github.com/digitros/nextjs-fastapi
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 # CORS: for production make sure allow_origins only allows the frontend of http://localhost:8080
 origins = ["http://localhost:3000", "http://payment-frontend:3000"]
@@ -31,44 +78,87 @@ app.add_middleware(CORSMiddleware,
     expose_headers=["*"], 
     allow_credentials=True,)
 
+# Outermost so it times everything, CORS included
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    """
+    FastAPI's 422, encoded with orjson: the rejected input is echoed back, and json.dumps refuses the
+    NaN or Infinity of a body like {"value": NaN}, turning the 422 into a 500
+    """
+    return FastJSONResponse(status_code=422, content={"detail": jsonable_encoder(exc.errors())})
+
+# Cursor key (value types and how to read it off a row) for each /groups/ sort
+GROUP_CURSOR_TYPES = {"id": (int,), "name": (str, int)}
+GROUP_CURSOR_KEYS = {
+    "id": lambda group: [group.id],
+    "name": lambda group: [group.name, group.id],
+}
+
 app.include_router(routers.auth.router)
 app.include_router(routers.users.router)
 app.include_router(routers.groups.router)
+app.include_router(routers.fx.router)
+app.include_router(routers.jobs.router)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    """ Prometheus scrape endpoint """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 
-# @app.middleware("http")
-# async def add_process_time_header(request: Request, call_next):
-#     start_time = time.time()
-#     response = await call_next(request)
-#     process_time = time.time() - start_time
-#     response.headers["X-Process-Time"] = str(process_time)
-#     return response
+@app.get("/ready")
+async def read_ready():
+    """
+    Readiness probe: 503 until a connection from the pool answers SELECT 1 in time, so a worker whose
+    database is down or whose pool is exhausted is taken out of the load balancer
+    """
+    try:
+        async with asyncio.timeout(get_settings().readiness_timeout):
+            async with database.async_engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+    except Exception:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    pool = database.async_engine.pool
+    return {"status": "ready", "pool": {"size": pool.size(), "checked_out": pool.checkedout(), "overflow": pool.overflow()}}
 
 
-@app.get("/users/me")
+@app.get("/users/me", response_model=schemas.UserModel)
 async def read_users_me(current_user: Annotated[schemas.UserModel, Depends(get_current_user)]):
-    return current_user
+    return model_response(schemas.UserModel, current_user)
 
 
 @app.get("/")
 async def read_root():
     return {"message": "Hello World"}
 
+# Send an Idempotency-Key header to make retries safe: a repeated key replays the first response
 @app.post("/users/", response_model=schemas.UserModel)
-# SQLAlchemy doesn't have support for db_user = await so these must be declared as def
-def create_user(token: Annotated[str, Depends(oauth2_scheme)], user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if db_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
-
-@app.post("/login")
-def login_user(user: schemas.UserLogin, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
+async def create_user(
+    request: Request,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    user: schemas.UserCreate,
+    idempotency_key: Annotated[str | None, Header(max_length=255)] = None,
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    async def create():
+        db_user = await async_crud.get_user_by_email(db, email=user.email, load_groups="none")
+        if db_user:
+            raise HTTPException(status_code=400, detail="Email already registered")
+        return await async_crud.create_user(db=db, user=user, commit=False)
+    return await get_idempotency_store().run(db, request, idempotency_key, token_caller(token), schemas.UserModel,
+                                             create, invalidates=("users",))
+
+@app.post("/login", dependencies=[Depends(login_rate_limit)])
+async def login_user(user: schemas.UserLogin, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.get_user_by_email(db, email=user.email, load_groups="none")
     if db_user is None:
         raise HTTPException(status_code=404, detail="Incorrect email or password")
-    if not verify_password(plain_password=user.password, hashed_password=db_user.hashed_password):
+    if not await get_password_hasher().verify(user.password, db_user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect email or password")
-    encoded_jwt = jwt.encode
     return {"message": "Login successful"}
 
 
@@ -76,25 +166,61 @@ def login_user(user: schemas.UserLogin, db: Session = Depends(get_db)):
 # Add a token here dependent on oauth2; dependency provides a string assigned to parameter token of path operation function
 # Will look for authorization header, check if has Bearer token, return token as str
 # Will return 401 unauthorized directly if no token
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
-    return users
+# Pass the X-Next-Cursor header of the previous page as cursor to page by keyset instead of skip
+async def read_users(request: Request, response: Response, skip: int = 0, limit: int = 100, cursor: str | None = None, db: AsyncSession = Depends(get_async_read_db)):
+    # User responses embed their groups, so they go stale on group writes too
+    cached = await get_response_cache().get(request, ("users", "groups"))
+    if cached is not None:
+        return cached
+    after_id = None
+    if cursor is not None:
+        after_id, = decode_cursor(cursor, sort="id", types=(int,))
+    users = await async_crud.get_users(db, skip=skip, limit=limit, after_id=after_id)
+    set_next_cursor(response, users, limit, sort="id", key=lambda user: [user.id])
+    return await get_response_cache().set(request, list[schemas.UserModel], users, response)
 
 
 @app.get("/users/{user_id}", response_model=schemas.UserModel)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    user = crud.get_user(db, user_id=user_id)
+async def read_user(request: Request, user_id: int, db: AsyncSession = Depends(get_async_read_db)):
+    cached = await get_response_cache().get(request, ("users", "groups"))
+    if cached is not None:
+        return cached
+    user = await async_crud.get_user(db, user_id=user_id)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    return await get_response_cache().set(request, schemas.UserModel, user)
 
 
 @app.post("/users/{user_id}/groups/", response_model=schemas.GroupModel)
-def create_group_for_user(user_id: int, group: schemas.GroupCreate, db: Session = Depends(get_db)):
-    return crud.create_user_group(db=db, group=group, user_id=user_id)
+async def create_group_for_user(
+    request: Request,
+    user_id: int,
+    group: schemas.GroupCreate,
+    idempotency_key: Annotated[str | None, Header(max_length=255)] = None,
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    return await get_idempotency_store().run(
+        db, request, idempotency_key, f"user:{user_id}", schemas.GroupModel,
+        lambda: async_crud.create_user_group(db=db, group=group, user_id=user_id, commit=False),
+        invalidates=("groups",))
 
 
 @app.get("/groups/", response_model=list[schemas.GroupModel])
-def read_groups(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    groups = crud.get_groups(db, skip=skip, limit=limit)
-    return groups
\ No newline at end of file
+async def read_groups(
+    request: Request,
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    sort: Literal["id", "name"] = "id",
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_async_read_db)
+    ):
+    cached = await get_response_cache().get(request, ("groups",))
+    if cached is not None:
+        return cached
+    after = None
+    if cursor is not None:
+        after = decode_cursor(cursor, sort=sort, types=GROUP_CURSOR_TYPES[sort])
+    groups = await async_crud.get_groups(db, skip=skip, limit=limit, sort=sort, after=after)
+    set_next_cursor(response, groups, limit, sort=sort, key=GROUP_CURSOR_KEYS[sort])
+    return await get_response_cache().set(request, list[schemas.GroupModel], groups, response)
@@ -0,0 +1,276 @@
+""" Request, database and password hashing instrumentation, exposed in Prometheus text format """
+import threading
+import time
+from contextvars import ContextVar
+
+from anyio.to_thread import current_default_thread_limiter, run_sync
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric registers itself here so render() can output them all
+REGISTRY = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """ Monotonic counter with optional labels """
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, (), value) for labels, value in self._values.items()]
+
+
+class Histogram:
+    """ Cumulative histogram with optional labels """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            counts = self._values.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        samples = []
+        for labels, counts in values.items():
+            for bound, count in zip(self.buckets, counts):
+                samples.append((f"{self.name}_bucket", labels, (("le", repr(float(bound))),), count))
+            samples.append((f"{self.name}_bucket", labels, (("le", "+Inf"),), counts[len(self.buckets)]))
+            samples.append((f"{self.name}_count", labels, (), counts[len(self.buckets)]))
+            samples.append((f"{self.name}_sum", labels, (), counts[-1]))
+        return samples
+
+
+class Gauge:
+    """ Point-in-time value read from a callback at scrape time; the callback returns {labels: value} """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        REGISTRY.append(self)
+
+    def samples(self):
+        if self.collect is None:
+            return []
+        return [(self.name, labels, (), value) for labels, value in self.collect().items()]
+
+
+def render():
+    """ All registered metrics in the Prometheus text exposition format """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, extra, value in metric.samples():
+            lines.append(f"{name}{_format_labels(metric.labelnames, labels, extra)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Request latency by route", ["method", "route", "status"])
+REQUEST_DB_STATEMENTS = Histogram(
+    "http_request_db_statements", "SQL statements executed per request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Time spent executing SQL per request", ["route"])
+REQUEST_PASSWORD_HASH_SECONDS = Histogram(
+    "http_request_password_hash_seconds", "Time spent waiting on bcrypt per request", ["route"])
+DB_STATEMENTS = Counter("db_statements_total", "SQL statements executed")
+DB_STATEMENT_SECONDS = Histogram("db_statement_duration_seconds", "SQL statement latency")
+PASSWORD_HASH_SECONDS = Histogram(
+    "password_hash_duration_seconds", "bcrypt call latency including process pool queueing", ["operation"])
+
+THREADPOOL_THREADS_IN_USE = Gauge(
+    "threadpool_threads_in_use", "Worker threads busy with sync routes/dependencies and to_thread() calls",
+    collect=lambda: {(): current_default_thread_limiter().borrowed_tokens})
+THREADPOOL_TASKS_WAITING = Gauge(
+    "threadpool_tasks_waiting", "Sync calls queued waiting for a free worker thread",
+    collect=lambda: {(): current_default_thread_limiter().statistics().tasks_waiting})
+THREADPOOL_QUEUE_SECONDS = Histogram(
+    "threadpool_queue_wait_seconds", "Time to_thread() calls waited for a free worker thread")
+
+# Instrumented engines by name; their pool is looked up on collection since dispose() replaces it
+_engines = {}
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_connections_checked_out", "Connections currently in use", ["engine"],
+    collect=lambda: {(name,): engine.pool.checkedout() for name, engine in _engines.items()})
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow", "Connections open beyond pool_size (negative when the pool isn't full yet)", ["engine"],
+    collect=lambda: {(name,): engine.pool.overflow() for name, engine in _engines.items()})
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_seconds", "Time to get a connection from the pool (waiting for one, connecting, pinging)",
+    ["engine"])
+
+
+class RequestStats:
+    """ Work attributed to the request currently being handled """
+
+    def __init__(self):
+        self.db_statements = 0
+        self.db_seconds = 0.0
+        self.password_hash_seconds = 0.0
+
+
+_request_stats: ContextVar[RequestStats | None] = ContextVar("request_stats", default=None)
+
+
+def observe_password_hash(operation: str, seconds: float):
+    """ Record a bcrypt hash/verify call, and charge it to the current request """
+    PASSWORD_HASH_SECONDS.observe(seconds, operation)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.password_hash_seconds += seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["query_start_time"].pop()
+    DB_STATEMENTS.inc()
+    DB_STATEMENT_SECONDS.observe(seconds)
+    # SQLAlchemy runs async engine events in a greenlet that shares the request's context
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.db_statements += 1
+        stats.db_seconds += seconds
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute; drop its start time
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_start_time"):
+        connection.info["query_start_time"].pop()
+
+
+async def to_thread(function, *args):
+    """ Run function(*args) in the worker threadpool, recording how long it waited for a thread """
+    submitted = time.perf_counter()
+
+    def timed():
+        THREADPOOL_QUEUE_SECONDS.observe(time.perf_counter() - submitted)
+        return function(*args)
+
+    return await run_sync(timed)
+
+
+def _timed_pool_class(pool_class, name: str):
+    """ Subclass of pool_class observing checkout time; dispose() recreates pools with the same class """
+    class TimedPool(pool_class):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                return super().connect()
+            finally:
+                DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - start, name)
+
+    return TimedPool
+
+
+def instrument_engine(engine, name: str):
+    """
+    Count statements and time spent in SQL on an engine (sync or async), and report its pool usage and
+    checkout time
+    """
+    engine = getattr(engine, "sync_engine", engine)
+    _engines[name] = engine
+    # No pool event fires before a checkout starts, so its connect() is timed instead
+    engine.pool.__class__ = _timed_pool_class(type(engine.pool), name)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, SQL statements, DB time and bcrypt time per route.
+    Also adds a Server-Timing header so a single slow response shows where its time went
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = {}
+
+    def _route_name(self, scope):
+        # Label by route template rather than raw path to keep the number of series bounded
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if endpoint not in self._routes:
+            router = scope["app"].router
+            paths = [route.path for route in router.routes if getattr(route, "endpoint", None) is endpoint]
+            self._routes[endpoint] = paths[0] if paths else "unmatched"
+        return self._routes[endpoint]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timing = (
+                    f"db;dur={stats.db_seconds * 1000:.1f}, "
+                    f"hash;dur={stats.password_hash_seconds * 1000:.1f}, "
+                    f"total;dur={(time.perf_counter() - start) * 1000:.1f}"
+                )
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_stats.reset(token)
+            route = self._route_name(scope)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], route, status)
+            REQUEST_DB_STATEMENTS.observe(stats.db_statements, route)
+            REQUEST_DB_SECONDS.observe(stats.db_seconds, route)
+            REQUEST_PASSWORD_HASH_SECONDS.observe(stats.password_hash_seconds, route)
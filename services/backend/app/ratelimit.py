@@ -0,0 +1,244 @@
+""" Token bucket rate limiting for the credential endpoints, per client IP and per email """
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import cached_property, lru_cache
+
+from fastapi import HTTPException, Request, Response, status
+
+from app import metrics
+from app.cache import RedisBackend
+from app.config import get_settings
+
+RATE_LIMIT_REQUESTS = metrics.Counter(
+    "rate_limit_requests_total", "Rate limited route calls by limiter and outcome (allowed, limited)",
+    ["limiter", "result"])
+RATE_LIMIT_ERRORS = metrics.Counter(
+    "rate_limit_errors_total", "Shared rate limit backend calls that failed and fell back to the local buckets")
+
+
+class MemoryBackend:
+    """
+    Per-process token buckets, split over shards that each have their own lock and LRU, so concurrent
+    callers rarely wait on each other and a flood of distinct keys (spoofed emails) evicts the
+    longest idle buckets instead of growing without bound
+    """
+    blocking = False
+
+    def __init__(self, shards: int, max_keys: int):
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._max_keys = max(1, max_keys // shards)
+
+    def _shard_index(self, key: str):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=4).digest(), "big") % len(self._shards)
+
+    def take(self, buckets: list[tuple[str, float, float]], cost: float = 1.0):
+        """
+        Take cost tokens from every (key, rate, capacity) bucket if they all have them, from none otherwise;
+        returns (allowed, tokens left in each)
+        """
+        indexes = [self._shard_index(key) for key, _, _ in buckets]
+        # Locked in shard order, so two calls over the same shards can't deadlock
+        locks = [self._locks[index] for index in sorted(set(indexes))]
+        now = time.monotonic()
+        for lock in locks:
+            lock.acquire()
+        try:
+            levels = []
+            for (key, rate, capacity), index in zip(buckets, indexes):
+                tokens, updated = self._shards[index].get(key, (capacity, now))
+                levels.append(min(capacity, tokens + (now - updated) * rate))
+            allowed = all(tokens >= cost for tokens in levels)
+            if allowed:
+                levels = [tokens - cost for tokens in levels]
+            for (key, _, _), index, tokens in zip(buckets, indexes, levels):
+                shard = self._shards[index]
+                shard[key] = (tokens, now)
+                shard.move_to_end(key)
+                while len(shard) > self._max_keys:
+                    shard.popitem(last=False)
+        finally:
+            for lock in locks:
+                lock.release()
+        return allowed, levels
+
+    def clear(self):
+        for buckets, lock in zip(self._shards, self._locks):
+            with lock:
+                buckets.clear()
+
+    def after_fork(self):
+        self._locks = [threading.Lock() for _ in self._shards]
+
+
+# Same algorithm as MemoryBackend.take, run atomically on the server. ARGV: now, cost, then rate and
+# capacity of each bucket in KEYS. Bucket: hash of tokens and last update time; it expires once it
+# would be full again, so idle keys cost no memory
+TAKE_SCRIPT = """
+local now, cost = tonumber(ARGV[1]), tonumber(ARGV[2])
+local levels, allowed = {}, 1
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local rate, capacity = tonumber(ARGV[2 * i + 1]), tonumber(ARGV[2 * i + 2])
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    levels[i] = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    if levels[i] < cost then
+        allowed = 0
+    end
+end
+local result = {allowed}
+for i, key in ipairs(KEYS) do
+    local rate, capacity = tonumber(ARGV[2 * i + 1]), tonumber(ARGV[2 * i + 2])
+    local tokens = levels[i] - cost * allowed
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil((capacity - tokens) / rate * 1000) + 1000)
+    result[i + 1] = tostring(tokens)
+end
+return result
+"""
+TAKE_SCRIPT_SHA = hashlib.sha1(TAKE_SCRIPT.encode()).hexdigest()
+
+
+class SharedBackend:
+    """
+    Buckets shared by every worker and node, on any server speaking the Redis protocol (one script call
+    per check, covering all of its buckets). If the server can't be reached, checks fall back to the per-process buckets so the
+    endpoints stay protected, only less precisely, rather than failing or going unlimited. The client
+    blocks on its socket, so the limiter runs checks in a thread
+    """
+    blocking = True
+
+    def __init__(self, url: str, timeout: float, fallback: MemoryBackend):
+        self.client = RedisBackend(url, timeout=timeout)
+        self.fallback = fallback
+
+    def _take(self, buckets: list[tuple[str, float, float]], cost: float):
+        args = (len(buckets), *(f"ratelimit:{key}" for key, _, _ in buckets), f"{time.time():.6f}", cost,
+                *(value for _, rate, capacity in buckets for value in (rate, capacity)))
+        try:
+            allowed, *levels = self.client.command("EVALSHA", TAKE_SCRIPT_SHA, *args)
+        except RuntimeError as exc:
+            if not str(exc).startswith("NOSCRIPT"):
+                raise
+            allowed, *levels = self.client.command("EVAL", TAKE_SCRIPT, *args)
+        return bool(allowed), [float(tokens) for tokens in levels]
+
+    def take(self, buckets: list[tuple[str, float, float]], cost: float = 1.0):
+        try:
+            return self._take(buckets, cost)
+        except Exception:
+            RATE_LIMIT_ERRORS.inc()
+            return self.fallback.take(buckets, cost)
+
+    def clear(self):
+        self.fallback.clear()
+
+    def after_fork(self):
+        self.client.after_fork()
+        self.fallback.after_fork()
+
+
+class Limit:
+    """ A bucket size (burst) and how fast it refills (per_minute) """
+
+    def __init__(self, burst: int, per_minute: float):
+        self.capacity = float(burst)
+        self.rate = per_minute / 60.0
+
+
+async def email_from_body(request: Request):
+    """ The email a credential request is for: username of the OAuth2 form, or email of a JSON body """
+    try:
+        if request.headers.get("content-type", "").startswith("application/json"):
+            email = (await request.json()).get("email")
+        else:
+            email = (await request.form()).get("username")
+    except Exception:
+        return None
+    return email.strip().lower() if isinstance(email, str) else None
+
+
+class RateLimit:
+    """
+    Dependency limiting a group of routes per client IP and per email with token buckets. Allowed
+    calls get RateLimit-Limit/Remaining/Reset headers for the tightest bucket; the rest are refused
+    with a 429 and Retry-After before any password is hashed or verified
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @cached_property
+    def limits(self):
+        """ Bucket of each scope, from the settings on first use """
+        settings = get_settings()
+        return {
+            "ip": Limit(settings.rate_limit_ip_burst, settings.rate_limit_ip_per_minute),
+            "email": Limit(settings.rate_limit_email_burst, settings.rate_limit_email_per_minute),
+        }
+
+    async def __call__(self, request: Request, response: Response):
+        limiter_backend = get_limiter_backend()
+        if limiter_backend is None:
+            return
+        # request.client is the peer address; behind a proxy, run the server with forwarded_allow_ips
+        # set so it's the address from X-Forwarded-For instead of the proxy's
+        keys = {"ip": request.client.host if request.client else None, "email": await email_from_body(request)}
+        scopes = [(scope, value) for scope, value in keys.items() if value is not None]
+        if not scopes:
+            RATE_LIMIT_REQUESTS.inc(1, self.name, "allowed")
+            return
+        limits = [self.limits[scope] for scope, _ in scopes]
+        # All buckets are checked before any is charged: a request refused by one costs the others nothing
+        buckets = [(f"{self.name}:{scope}:{value}", limit.rate, limit.capacity)
+                   for (scope, value), limit in zip(scopes, limits)]
+        if limiter_backend.blocking:
+            allowed, levels = await metrics.to_thread(limiter_backend.take, buckets)
+        else:
+            allowed, levels = limiter_backend.take(buckets)
+        if not allowed:
+            RATE_LIMIT_REQUESTS.inc(1, self.name, "limited")
+            # The empty bucket that refills last decides when a retry can pass
+            limit, tokens = max(((limit, tokens) for limit, tokens in zip(limits, levels) if tokens < 1.0),
+                                key=lambda pair: (1.0 - pair[1]) / pair[0].rate)
+            retry_after = math.ceil((1.0 - tokens) / limit.rate)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many attempts, try again later",
+                headers={**_headers(limit, tokens), "Retry-After": str(retry_after)},
+            )
+        RATE_LIMIT_REQUESTS.inc(1, self.name, "allowed")
+        response.headers.update(_headers(*min(zip(limits, levels), key=lambda pair: pair[1] / pair[0].capacity)))
+
+
+def _headers(limit: Limit, tokens: float):
+    return {
+        "RateLimit-Limit": str(int(limit.capacity)),
+        "RateLimit-Remaining": str(int(tokens)),
+        # Seconds until the bucket is full again
+        "RateLimit-Reset": str(math.ceil((limit.capacity - tokens) / limit.rate)),
+    }
+
+
+def create_backend(settings):
+    if settings.rate_limit_backend == "off":
+        return None
+    memory = MemoryBackend(shards=settings.rate_limit_shards, max_keys=settings.rate_limit_max_keys)
+    if settings.rate_limit_backend == "redis":
+        return SharedBackend(settings.rate_limit_url, timeout=settings.rate_limit_timeout, fallback=memory)
+    return memory
+
+
+@lru_cache
+def get_limiter_backend():
+    """ The process's bucket backend (None if limiting is off), created from the settings on first use """
+    return create_backend(get_settings())
+
+
+# /token and /login check the same credentials, so they share buckets: alternating doesn't double the budget
+login_rate_limit = RateLimit("login")
+reset_rate_limit = RateLimit("reset")
@@ -0,0 +1,33 @@
+""" Fast JSON responses: serialize schemas in one pydantic-core pass instead of validate, encode, dump """
+from functools import lru_cache
+
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+from pydantic import TypeAdapter
+
+# Default response class of the app: plain dict/list results are encoded with orjson instead of json.dumps
+FastJSONResponse = ORJSONResponse
+
+
+@lru_cache
+def type_adapter(type_):
+    """ TypeAdapter for a schema type (e.g. list[UserModel]); building one is costly, so they are reused """
+    return TypeAdapter(type_)
+
+
+def dump_json(type_, content):
+    """
+    Validate content (ORM objects or schema instances) as type_ and dump it to JSON bytes, in Rust.
+    Schema instances aren't revalidated, so already built models cost only the dump
+    """
+    adapter = type_adapter(type_)
+    return adapter.dump_json(adapter.validate_python(content))
+
+
+def model_response(type_, content, status_code: int = 200, headers: dict | None = None):
+    """
+    Response with content serialized as type_. Returning it from a route skips FastAPI's response_model
+    round trip (validate, dump to Python, encode again); keep response_model on the route for the docs
+    """
+    return Response(content=dump_json(type_, content), status_code=status_code,
+                    headers=headers, media_type="application/json")
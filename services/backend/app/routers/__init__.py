@@ -0,0 +1 @@
+from . import auth, fx, groups, jobs, users
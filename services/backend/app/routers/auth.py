@@ -3,35 +3,36 @@ from typing import Annotated
 
 from fastapi import APIRouter, HTTPException, Depends, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from app.utils import get_db, create_access_token, Token
-from app.db import crud, schemas
-from sqlalchemy.orm import Session
+from app.utils import get_async_db, create_access_token, Token
+from app.db import async_crud, schemas
+from app.ratelimit import login_rate_limit, reset_rate_limit
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 router = APIRouter()
 
-@router.post("/reset/", response_model=schemas.UserModel)
-def reset_user(user_reset: schemas.UserReset, db: Session = Depends(get_db)):
+@router.post("/reset/", response_model=schemas.UserModel, dependencies=[Depends(reset_rate_limit)])
+async def reset_user(user_reset: schemas.UserReset, db: AsyncSession = Depends(get_async_db)):
     """ Route to send user password reset request to update database """
     if not user_reset.password == user_reset.confirm_password:
         raise HTTPException(status_code=400, detail="Passwords do not match")
-    user = crud.reset_user_password(db, email=user_reset.email, password=user_reset.password)
+    user = await async_crud.reset_user_password(db, email=user_reset.email, password=user_reset.password)
     if not user:
         raise HTTPException(status_code=400, detail="Cannot reset password")
     return user
 
 
 # Path to create a jwt token and return it
-@router.post("/token", response_model=Token)
+@router.post("/token", response_model=Token, dependencies=[Depends(login_rate_limit)])
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
     ):
     """
     Login/token: Pass in OAuth2PasswordRequestForm with username and password. 
     Return with access token after validating in the database
     """
-    user = crud.authenticate_user_by_email(db, form_data.username, form_data.password)
+    user = await async_crud.authenticate_user_by_email(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,34 @@
+""" Routes for FX rates """
+from datetime import date
+from typing import Annotated
+
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import schemas
+from app.groups import fx
+from app.groups import schemas as group_schemas
+from app.responses import model_response
+from app.utils import get_async_db, get_async_read_db, get_current_admin_user
+
+router = APIRouter()
+
+
+@router.get("/fx/rates", response_model=list[group_schemas.FxRateModel])
+async def read_rates(as_of: date | None = None, db: AsyncSession = Depends(get_async_read_db)):
+    """ Latest rate of every currency on as_of (default: today) """
+    rates = await fx.get_latest_rates(db, as_of or date.today())
+    return model_response(list[group_schemas.FxRateModel], rates)
+
+
+@router.put("/fx/rates")
+async def load_rates(
+    rates: list[group_schemas.FxRateModel],
+    current_user: Annotated[schemas.UserModel, Depends(get_current_admin_user)],
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """
+    Insert or replace rates. Stored balances aren't recomputed: after replacing the rate of a day that
+    already has expenses, run python -m app.groups.verify_balances --repair
+    """
+    return {"loaded": await fx.save_rates(db, [rate.model_dump() for rate in rates])}
@@ -1,3 +1,320 @@
-from fastapi import APIRouter
+""" Routes for groups """
+from datetime import datetime
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import jobs
+from app.config import get_settings
+from app.db import bulk, export, schemas
+from app.groups import schemas as group_schemas
+from app.groups import fx, service, stream
+from app.responses import model_response
+from app.routers.jobs import accepted
+from app.utils import get_async_db, get_async_read_db, get_current_active_user
 
 router = APIRouter()
+
+MANAGER_ROLES = (group_schemas.MemberRole.owner.value, group_schemas.MemberRole.admin.value)
+
+
+async def require_member(db: AsyncSession, group_id: int, user_id: int, roles: tuple[str, ...] | None = None):
+    """ 404 if the group doesn't exist, 403 unless the user is a member (with one of roles, if given) """
+    role = await service.get_role(db, group_id, user_id)
+    if role is None and await service.get_group(db, group_id) is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    if role is None or (roles is not None and role not in roles):
+        raise HTTPException(status_code=403, detail="Not allowed in this group")
+    return role
+
+
+@router.post("/groups/import", response_model=schemas.ImportResult, responses={202: {"model": schemas.JobModel}})
+async def import_groups(
+    request: Request,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    background: bool = False,
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """
+    Bulk create groups from an NDJSON (application/x-ndjson) or CSV (text/csv) body
+    with name, description and owner_email. Valid rows are created, invalid ones are reported by line number.
+    With background=true a job imports them: the response is a 202 with the job
+    """
+    try:
+        rows = list(bulk.parse_rows(await request.body(), request.headers.get("content-type", "")))
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise HTTPException(status_code=415, detail=str(exc))
+    if background:
+        # Not retried: a second attempt would create the groups of already committed batches again
+        job = await jobs.enqueue(db, "import_groups", {"rows": rows}, user_id=current_user.id, max_attempts=1)
+        return accepted(job)
+    return await bulk.import_groups(db, rows, batch_size=get_settings().import_batch_size)
+
+
+@router.get("/groups/export")
+async def export_groups(
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    format: Literal["ndjson", "csv"] = "ndjson"
+    ):
+    """ Stream every group as NDJSON or CSV """
+    return export.export_response(export.groups_query(), format, "groups", get_settings().export_batch_size)
+
+
+@router.get("/groups/mine", response_model=list[group_schemas.MyGroupModel])
+async def read_my_groups(
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    db: AsyncSession = Depends(get_async_read_db)
+    ):
+    """ Groups the current user is a member of, with their role in each """
+    return model_response(list[group_schemas.MyGroupModel], await service.get_user_groups(db, user_id=current_user.id))
+
+
+@router.get("/groups/{group_id}/members", response_model=list[group_schemas.MemberModel])
+async def read_members(
+    group_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    db: AsyncSession = Depends(get_async_read_db)
+    ):
+    """ Members of a group with their roles; members only """
+    await require_member(db, group_id, current_user.id)
+    return model_response(list[group_schemas.MemberModel], await service.get_members(db, group_id=group_id))
+
+
+@router.post("/groups/{group_id}/members", response_model=group_schemas.MembersChanged)
+async def add_members(
+    group_id: int,
+    members: group_schemas.MembersAdd,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """ Add users to a group in one statement; owners and admins add members, only the owner adds admins """
+    role = await require_member(db, group_id, current_user.id, MANAGER_ROLES)
+    if members.role == group_schemas.MemberRole.owner:
+        raise HTTPException(status_code=400, detail="A group has a single owner")
+    if members.role == group_schemas.MemberRole.admin and role != group_schemas.MemberRole.owner.value:
+        raise HTTPException(status_code=403, detail="Only the owner can add admins")
+    added = await service.add_members(db, group_id=group_id, user_ids=members.user_ids, role=members.role)
+    return group_schemas.MembersChanged(user_ids=added)
+
+
+@router.delete("/groups/{group_id}/members", response_model=group_schemas.MembersChanged)
+async def remove_members(
+    group_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    user_ids: list[int] = Query(min_length=1, max_length=1000),
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """ Remove users from a group in one statement; the owner and members with an unsettled balance stay """
+    await require_member(db, group_id, current_user.id, MANAGER_ROLES)
+    removed = await service.remove_members(db, group_id=group_id, user_ids=user_ids)
+    return group_schemas.MembersChanged(user_ids=removed)
+
+
+@router.post("/groups/{group_id}/expenses", response_model=group_schemas.ExpenseModel)
+async def create_expense(
+    group_id: int,
+    expense: group_schemas.ExpenseCreate,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """ Add an expense to a group; shares are resolved to whole cents when it's stored """
+    await require_member(db, group_id, current_user.id)
+    try:
+        db_expense = await service.create_expense(db, group_id=group_id, expense=expense, created_by_id=current_user.id)
+    except (service.SplitError, fx.MissingRateError) as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return model_response(group_schemas.ExpenseModel, db_expense)
+
+
+@router.put("/groups/{group_id}/expenses/{expense_id}", response_model=group_schemas.ExpenseModel)
+async def update_expense(
+    group_id: int,
+    expense_id: int,
+    expense: group_schemas.ExpenseCreate,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """ Replace an expense's amount, payers and shares """
+    await require_member(db, group_id, current_user.id)
+    db_expense = await service.get_expense(db, group_id=group_id, expense_id=expense_id, for_update=True)
+    if db_expense is None:
+        raise HTTPException(status_code=404, detail="Expense not found")
+    try:
+        db_expense = await service.update_expense(db, db_expense=db_expense, expense=expense, user_id=current_user.id)
+    except (service.SplitError, fx.MissingRateError) as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return model_response(group_schemas.ExpenseModel, db_expense)
+
+
+@router.delete("/groups/{group_id}/expenses/{expense_id}", status_code=204)
+async def delete_expense(
+    group_id: int,
+    expense_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    await require_member(db, group_id, current_user.id)
+    db_expense = await service.get_expense(db, group_id=group_id, expense_id=expense_id, for_update=True)
+    if db_expense is None:
+        raise HTTPException(status_code=404, detail="Expense not found")
+    await service.delete_expense(db, db_expense=db_expense, user_id=current_user.id)
+
+
+@router.get("/groups/{group_id}/expenses", response_model=list[group_schemas.ExpenseModel])
+async def read_expenses(
+    group_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    skip: int = 0,
+    limit: int = 100,
+    db: AsyncSession = Depends(get_async_read_db)
+    ):
+    await require_member(db, group_id, current_user.id)
+    expenses = await service.get_expenses(db, group_id=group_id, skip=skip, limit=limit)
+    return model_response(list[group_schemas.ExpenseModel], expenses)
+
+
+@router.get("/groups/{group_id}/expenses/export")
+async def export_ledger(
+    group_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    format: Literal["ndjson", "csv"] = "ndjson",
+    db: AsyncSession = Depends(get_async_read_db)
+    ):
+    """ Stream a group's ledger, one row per amount paid or owed on each expense, as NDJSON or CSV; members only """
+    try:
+        await require_member(db, group_id, current_user.id)
+    finally:
+        # The export reads on a connection of its own; don't hold this one until it's downloaded
+        await db.close()
+    return export.export_response(
+        export.ledger_query(group_id), format, f"group-{group_id}-ledger", get_settings().export_batch_size)
+
+
+@router.get("/groups/{group_id}/settlement", response_model=group_schemas.SettlementModel)
+async def read_settlement(
+    group_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    engine: Literal["auto", "exact", "greedy"] = "auto",
+    db: AsyncSession = Depends(get_async_read_db)
+    ):
+    """
+    Who owes whom: stored net balances plus the transfers that settle the group. engine=auto uses the
+    fewest transfers for groups small enough to solve exactly in time, the greedy planner otherwise
+    """
+    await require_member(db, group_id, current_user.id)
+    settlement = await service.get_settlement(db, group_id=group_id, engine=engine)
+    return model_response(group_schemas.SettlementModel, settlement)
+
+
+@router.post("/groups/{group_id}/settlements", response_model=group_schemas.LedgerEventModel)
+async def record_settlement(
+    group_id: int,
+    settlement: group_schemas.SettlementRecord,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """ Record that one member paid another back; moves both balances and is logged in the ledger """
+    await require_member(db, group_id, current_user.id)
+    try:
+        event = await service.record_settlement(db, group_id=group_id, settlement=settlement, user_id=current_user.id)
+    except service.SplitError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return model_response(group_schemas.LedgerEventModel, event)
+
+
+@router.post("/groups/{group_id}/balances/verify", status_code=202, response_model=schemas.JobModel)
+async def verify_balances(
+    group_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    repair: bool = False,
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """
+    Start a job rebuilding the group's balances from its ledger; its result lists the drifted balances,
+    which repair=true (owners and admins only) also corrects
+    """
+    await require_member(db, group_id, current_user.id, roles=MANAGER_ROLES if repair else None)
+    job = await jobs.enqueue(db, "verify_balances", {"group_id": group_id, "repair": repair}, user_id=current_user.id)
+    return accepted(job)
+
+
+@router.get("/groups/{group_id}/events", response_model=list[group_schemas.LedgerEventModel])
+async def read_events(
+    group_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    after_id: int = 0,
+    limit: int = 100,
+    db: AsyncSession = Depends(get_async_read_db)
+    ):
+    """ A group's ledger, oldest first; pass the last id seen as after_id for the next page """
+    await require_member(db, group_id, current_user.id)
+    events = await service.get_events(db, group_id=group_id, after_id=after_id, limit=limit)
+    return model_response(list[group_schemas.LedgerEventModel], events)
+
+
+# Reads from the primary, which has every event the notifications refer to. The session (the one
+# get_current_user used) is closed before streaming: left open it would hold a connection until the stream ends
+@router.get("/groups/{group_id}/stream")
+async def stream_group(
+    group_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    after_id: int | None = None,
+    last_event_id: Annotated[int | None, Header()] = None,
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """
+    Live ledger events of a group as server-sent events, for its members: "event" is the kind, "id" the event
+    id and "data" the event as /groups/{id}/events returns it, so balance deltas and expense details arrive
+    as they commit. A reconnecting client (EventSource sends Last-Event-ID, or pass after_id) first gets
+    what it missed
+    """
+    settings = get_settings()
+    try:
+        await require_member(db, group_id, current_user.id)
+    finally:
+        await db.close()
+    try:
+        subscriber = await stream.get_group_hub().subscribe(group_id, timeout=settings.readiness_timeout)
+    except TimeoutError:
+        raise HTTPException(status_code=503, detail="Live updates unavailable", headers={"Retry-After": "5"})
+    # Subscribed before reading what was missed, so nothing falls in between; duplicates are skipped
+    if last_event_id is not None:
+        after_id = last_event_id
+    missed = []
+    try:
+        if after_id is not None:
+            # One more than is replayed, to tell "exactly the limit missed" from "more than that"
+            missed = await service.get_events(db, group_id, after_id=after_id, limit=settings.stream_replay_limit + 1)
+    except BaseException:
+        stream.get_group_hub().unsubscribe(subscriber)
+        raise
+    finally:
+        await db.close()
+    reset = len(missed) > settings.stream_replay_limit
+    return StreamingResponse(
+        stream.events(subscriber, missed[:settings.stream_replay_limit], reset=reset),
+        media_type="text/event-stream",
+        # No caching, and no buffering by nginx style proxies
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/groups/{group_id}/balances", response_model=list[group_schemas.BalanceModel])
+async def read_balances(
+    group_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    as_of: datetime | None = None,
+    db: AsyncSession = Depends(get_async_read_db)
+    ):
+    """ Balances of every user in a group, now or as of a past time (replayed from the ledger) """
+    await require_member(db, group_id, current_user.id)
+    if as_of is None:
+        user_ids, balances = await service.get_balances(db, group_id)
+    else:
+        user_ids, balances = await service.get_balances_as_of(db, group_id, as_of)
+    return model_response(list[group_schemas.BalanceModel], [
+        group_schemas.BalanceModel(user_id=user, balance_cents=amount)
+        for user, amount in zip(user_ids.tolist(), balances.tolist())
+    ])
@@ -0,0 +1,42 @@
+""" Routes for background jobs """
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import jobs
+from app.db import models, schemas
+from app.responses import model_response
+from app.utils import get_async_db, get_current_active_user
+
+router = APIRouter()
+
+
+def accepted(job: models.Job):
+    """ 202 response for a route that handed its work to a job; poll Location for the outcome """
+    return model_response(schemas.JobModel, job, status_code=202, headers={"Location": f"/jobs/{job.id}"})
+
+
+@router.get("/jobs", response_model=list[schemas.JobModel])
+async def read_jobs(
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    before_id: int | None = None,
+    limit: int = 100,
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """ Jobs the current user started, newest first; pass the last id seen as before_id for the next page """
+    return model_response(list[schemas.JobModel], await jobs.get_jobs(db, current_user.id, before_id, limit))
+
+
+# Read from the primary: a job polled right after it was enqueued may not have reached a replica yet
+@router.get("/jobs/{job_id}", response_model=schemas.JobModel)
+async def read_job(
+    job_id: int,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """ Status of a job the current user started, with its result once it succeeded """
+    job = await jobs.get_job(db, job_id)
+    if job is None or job.created_by != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return model_response(schemas.JobModel, job)
@@ -0,0 +1,53 @@
+""" Access to the group routes: members only, 404 for unknown groups
+
+Run with: TEST_DATABASE_URL=postgresql://... python -m pytest app/routers
+"""
+import pytest
+
+from app.conftest import create_user
+
+# GET routes answering a member with a plain 200
+MEMBER_ROUTES = [
+    "/groups/{group_id}/members",
+    "/groups/{group_id}/expenses",
+    "/groups/{group_id}/settlement",
+    "/groups/{group_id}/expenses/export",
+    "/groups/{group_id}/events",
+    "/groups/{group_id}/balances",
+]
+# Only checked for refusals: for a member it streams until the client hangs up
+STREAM_ROUTE = "/groups/{group_id}/stream"
+
+
+@pytest.fixture
+def group(client):
+    """ (group, owner's headers, outsider's headers) """
+    owner, owner_headers = create_user(client, "owner")
+    _, outsider_headers = create_user(client, "outsider")
+    group = client.post(f"/users/{owner['id']}/groups/", json={"name": "Flat"}).json()
+    return group, owner_headers, outsider_headers
+
+
+@pytest.mark.parametrize("route", MEMBER_ROUTES + [STREAM_ROUTE])
+def test_member_routes_need_a_login(client, group, route):
+    group, _, _ = group
+    assert client.get(route.format(group_id=group["id"])).status_code == 401
+
+
+@pytest.mark.parametrize("route", MEMBER_ROUTES + [STREAM_ROUTE])
+def test_member_routes_refuse_outsiders(client, group, route):
+    group, _, outsider_headers = group
+    response = client.get(route.format(group_id=group["id"]), headers=outsider_headers)
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize("route", MEMBER_ROUTES)
+def test_member_routes_serve_members(client, group, route):
+    group, owner_headers, _ = group
+    assert client.get(route.format(group_id=group["id"]), headers=owner_headers).status_code == 200
+
+
+@pytest.mark.parametrize("route", MEMBER_ROUTES + [STREAM_ROUTE])
+def test_member_routes_404_for_unknown_groups(client, group, route):
+    _, owner_headers, _ = group
+    assert client.get(route.format(group_id=999999), headers=owner_headers).status_code == 404
@@ -1,3 +1,47 @@
-from fastapi import APIRouter
+""" Routes for users """
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import jobs
+from app.config import get_settings
+from app.db import bulk, export, schemas
+from app.routers.jobs import accepted
+from app.utils import get_async_db, get_current_active_user
 
 router = APIRouter()
+
+
+@router.post("/users/import", response_model=schemas.ImportResult, responses={202: {"model": schemas.JobModel}})
+async def import_users(
+    request: Request,
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    background: bool = False,
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """
+    Bulk create users from an NDJSON (application/x-ndjson) or CSV (text/csv) body with the UserCreate fields.
+    Valid rows are created, invalid ones are reported by line number. With background=true the rows are
+    imported by a job: the response is a 202 with the job, whose result is the import's outcome. Their
+    passwords are hashed before the job is queued, so the plaintext never reaches the jobs table
+    """
+    try:
+        rows = list(bulk.parse_rows(await request.body(), request.headers.get("content-type", "")))
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise HTTPException(status_code=415, detail=str(exc))
+    if background:
+        # Batches are committed as they go, so a retried import would report its own rows as taken
+        rows = await bulk.hash_passwords(rows)
+        job = await jobs.enqueue(db, "import_users", {"rows": rows}, user_id=current_user.id, max_attempts=1)
+        return accepted(job)
+    return await bulk.import_users(db, rows, batch_size=get_settings().import_batch_size)
+
+
+@router.get("/users/export")
+async def export_users(
+    current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)],
+    format: Literal["ndjson", "csv"] = "ndjson"
+    ):
+    """ Stream every user (without password hashes) as NDJSON or CSV """
+    return export.export_response(export.users_query(), format, "users", get_settings().export_batch_size)
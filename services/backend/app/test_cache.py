@@ -0,0 +1,38 @@
+""" Response cache: misses right after a write are filled from the primary
+
+Run with: python -m pytest app/test_cache.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+from starlette.requests import Request
+
+from app.cache import MemoryBackend, ResponseCache
+
+
+def request(read_db):
+    request = Request({"type": "http", "method": "GET", "path": "/groups/", "query_string": b"", "headers": []})
+    request.state.read_db = read_db
+    return request
+
+
+def test_miss_after_a_write_reads_the_primary():
+    cache = ResponseCache(MemoryBackend(max_entries=10), ttl=30, primary_seconds=60)
+    quiet, after_write = SimpleNamespace(info={"use_replica": True}), SimpleNamespace(info={"use_replica": True})
+
+    async def scenario():
+        assert await cache.get(request(quiet), ("groups",)) is None
+        await cache.invalidate_async("groups")
+        assert await cache.get(request(after_write), ("groups",)) is None
+
+    asyncio.run(scenario())
+    assert quiet.info["use_replica"] is True
+    assert after_write.info["use_replica"] is False
+
+
+def test_writes_stop_counting_as_recent():
+    backend = MemoryBackend(max_entries=10)
+    backend.bump("groups", recent=60)
+    assert backend.versions(("users", "groups")) == ([0, 1], True)
+    backend.bump("groups", recent=0)
+    assert backend.versions(("users", "groups")) == ([0, 2], False)
@@ -0,0 +1,55 @@
+""" Idempotency-Key replays, through the API
+
+Run with: TEST_DATABASE_URL=postgresql://... python -m pytest app/test_idempotency.py
+"""
+import pytest
+
+from app import idempotency
+from app.conftest import create_user
+
+
+def create_group(client, user: dict, name: str, key: str):
+    return client.post(f"/users/{user['id']}/groups/", json={"name": name}, headers={"Idempotency-Key": key})
+
+
+def group_names(client):
+    return sorted(group["name"] for group in client.get("/groups/").json())
+
+
+def test_retry_replays_the_first_response(client):
+    alice, _ = create_user(client, "alice")
+    first = create_group(client, alice, "Flat", "key-1")
+    idempotency.get_idempotency_store().front.clear()
+    # Answered from the database, then from the per-process cache
+    for _ in range(2):
+        retry = create_group(client, alice, "Flat", "key-1")
+        assert (retry.status_code, retry.json()) == (first.status_code, first.json())
+    assert group_names(client) == ["Flat"]
+
+
+def test_key_does_not_replay_to_another_caller(client):
+    alice, _ = create_user(client, "alice")
+    bob, _ = create_user(client, "bob")
+    create_group(client, alice, "Alice's", "shared-key")
+    response = create_group(client, bob, "Bob's", "shared-key")
+
+    assert response.status_code == 200
+    assert response.json()["owner_id"] == bob["id"]
+    assert group_names(client) == ["Alice's", "Bob's"]
+
+
+def test_failed_response_leaves_neither_write_nor_key(client, monkeypatch):
+    alice, _ = create_user(client, "alice")
+
+    def fail(type_, content):
+        raise RuntimeError("serialization failed")
+
+    monkeypatch.setattr(idempotency, "dump_json", fail)
+    with pytest.raises(RuntimeError):
+        create_group(client, alice, "Flat", "key-1")
+    assert group_names(client) == []
+
+    monkeypatch.undo()
+    # The key was released along with the write, so the retry runs it
+    assert create_group(client, alice, "Flat", "key-1").status_code == 200
+    assert group_names(client) == ["Flat"]
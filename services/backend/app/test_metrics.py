@@ -0,0 +1,30 @@
+""" Threadpool and connection pool instrumentation
+
+Run with: TEST_DATABASE_URL=postgresql://... python -m pytest app/test_metrics.py
+"""
+import asyncio
+import time
+
+from app import metrics
+
+
+def count(histogram: metrics.Histogram, *labels):
+    return next((value for name, sample_labels, _, value in histogram.samples()
+                 if name.endswith("_count") and sample_labels == labels), 0)
+
+
+def test_to_thread_records_its_queue_wait():
+    before = count(metrics.THREADPOOL_QUEUE_SECONDS)
+
+    async def run():
+        return await metrics.to_thread(time.sleep, 0)
+
+    asyncio.run(run())
+    assert count(metrics.THREADPOOL_QUEUE_SECONDS) == before + 1
+
+
+def test_requests_record_pool_checkouts(client):
+    before = count(metrics.DB_POOL_CHECKOUT_SECONDS, "async")
+    assert client.get("/groups/").status_code == 200
+    assert count(metrics.DB_POOL_CHECKOUT_SECONDS, "async") > before
+    assert "db_pool_checkout_seconds_count" in client.get("/metrics").text
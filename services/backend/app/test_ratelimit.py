@@ -0,0 +1,60 @@
+""" Token buckets: refill, refusal, and requests refused by one bucket not charging the others
+
+Run with: TEST_DATABASE_URL=postgresql://... python -m pytest app/test_ratelimit.py
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from app import ratelimit
+from app.conftest import PASSWORD, create_user
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Seconds on the buckets' clock; advance with clock[0] += seconds """
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_bucket_refuses_when_empty_and_refills(clock):
+    backend = ratelimit.MemoryBackend(shards=4, max_keys=100)
+    bucket = [("login:ip:1.2.3.4", 0.5, 2.0)]
+    assert backend.take(bucket) == (True, [1.0])
+    assert backend.take(bucket) == (True, [0.0])
+    assert backend.take(bucket) == (False, [0.0])
+    clock[0] += 1
+    assert backend.take(bucket) == (False, [0.5])
+    clock[0] += 1
+    assert backend.take(bucket) == (True, [0.0])
+    # Never refills past its capacity
+    clock[0] += 60
+    assert backend.take(bucket) == (True, [1.0])
+
+
+def test_refused_take_charges_no_bucket(clock):
+    backend = ratelimit.MemoryBackend(shards=4, max_keys=100)
+    ip, email = ("login:ip:1.2.3.4", 1.0, 5.0), ("login:email:a@example.com", 1.0, 1.0)
+    assert backend.take([ip, email]) == (True, [4.0, 0.0])
+    assert backend.take([ip, email]) == (False, [4.0, 0.0])
+    assert backend.take([ip]) == (True, [3.0])
+
+
+def test_refused_email_leaves_the_ip_budget(client):
+    user, _ = create_user(client, "alice")
+    limits = ratelimit.login_rate_limit.limits
+    attempts = int(limits["email"].capacity)
+    for _ in range(attempts):
+        client.post("/token", data={"username": "bob@example.com", "password": "wrong"})
+    for _ in range(5):
+        response = client.post("/token", data={"username": "bob@example.com", "password": "wrong"})
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+
+    assert client.post("/token", data={"username": user["email"], "password": PASSWORD}).status_code == 200
+    # create_user's login, bob's allowed attempts and this one: the refused ones cost the IP nothing.
+    # A take of nothing reads the bucket (TestClient's address is "testclient")
+    ip = limits["ip"]
+    _, [tokens] = ratelimit.get_limiter_backend().take([("login:ip:testclient", ip.rate, ip.capacity)], cost=0)
+    assert int(tokens) == int(ip.capacity) - (1 + attempts + 1)
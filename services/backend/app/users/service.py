@@ -0,0 +1,130 @@
+""" Password hashing service: runs bcrypt in a process pool so it doesn't block the event loop """
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from fastapi import HTTPException, status
+
+from app import metrics
+from app.config import get_settings
+
+# Passwords per process pool task in hash_many: small, so a bulk import never holds a worker for long
+HASH_CHUNK_SIZE = 4
+
+
+@lru_cache
+def get_pwd_context():
+    """ passlib's bcrypt context, built on first use so importing the app doesn't load passlib """
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+# Run inside the worker processes; must be module level so they can be pickled
+def _hash(password: str):
+    return get_pwd_context().hash(password)
+
+
+def _verify(plain_password: str, hashed_password: str):
+    return get_pwd_context().verify(plain_password, hashed_password)
+
+
+def _hash_many(passwords: list[str]):
+    pwd_context = get_pwd_context()
+    return [pwd_context.hash(password) for password in passwords]
+
+
+class PasswordHasher:
+    """
+    Async bcrypt hashing/verification backed by a bounded process pool.
+    At most max_workers + queue_limit calls can be pending; past that callers get a 503
+    with Retry-After instead of piling up behind a login storm.
+    """
+
+    def __init__(self, max_workers: int, queue_limit: int, retry_after: int = 1):
+        self.max_workers = max_workers
+        self.queue_limit = queue_limit
+        self.retry_after = retry_after
+        self._pool: ProcessPoolExecutor | None = None
+        self._pending = 0
+        # Batches use at most half the workers, leaving the rest to logins
+        self._batch_slots = asyncio.Semaphore(max(1, max_workers // 2))
+
+    @property
+    def pending(self):
+        """ Number of hash/verify calls running or waiting for a worker """
+        return self._pending
+
+    def _get_pool(self):
+        # Created on first use so each (forked) server worker gets its own pool
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    async def _submit(self, operation: str, fn, *args):
+        if self._pending >= self.max_workers + self.queue_limit:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, try again shortly",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_pool(), fn, *args)
+        finally:
+            self._pending -= 1
+            metrics.observe_password_hash(operation, time.perf_counter() - start)
+
+    async def hash(self, password: str):
+        """ Hash the user's password in the process pool """
+        return await self._submit("hash", _hash, password)
+
+    async def hash_many(self, passwords: list[str]):
+        """
+        Hash a batch of passwords in chunks of HASH_CHUNK_SIZE, at most half the workers' worth at a time.
+        Each chunk takes a pending slot like a single hash, so a full pool refuses batches with a 503 too
+        """
+        chunks = [passwords[i:i + HASH_CHUNK_SIZE] for i in range(0, len(passwords), HASH_CHUNK_SIZE)]
+
+        async def hash_chunk(chunk):
+            async with self._batch_slots:
+                return await self._submit("hash", _hash_many, chunk)
+
+        tasks = [asyncio.ensure_future(hash_chunk(chunk)) for chunk in chunks]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # A refused chunk cancels the rest of the batch
+            for task in tasks:
+                task.cancel()
+            raise
+        return [hashed for chunk in results for hashed in chunk]
+
+    async def verify(self, plain_password: str, hashed_password: str):
+        """ Verify a password against its hash in the process pool """
+        return await self._submit("verify", _verify, plain_password, hashed_password)
+
+    def shutdown(self):
+        """ Stop the worker processes; called on application shutdown """
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+@lru_cache
+def get_password_hasher():
+    """ The process's password hasher, created from the settings on first use (its pool on first hash) """
+    settings = get_settings()
+    return PasswordHasher(
+        max_workers=settings.password_hash_workers,
+        queue_limit=settings.password_hash_queue_limit,
+        retry_after=settings.password_hash_retry_after,
+    )
+
+
+metrics.Gauge(
+    "password_hash_pending", "bcrypt calls running or queued in the process pool",
+    collect=lambda: {(): get_password_hasher().pending})
@@ -0,0 +1,102 @@
+""" In-process cache of verified JWTs and the user they resolve to """
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+
+from app.config import get_settings
+
+
+@dataclass
+class CachedToken:
+    """ Decoded claims and resolved user for one token """
+    claims: dict
+    user: object
+    user_id: int
+    expires_at: float
+
+
+class TokenCache:
+    """
+    Bounded LRU of verified tokens keyed by the SHA-256 digest of the token (the raw token is never stored).
+    Entries expire at the token's exp, or after max_ttl seconds if sooner, so changes made by
+    other workers are picked up eventually. invalidate_user() drops every token of a user.
+    """
+
+    def __init__(self, max_entries: int, max_ttl: float):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[bytes, CachedToken] = OrderedDict()
+        self._by_user: dict[int, set[bytes]] = {}
+        # Sync crud functions run in the threadpool and can invalidate concurrently
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str):
+        """ Return the cached entry for a token, or None on a miss/expired entry """
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, token: str, claims: dict, user, user_id: int):
+        """ Cache a verified token until its exp claim (capped at max_ttl); tokens without exp aren't cached """
+        if not isinstance(claims.get("exp"), (int, float)):
+            return
+        expires_at = min(float(claims["exp"]), time.time() + self.max_ttl)
+        key = self._key(token)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = CachedToken(claims=claims, user=user, user_id=user_id, expires_at=expires_at)
+            self._by_user.setdefault(user_id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int):
+        """ Drop every cached token belonging to a user (password reset, deactivation) """
+        with self._lock:
+            for key in list(self._by_user.get(user_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self):
+        """ Hit/miss counters and current size """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _remove(self, key: bytes):
+        # Caller must hold the lock
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._by_user.get(entry.user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[entry.user_id]
+
+
+@lru_cache
+def get_token_cache():
+    """ The process's token cache, created from the settings on first use """
+    settings = get_settings()
+    return TokenCache(max_entries=settings.token_cache_max_entries, max_ttl=settings.token_cache_max_ttl)
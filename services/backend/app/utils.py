@@ -2,13 +2,15 @@ import os
 from typing import Annotated
 
 from datetime import datetime, timedelta
-from jose import JWTError, jwt
 from pydantic import BaseModel
-from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from .db.database import SessionLocal
+from .config import get_settings
+from .db import async_crud, database, schemas
+from .users.service import get_pwd_context
+from .users.utils import get_token_cache
 
 # to get a string like this run:
 # openssl rand -hex 32
@@ -38,9 +40,6 @@ class UserInDB(User):
     hashed_password: str
 
 
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 # Create instance of the clas, pass in token as an argument
 # Frontend will use this url to send a username and password, return a token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -48,25 +47,44 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 def get_db():
     """Dependency to create DB sessions to read/write"""
-    db = SessionLocal()
+    db = database.SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
 
+async def get_async_db():
+    """Dependency to create async DB sessions for the coroutine routes"""
+    async with database.AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_async_read_db(request: Request):
+    """
+    Dependency for read-mostly routes: SELECTs go to a read replica until the session writes. The session
+    is kept on the request so the response cache can send a fill that follows a write to the primary
+    """
+    async with database.AsyncSessionLocal(info={"use_replica": True}) as db:
+        request.state.read_db = db
+        yield db
+
+
 def get_password_hash(password: str):
     """ Will hash the user's password so it can be added to the database """
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 
 def verify_password(plain_password, hashed_password):
     """ Verify the password entered against the hashed password in the database """
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 
 def create_access_token(data: dict):
     """ Create a JWT token and return it to the browser """
+    # jose (and the cryptography backend it loads) is imported on first use, not at app import
+    from jose import jwt
+
     expires_delta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode = data.copy()
     if expires_delta:
@@ -80,8 +98,14 @@ def create_access_token(data: dict):
 
 # Receives a token and returns the user associated with that token
 # Decode the token, verify it, and return the current user based on it
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(get_async_db)):
     """ Receives a token, decodes and verifies it, returns associated user """
+    # Repeat requests with the same token skip the HMAC check and the user lookup
+    cached = get_token_cache().get(token)
+    if cached is not None:
+        return cached.user
+    from jose import JWTError, jwt
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -95,13 +119,23 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = get_user(username=token_data.username)
-    if user is None:
+    db_user = await async_crud.get_user_by_username(db, username=token_data.username)
+    if db_user is None:
         raise credentials_exception
+    # Cache a detached snapshot rather than the ORM object bound to this request's session
+    user = schemas.UserModel.model_validate(db_user)
+    get_token_cache().set(token, claims=payload, user=user, user_id=db_user.id)
     return user
 
 
-async def get_current_active_user(current_user: Annotated[User, Depends(get_current_user)]):
-    if current_user.disabled:
+async def get_current_active_user(current_user: Annotated[schemas.UserModel, Depends(get_current_user)]):
+    if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
+
+
+async def get_current_admin_user(current_user: Annotated[schemas.UserModel, Depends(get_current_active_user)]):
+    """ The current user, if they are listed in ADMIN_USERNAMES """
+    if current_user.username not in get_settings().admin_usernames:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return current_user
@@ -0,0 +1,91 @@
+""" Timing helpers, result files and baseline comparison for the benchmark suite """
+import json
+import platform
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+def summarize(latencies: list[float], elapsed: float):
+    """ p50/p95/p99 latency in milliseconds and throughput for a list of per-call durations in seconds """
+    samples = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {
+        "count": len(latencies),
+        "p50_ms": round(float(p50), 4),
+        "p95_ms": round(float(p95), 4),
+        "p99_ms": round(float(p99), 4),
+        "ops_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+def bench(fn, iterations: int, warmup: int = 3):
+    """ Time a sync callable """
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def abench(fn, iterations: int, warmup: int = 3):
+    """ Time an async callable (awaited one call at a time) """
+    for _ in range(warmup):
+        await fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        await fn()
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def write_results(path: str, results: dict, backend: str):
+    """ Save results with enough context to tell whether two runs are comparable """
+    document = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "backend": backend,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "node": platform.node(),
+        },
+        "results": results,
+    }
+    with open(path, "w") as file:
+        json.dump(document, file, indent=2, sort_keys=True)
+
+
+def compare(results: dict, baseline_path: str, tolerance: float, backend: str):
+    """
+    Compare p50/p95 latency against a stored baseline file. Returns a list of regression messages for
+    every benchmark more than tolerance (e.g. 0.2 = 20%) slower than its baseline
+    """
+    with open(baseline_path) as file:
+        document = json.load(file)
+    if document["meta"]["backend"] != backend:
+        raise SystemExit(f"Baseline was recorded on {document['meta']['backend']}, not {backend}; not comparable")
+    baseline = document["results"]
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if current is None:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if base[metric] and current[metric] > base[metric] * (1 + tolerance):
+                change = (current[metric] / base[metric] - 1) * 100
+                regressions.append(f"{name} {metric}: {base[metric]:.3f} -> {current[metric]:.3f} ms (+{change:.0f}%)")
+    return regressions
+
+
+def print_table(results: dict):
+    print(f"{'benchmark':<40} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/s':>10}")
+    for name, result in results.items():
+        print(f"{name:<40} {result['count']:>7} {result['p50_ms']:>10.3f} {result['p95_ms']:>10.3f} "
+              f"{result['p99_ms']:>10.3f} {result['ops_per_sec']:>10.1f}")
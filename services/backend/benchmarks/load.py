@@ -0,0 +1,47 @@
+""" In-process ASGI load driver: concurrent clients against the app without a network hop """
+import asyncio
+import time
+
+import httpx
+
+from benchmarks.environment import BENCH_PASSWORD, BenchEnvironment
+from benchmarks.harness import summarize
+
+
+async def drive(client: httpx.AsyncClient, make_request, requests: int, concurrency: int):
+    """ Send requests from concurrency workers; fail loudly on any non-2xx response """
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for i in remaining:
+            start = time.perf_counter()
+            response = await make_request(client, i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 300:
+                raise RuntimeError(f"{response.request.method} {response.request.url} -> {response.status_code}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def run(env: BenchEnvironment, requests: int, concurrency: int):
+    tokens = [env.token(i) for i in range(min(len(env.usernames), 50))]
+    scenarios = {
+        "GET /users/": lambda client, i: client.get("/users/", params={"limit": 100}),
+        "GET /groups/": lambda client, i: client.get("/groups/", params={"limit": 100}),
+        "GET /users/me": lambda client, i: client.get(
+            "/users/me", headers={"Authorization": f"Bearer {tokens[i % len(tokens)]}"}),
+        "POST /token": lambda client, i: client.post(
+            "/token", data={"username": env.emails[i % len(env.emails)], "password": BENCH_PASSWORD}),
+    }
+    # Every /token request is a bcrypt verify, so it gets fewer requests
+    counts = {"POST /token": max(concurrency, requests // 20)}
+
+    results = {}
+    transport = httpx.ASGITransport(app=env.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name, make_request in scenarios.items():
+            results[f"load {name}"] = await drive(client, make_request, counts.get(name, requests), concurrency)
+    return results
@@ -0,0 +1,78 @@
+""" Micro-benchmarks: crud queries, tokens, bcrypt and response serialization """
+from benchmarks.environment import BENCH_PASSWORD, BenchEnvironment
+from benchmarks.harness import abench, bench
+
+
+def run_sync(env: BenchEnvironment, iterations: int):
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    from app.db import crud, schemas
+    from app.responses import dump_json, type_adapter
+    from app.users.service import get_pwd_context
+    from app.utils import create_access_token
+
+    results = {}
+    user_id, email = env.user_ids[0], env.emails[0]
+    with env.SessionLocal() as db:
+        # expire_all so every call goes to the database instead of the identity map
+        def query(fn):
+            def call():
+                db.expire_all()
+                fn()
+            return call
+
+        results["crud.get_user"] = bench(query(lambda: crud.get_user(db, user_id=user_id)), iterations)
+        results["crud.get_user_by_email"] = bench(query(lambda: crud.get_user_by_email(db, email=email)), iterations)
+        results["crud.get_users[100]"] = bench(query(lambda: crud.get_users(db, limit=100)), iterations)
+        results["crud.get_groups[100]"] = bench(query(lambda: crud.get_groups(db, limit=100)), iterations)
+
+        users = crud.get_users(db, limit=100)
+        results["serialize.UserModel[100]"] = bench(lambda: dump_json(list[schemas.UserModel], users), iterations)
+        # What a route returning ORM objects with response_model costs: validate, dump to Python, json.dumps
+        adapter = type_adapter(list[schemas.UserModel])
+        results["serialize.UserModel[100].response_model"] = bench(
+            lambda: JSONResponse(jsonable_encoder(adapter.dump_python(adapter.validate_python(users), mode="json"))),
+            iterations)
+
+    results["create_access_token"] = bench(lambda: create_access_token(data={"sub": env.usernames[0]}), iterations)
+
+    # bcrypt is slow by design; a handful of rounds is enough
+    pwd_context = get_pwd_context()
+    hashed = pwd_context.hash(BENCH_PASSWORD)
+    rounds = max(3, iterations // 50)
+    results["bcrypt.hash"] = bench(lambda: pwd_context.hash(BENCH_PASSWORD), rounds, warmup=1)
+    results["bcrypt.verify"] = bench(lambda: pwd_context.verify(BENCH_PASSWORD, hashed), rounds, warmup=1)
+    return results
+
+
+async def run_async(env: BenchEnvironment, iterations: int):
+    from app.db import async_crud
+    from app.users.service import get_password_hasher
+    from app.users.utils import get_token_cache
+    from app.users.service import get_pwd_context
+    from app.utils import get_current_user
+
+    results = {}
+    token = env.token()
+    async with env.AsyncSessionLocal() as db:
+        async def users_page():
+            db.expunge_all()
+            await async_crud.get_users(db, limit=100)
+
+        results["async_crud.get_users[100]"] = await abench(users_page, iterations)
+
+        async def current_user_uncached():
+            get_token_cache().clear()
+            db.expunge_all()
+            await get_current_user(token, db)
+
+        results["get_current_user.uncached"] = await abench(current_user_uncached, iterations)
+        results["get_current_user.cached"] = await abench(lambda: get_current_user(token, db), iterations)
+
+    pwd_context = get_pwd_context()
+    hashed = pwd_context.hash(BENCH_PASSWORD)
+    rounds = max(3, iterations // 50)
+    results["password_hasher.verify"] = await abench(
+        lambda: get_password_hasher().verify(BENCH_PASSWORD, hashed), rounds, warmup=1)
+    return results
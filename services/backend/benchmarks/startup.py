@@ -0,0 +1,63 @@
+""" Cold start benchmark: each run is a fresh interpreter, timed from first import to the first /ready """
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.harness import summarize
+
+PHASES = ("import", "lifespan", "first_ready", "total")
+
+
+async def _serve_first_ready(app):
+    import httpx
+
+    timings = {}
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        timings["lifespan"] = time.perf_counter() - start
+        start = time.perf_counter()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            response = await client.get("/ready")
+        if response.status_code != 200:
+            raise RuntimeError(f"GET /ready -> {response.status_code}")
+        timings["first_ready"] = time.perf_counter() - start
+    return timings
+
+
+def probe(backend: str, database_url: str | None):
+    """ One cold start in this process: import the app, run its startup, serve GET /ready """
+    import asyncio
+
+    start = time.perf_counter()
+    from benchmarks.environment import configure
+
+    configure(backend, database_url)
+    from app.main import app
+
+    timings = {"import": time.perf_counter() - start}
+    timings.update(asyncio.run(_serve_first_ready(app)))
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def run(backend: str, database_url: str | None, runs: int):
+    """ Time runs cold starts, each in a new interpreter so nothing is already imported """
+    samples = {phase: [] for phase in PHASES}
+    started = time.perf_counter()
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.startup", backend, database_url or ""],
+            check=True, capture_output=True, text=True, env=os.environ.copy(),
+        ).stdout
+        timings = json.loads(output.splitlines()[-1])
+        for phase in PHASES:
+            samples[phase].append(timings[phase])
+    elapsed = time.perf_counter() - started
+    return {f"startup.{phase}": summarize(samples[phase], elapsed) for phase in PHASES}
+
+
+if __name__ == "__main__":
+    print(json.dumps(probe(sys.argv[1], sys.argv[2] or None)))
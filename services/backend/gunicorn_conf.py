@@ -0,0 +1,49 @@
+""" Gunicorn settings for production: gunicorn -c gunicorn_conf.py app.main:app """
+import multiprocessing
+import os
+
+# One uvicorn worker per core by default; WEB_CONCURRENCY overrides it
+cores = multiprocessing.cpu_count()
+workers = int(os.getenv("WEB_CONCURRENCY", cores))
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = os.getenv("BIND", f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}")
+
+# Every worker has its own bcrypt process pool; split the cores between them instead of
+# starting cores x workers hashing processes. Each worker also has its own DB pool
+# (DB_POOL_SIZE + DB_MAX_OVERFLOW connections), so size max_connections for all of them
+os.environ.setdefault("PASSWORD_HASH_WORKERS", str(max(1, cores // workers)))
+# A write only invalidates the in-memory response cache of the worker that made it, the others would keep
+# serving the stale responses: with several workers the cache is shared through Redis unless configured
+if workers > 1:
+    os.environ.setdefault("RESPONSE_CACHE_BACKEND", "redis")
+
+# Import the app once in the master and fork the workers from it: faster startup, shared memory
+preload_app = True
+
+# Restart each worker after a while (jittered so they don't all restart at once) to bound leaks;
+# a worker being replaced gets graceful_timeout seconds to finish its in-flight requests
+max_requests = int(os.getenv("MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", 1000))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.getenv("TIMEOUT", 60))
+keepalive = int(os.getenv("KEEP_ALIVE", 5))
+
+accesslog = os.getenv("ACCESS_LOG", "-")
+errorlog = os.getenv("ERROR_LOG", "-")
+loglevel = os.getenv("LOG_LEVEL", "info")
+
+
+def post_fork(server, worker):
+    # Engines are created lazily, but anything the master connected before forking must not be
+    # shared: a pooled connection used by two processes corrupts both, so each worker starts empty
+    from app.cache import get_response_cache
+    from app.db import database
+    from app.idempotency import get_idempotency_store
+    from app.ratelimit import get_limiter_backend
+
+    database.dispose_engines()
+    get_response_cache().after_fork()
+    get_idempotency_store().after_fork()
+    limiter_backend = get_limiter_backend()
+    if limiter_backend is not None:
+        limiter_backend.after_fork()